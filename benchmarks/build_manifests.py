@@ -0,0 +1,59 @@
+"""
+Benchmarks building the manifests of a deploy from the compiled templates (see portal/manifests.py)
+against rendering the Jinja templates and parsing them with yaml.safe_load.
+
+Example usage:
+===============
+
+cd <path>/<to>/af-portal
+python benchmarks/build_manifests.py -n 1000
+"""
+
+import argparse
+import time
+import yaml
+import harness
+from jinja2 import Environment, FileSystemLoader
+from portal import manifests
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("-n", type=int, default=1000)
+    args = parser.parse_args()
+    settings = dict(
+        harness.notebook_settings("mynotebook", gpu=1),
+        cpu_request=4,
+        cpu_limit=8,
+        memory_request="16Gi",
+        memory_limit="32Gi",
+        gpu_node="",
+        storage_class="rook-cephfs",
+        namespace="af-jupyter",
+        domain_name="af.uchicago.edu",
+        token="dG9rZW4=",
+        start_script="/usr/local/bin/SetupPrivateJupyterLab.sh",
+    )
+    times = dict(compiled=[], rendered=[])
+    for _ in range(args.n):
+        start = time.perf_counter()
+        for kind in manifests.compiled:
+            manifests.build(kind, **settings)
+        times["compiled"].append((time.perf_counter() - start) * 1000)
+    # Rendering is much slower, so it runs a tenth as many times
+    for _ in range(args.n // 10 or 1):
+        start = time.perf_counter()
+        templates = Environment(loader=FileSystemLoader(manifests.template_dir))
+        for kind in manifests.compiled:
+            yaml.safe_load(templates.get_template(kind + ".yaml").render(**settings))
+        times["rendered"].append((time.perf_counter() - start) * 1000)
+    for path, result in times.items():
+        result = harness.summary(result)
+        print(
+            "%-9s the manifests of a deploy: median %.1f ms, max %.1f ms"
+            % (path, result["median"], result["max"])
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,28 @@
+"""
+Shared setup of the benchmarks: the throwaway configuration, the notebook settings and the fake Kubernetes API
+of the tests (see tests/), and a timer. Import it before the portal.
+"""
+
+import os
+import sys
+import time
+
+root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path[:0] = [root, os.path.join(root, "tests")]
+
+# The benchmarks run as scripts, so the paths of the portal and the tests are added before the shared test setup
+# is imported, which configures the portal (see tests/environment.py)
+from environment import notebook_settings  # noqa: E402, F401
+
+
+def timed(fn, *args, **kwargs):
+    """Calls a function. Returns the time it took in milliseconds."""
+    start = time.perf_counter()
+    fn(*args, **kwargs)
+    return (time.perf_counter() - start) * 1000
+
+
+def summary(times):
+    """Returns the median and the max of a list of times in milliseconds, as a dict."""
+    times = sorted(times)
+    return dict(median=round(times[len(times) // 2], 1), max=round(times[-1], 1))
@@ -0,0 +1,71 @@
+"""
+Benchmarks the JSON codec (see portal/codec.py) against the json module: decoding a multiplex response of the
+Connect API with the profiles of n users, and encoding the profiles as a JSON response.
+
+Example usage:
+===============
+
+cd <path>/<to>/af-portal
+python benchmarks/json_codec.py -n 10000
+"""
+
+import argparse
+import json
+import harness
+from portal import codec
+
+
+def multiplex_response(n):
+    """Returns a multiplex response with the user records of n users, as bytes."""
+    bodies = {
+        "/v1alpha1/users/user%d?token=..." % i: {
+            "status": 200,
+            "body": json.dumps(
+                {
+                    "kind": "User",
+                    "metadata": {
+                        "unix_name": "user%d" % i,
+                        "unix_id": 10000 + i,
+                        "name": "User %d" % i,
+                        "email": "user%d@example.org" % i,
+                        "institution": "University of Chicago",
+                        "phone": "555-0100",
+                        "join_date": "2023-06-01T12:00:00Z",
+                        "public_key": "ssh-ed25519 AAAAC3NzaC1lZDI1NTE5AAAAI%032d" % i,
+                        "group_memberships": [
+                            {"name": "root", "state": "active"},
+                            {"name": "root.atlas-af", "state": "active"},
+                        ],
+                    },
+                }
+            ),
+        }
+        for i in range(n)
+    }
+    return json.dumps(bodies).encode()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("-n", type=int, default=10000)
+    args = parser.parse_args()
+    payload = multiplex_response(args.n)
+    print("%d users, %.1f MB multiplex response" % (args.n, len(payload) / 1e6))
+    codecs = {codec.name: (codec.loads, codec.dumps)}
+    codecs["json"] = (json.loads, lambda obj: json.dumps(obj).encode())
+    for label, (decode, encode) in codecs.items():
+        profiles = []
+
+        def decode_all():
+            data = decode(payload)
+            profiles.extend(
+                decode(value["body"])["metadata"] for value in data.values()
+            )
+
+        decoded = harness.timed(decode_all)
+        encoded = harness.timed(encode, {"users": profiles})
+        print("%-6s decode: %.1f ms, encode: %.1f ms" % (label, decoded, encoded))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,73 @@
+"""
+Benchmarks the memory used by the profiles of the users of a large group, as dicts (as connect.get_user_profiles
+used to build them) and as records (see portal/records.py).
+
+Example usage:
+===============
+
+cd <path>/<to>/af-portal
+python benchmarks/profile_memory.py -n 50000
+"""
+
+import argparse
+import tracemalloc
+
+# The harness configures the portal before it is imported
+import harness  # noqa: F401
+from portal.records import Profile, facility_group, format_date
+
+
+def group_metadata(n):
+    """Returns the metadata of n users of a group, as the Connect API lists them."""
+    return [
+        dict(
+            unix_name="user%d" % i,
+            unix_id=10000 + i,
+            name="User %d" % i,
+            email="user%d@example.org" % i,
+            institution="University of Chicago",
+            phone="555-0100",
+            join_date="2023-06-%02dT12:00:00Z" % (i % 28 + 1),
+            group_memberships=[
+                dict(name="root", state="active"),
+                dict(name=facility_group, state=("active", "pending")[i % 2]),
+            ],
+        )
+        for i in range(n)
+    ]
+
+
+def as_dict(m):
+    membership = [g for g in m["group_memberships"] if g["name"] == facility_group]
+    return dict(
+        unix_name=m["unix_name"],
+        unix_id=m["unix_id"],
+        name=m["name"],
+        email=m["email"],
+        institution=m["institution"],
+        phone=m["phone"],
+        join_date=format_date(m["join_date"]),
+        role=membership[0]["state"] if membership else "nonmember",
+    )
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("-n", type=int, default=50000)
+    args = parser.parse_args()
+    metadata = group_metadata(args.n)
+    build = dict(dicts=as_dict, records=lambda m: Profile.from_metadata(m, full=False))
+    for kind, fn in build.items():
+        tracemalloc.start()
+        profiles = [fn(m) for m in metadata]
+        used = tracemalloc.get_traced_memory()[0]
+        tracemalloc.stop()
+        del profiles
+        print(
+            "%-7s %.1f MB for %d profiles, %d bytes each"
+            % (kind, used / 1e6, args.n, used / args.n)
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,67 @@
+"""
+Benchmarks stopping and resuming a notebook against removing it and deploying it again, on the fake Kubernetes API
+of the tests. Each API call takes --latency seconds, to model the round trip to the API server.
+
+The benchmark measures the time that the portal spends in each path and the number of API calls it makes.
+Pulling the image and starting the container are the same for a new pod either way, so they are not modeled here.
+
+Example usage:
+===============
+
+cd <path>/<to>/af-portal
+python benchmarks/stop_resume.py --latency 0.01 -n 20
+"""
+
+import argparse
+import harness
+from fake_kubernetes import FakeCluster
+from portal import jupyterlab
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--latency", type=float, default=0.005)
+    parser.add_argument("-n", type=int, default=20)
+    args = parser.parse_args()
+    cluster = FakeCluster(latency=args.latency)
+    cluster.install()
+    results = {}
+    for path in ("remove + deploy", "stop + resume"):
+        name = path.split()[0]
+        down, up, calls = [], [], 0
+        jupyterlab.deploy_notebook(**harness.notebook_settings(name))
+        for _ in range(args.n):
+            before = sum(cluster.calls.values())
+            if path == "stop + resume":
+                down.append(harness.timed(jupyterlab.stop_notebook, name))
+                up.append(harness.timed(jupyterlab.resume_notebook, name))
+            else:
+                down.append(harness.timed(jupyterlab.remove_notebook, name))
+                up.append(
+                    harness.timed(
+                        jupyterlab.deploy_notebook, **harness.notebook_settings(name)
+                    )
+                )
+            calls += sum(cluster.calls.values()) - before
+        results[path] = dict(
+            down=harness.summary(down),
+            up=harness.summary(up),
+            calls=round(calls / args.n, 1),
+        )
+    print("Latency of each API call: %.1f ms" % (args.latency * 1000))
+    for path, result in results.items():
+        print(
+            "%-16s down: median %.1f ms, max %.1f ms; up: median %.1f ms, max %.1f ms; %.1f API calls"
+            % (
+                path,
+                result["down"]["median"],
+                result["down"]["max"],
+                result["up"]["median"],
+                result["up"]["max"],
+                result["calls"],
+            )
+        )
+
+
+if __name__ == "__main__":
+    main()
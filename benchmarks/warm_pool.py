@@ -0,0 +1,82 @@
+"""
+Benchmarks claiming a warm pod against a cold deploy, on the fake Kubernetes API of the tests.
+Each API call takes --latency seconds, and a new pod is Pending for --startup seconds (the image pull and the
+container start) before it is Running and Ready. The time to Ready is measured from the call until the pod is Ready.
+
+Example usage:
+===============
+
+cd <path>/<to>/af-portal
+python benchmarks/warm_pool.py --latency 0.01 --startup 2 -n 10
+"""
+
+import argparse
+import time
+import harness
+from fake_kubernetes import FakeCluster
+from portal import jupyterlab, warmpool
+
+image = "hub.opensciencegrid.org/usatlas/ml-platform:latest"
+
+
+def wait_until_ready(cluster, name):
+    """Waits until a pod is Ready, without counting the reads as API calls."""
+    while True:
+        pod = cluster.get("pod", name, cluster.namespace)
+        if pod.status.phase == "Running":
+            return
+        time.sleep(0.01)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--latency", type=float, default=0.005)
+    parser.add_argument("--startup", type=float, default=1.0)
+    parser.add_argument("-n", type=int, default=5)
+    args = parser.parse_args()
+    cluster = FakeCluster(latency=args.latency, startup_seconds=args.startup)
+    cluster.install()
+    warmpool.pool = [dict(image=image, cpu=1, memory=4, size=args.n)]
+    warmpool.refill()
+    # The warm pods start before anyone claims them
+    time.sleep(args.startup)
+    results = {}
+    for path in ("cold deploy", "warm claim"):
+        call, ready, api_calls = [], [], 0
+        for i in range(args.n):
+            settings = harness.notebook_settings("%s-%d" % (path.split()[0], i))
+            before = sum(cluster.calls.values())
+            start = time.perf_counter()
+            if path == "warm claim":
+                name = warmpool.claim(**settings)
+            else:
+                jupyterlab.deploy_notebook(**settings)
+                name = settings["notebook_id"]
+            call.append((time.perf_counter() - start) * 1000)
+            api_calls += sum(cluster.calls.values()) - before
+            wait_until_ready(cluster, name)
+            ready.append((time.perf_counter() - start) * 1000)
+        results[path] = dict(
+            call=harness.summary(call),
+            ready=harness.summary(ready),
+            api_calls=api_calls / args.n,
+        )
+    print(
+        "Latency of each API call: %.1f ms, pod startup: %.1f s"
+        % (args.latency * 1000, args.startup)
+    )
+    for path, result in results.items():
+        print(
+            "%-12s call: median %.1f ms; time to Ready: median %.1f ms, max %.1f ms; %.1f API calls"
+            % (
+                path,
+                result["call"]["median"],
+                result["ready"]["median"],
+                result["ready"]["max"],
+                result["api_calls"],
+            )
+        )
+
+
+if __name__ == "__main__":
+    main()
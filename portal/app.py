@@ -1,10 +1,44 @@
-from flask import Flask
+from flask import Flask, current_app
+from flask.json.provider import DefaultJSONProvider
 from flask_wtf.csrf import CSRFProtect
 from jinja2_markdown import MarkdownExtension
 import logging
+import os
+from portal import codec
+
+
+class JSONProvider(DefaultJSONProvider):
+    """
+    Serializes records (see records.py) as dicts, and encodes responses with the fast JSON codec
+    when it is installed (see codec.py). The body of a response is the encoded bytes, without another copy.
+    """
+
+    @staticmethod
+    def default(o):
+        if hasattr(o, "to_dict"):
+            return o.to_dict()
+        return DefaultJSONProvider.default(o)
+
+    def dumps(self, obj, **kwargs):
+        if codec.orjson is None or kwargs:
+            return super().dumps(obj, **kwargs)
+        return codec.dumps(obj, default=self.default, sort_keys=self.sort_keys).decode()
+
+    def response(self, *args, **kwargs):
+        if codec.orjson is None:
+            return super().response(*args, **kwargs)
+        # The arguments are read as jsonify reads them: one positional argument, several, or keyword arguments
+        if args and kwargs:
+            raise TypeError("app.json.response() takes either args or kwargs, not both")
+        obj = args[0] if len(args) == 1 else (args or kwargs or None)
+        body = codec.dumps(obj, default=self.default, sort_keys=self.sort_keys)
+        return current_app.response_class(body + b"\n", mimetype=self.mimetype)
+
 
 app = Flask(__name__)
-app.config.from_pyfile("secrets/portal.conf")
+app.json = JSONProvider(app)
+# PORTAL_CONFIG points the app at another configuration file (e.g. in the tests)
+app.config.from_pyfile(os.environ.get("PORTAL_CONFIG", "secrets/portal.conf"))
 app.jinja_env.add_extension(MarkdownExtension)
 csrf = CSRFProtect(app)
 
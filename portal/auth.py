@@ -0,0 +1,147 @@
+"""
+Globus Auth for the login path: a long-lived auth client, and the cached OIDC metadata and signing keys of Globus Auth.
+
+Logging in used to build a new ConfidentialAppAuthClient (and its HTTP session) on every call, and decoding the
+ID token fetched the OIDC configuration and the signing keys (JWKS) from Globus Auth on every login.
+Now one client is shared by every request, and each login gets its own authorization code flow on that client,
+so that concurrent logins do not share flow state. The OIDC configuration is cached for OIDC_CACHE_TTL seconds,
+and the signing keys are cached by key ID. When an ID token is signed with a key ID that is not in the cache
+(e.g. after Globus Auth rotates its keys), the keys are fetched again, at most once every JWKS_MIN_REFRESH seconds.
+
+Functionality:
+===============
+
+1. The get_client function returns the shared auth client
+2. The start_flow function starts an authorization code flow for a login
+3. The decode_id_token function verifies and decodes the ID token of a login, with the cached OIDC metadata and keys
+4. The revocation_job function returns a job that revokes a session's tokens (see views.my_job_queue)
+
+Dependencies:
+===============
+
+A portal.conf file with CLIENT_ID and CLIENT_SECRET, and the following optional settings:
+
+OIDC_CACHE_TTL: (int) How long (in seconds) the OIDC configuration is cached. The default is 86400.
+JWKS_MIN_REFRESH: (int) The min time (in seconds) between two fetches of the signing keys. The default is 60.
+
+Example usage:
+===============
+
+cd <path>/<to>/af-portal
+python
+>>> from portal import auth
+>>> flow = auth.start_flow('https://af.uchicago.edu/login')
+>>> flow.get_authorize_url()
+>>> auth.get_openid_configuration()
+"""
+
+import json
+import threading
+import time
+import globus_sdk
+import jwt
+from globus_sdk.services.auth import GlobusAuthorizationCodeFlowManager
+from portal.app import app, logger
+
+oidc_cache_ttl = app.config.get("OIDC_CACHE_TTL", 86400)
+jwks_min_refresh = app.config.get("JWKS_MIN_REFRESH", 60)
+
+lock = threading.Lock()
+client = None
+# A tuple (timestamp, OIDC configuration as a dict)
+openid_configuration = None
+# The signing keys of Globus Auth, by key ID
+signing_keys = {}
+jwks_fetched = 0
+
+
+def get_client():
+    """Returns the auth client that is shared by every request. The client is created on the first call."""
+    global client
+    with lock:
+        if client is None:
+            client = globus_sdk.ConfidentialAppAuthClient(
+                app.config["CLIENT_ID"], app.config["CLIENT_SECRET"]
+            )
+        return client
+
+
+def start_flow(redirect_uri):
+    """Returns a new authorization code flow on the shared client (see get_authorize_url and exchange_code_for_tokens)."""
+    return GlobusAuthorizationCodeFlowManager(
+        get_client(), redirect_uri, refresh_tokens=True
+    )
+
+
+def get_openid_configuration():
+    """Returns the OIDC configuration of Globus Auth as a dict, from the cache when it is younger than OIDC_CACHE_TTL."""
+    global openid_configuration
+    with lock:
+        entry = openid_configuration
+    if entry and time.time() - entry[0] < oidc_cache_ttl:
+        return entry[1]
+    data = get_client().get_openid_configuration().data
+    with lock:
+        openid_configuration = (time.time(), data)
+    logger.info("Fetched the OIDC configuration of Globus Auth")
+    return data
+
+
+def get_signing_key(kid):
+    """
+    Returns the public key with a key ID, from the cache, or else from a fresh fetch of the signing keys.
+    When kid is None, returns the first key, as the Globus SDK does.
+    """
+    global jwks_fetched
+    with lock:
+        key = signing_keys.get(kid)
+        stale = time.time() - jwks_fetched >= jwks_min_refresh
+    if key is not None or (signing_keys and not stale):
+        return key
+    jwk_data = get_client().get_jwk(get_openid_configuration(), as_pem=False)
+    keys = {}
+    for i, jwk in enumerate(jwk_data["keys"]):
+        public_key = jwt.algorithms.RSAAlgorithm.from_jwk(json.dumps(jwk))
+        keys[jwk.get("kid")] = public_key
+        if i == 0:
+            keys[None] = public_key
+    with lock:
+        signing_keys.clear()
+        signing_keys.update(keys)
+        jwks_fetched = time.time()
+    logger.info("Fetched %d signing keys of Globus Auth" % len(jwk_data["keys"]))
+    return keys.get(kid)
+
+
+def decode_id_token(tokens):
+    """
+    Verifies and decodes the ID token in the token response of a login. Returns a dict.
+
+    tokens: (OAuthTokenResponse) The response of exchange_code_for_tokens
+    """
+    kid = jwt.get_unverified_header(tokens["id_token"]).get("kid")
+    key = get_signing_key(kid)
+    if key is None:
+        raise jwt.InvalidKeyError("Unknown signing key %s" % kid)
+    return tokens.decode_id_token(
+        openid_configuration=get_openid_configuration(), jwk=key
+    )
+
+
+def revoke_tokens(tokens):
+    """Revokes a list of access tokens."""
+    for token in tokens:
+        get_client().oauth2_revoke_token(token)
+    logger.info("Revoked %d tokens" % len(tokens))
+
+
+def revocation_job(tokens):
+    """
+    Returns a function without arguments that revokes a list of access tokens, to be run by the job queue.
+    The tokens are kept in the function, so that the job queue does not log them with the job's arguments.
+    """
+
+    def revoke_session_tokens():
+        revoke_tokens(tokens)
+
+    return revoke_session_tokens
@@ -0,0 +1,265 @@
+"""
+Notebook backends: the Kubernetes clusters (and namespaces) that notebooks are deployed on.
+
+The primary backend is the cluster and namespace set by KUBECONFIG and NAMESPACE.
+More backends (e.g. a second cluster that adds GPU capacity) can be configured in portal.conf,
+each with its own kubeconfig file, context, namespace and domain name.
+
+The functions in jupyterlab.py run against the current backend of the calling thread, which is the primary backend
+unless the call is made inside a backends.use block. Functions that gather data from every backend
+(e.g. listing notebooks, or modeling the GPU nodes) use fan_out, which calls a function on all backends concurrently
+and merges nothing by itself: it returns the result of each backend that answered in time.
+A backend that does not answer before its timeout is left out of the results, so one slow cluster does not stall the others.
+The calls made in fan_out keep the deadline of the calling request, and every Kubernetes call made during a request
+times out when the request's deadline passes (see deadlines.py).
+Each backend has its own thread pool, so a cluster that hangs only ties up its own threads.
+
+The GPU nodes of a backend other than the primary backend are named <backend>/<node>, so that node names are unique
+across clusters, and so that the backend of a reserved node can be looked up (see of_node).
+
+Functionality:
+===============
+
+1. The current function returns the current backend of the calling thread
+2. The use function sets the current backend of the calling thread, in a with block
+3. The fan_out function calls a function on every backend concurrently, with a timeout for each backend
+4. The locate function finds the backend that a notebook was deployed on
+5. The of_node function returns the backend of a GPU node
+6. The routed decorator runs a function that takes a notebook name on the notebook's backend
+
+Dependencies:
+===============
+
+A portal.conf file with the following optional settings:
+
+BACKENDS: (dict) The backends other than the primary backend, by name. Each backend is a dict with a kubeconfig file,
+          and optionally a context, a namespace (the default is NAMESPACE), a domain_name (the default is DOMAIN_NAME),
+          a timeout in seconds, and the storage_class of the owners' persistent volumes (see jupyterlab.deploy_notebook).
+          A backend without a storage_class deploys notebooks without a persistent volume. e.g.
+          {"gpu-cluster": {"kubeconfig": "/etc/portal/gpu-cluster.conf", "namespace": "af-jupyter", "timeout": 5}}
+PRIMARY_BACKEND: (string) The name of the primary backend. The default is "primary".
+BACKEND_TIMEOUT: (number) The default timeout (in seconds) for each backend in fan_out. The default is 10.
+STORAGE_CLASS: (string) The storage class of the owners' persistent volumes on the primary backend.
+               The default is "rook-cephfs". When it is empty, the primary backend deploys notebooks without them.
+
+Example usage:
+===============
+
+cd <path>/<to>/af-portal
+python
+>>> from portal import backends, jupyterlab
+>>> backends.fan_out(jupyterlab.list_notebooks)
+>>> with backends.use('gpu-cluster'):
+...     jupyterlab.list_notebooks()
+>>> backends.locate('mynotebook')
+"""
+
+import concurrent.futures
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from functools import wraps
+from kubernetes import client, config
+from kubernetes.client.exceptions import ApiException
+from portal import deadlines
+from portal.app import app, logger
+
+primary_name = app.config.get("PRIMARY_BACKEND", "primary")
+default_timeout = app.config.get("BACKEND_TIMEOUT", 10)
+primary_storage_class = app.config.get("STORAGE_CLASS", "rook-cephfs")
+
+registry = {}
+lock = threading.Lock()
+local = threading.local()
+
+
+class ApiClient(client.ApiClient):
+    """A Kubernetes API client whose calls take their timeout from the deadline of the request (see deadlines.py)."""
+
+    def call_api(self, *args, **kwargs):
+        if kwargs.get("_request_timeout") is None:
+            kwargs["_request_timeout"] = deadlines.timeout(None, "kubernetes")
+        return super().call_api(*args, **kwargs)
+
+
+class Backend:
+    def __init__(
+        self,
+        name,
+        kubeconfig=None,
+        context=None,
+        namespace=None,
+        domain_name=None,
+        timeout=None,
+        storage_class=None,
+    ):
+        """
+        name: (string) The name of the backend
+        kubeconfig: (string) The path of the backend's kubeconfig file. The primary backend uses the loaded kubeconfig.
+        context: (string) The kubeconfig context of the backend (optional)
+        namespace: (string) The namespace that notebooks are deployed in
+        domain_name: (string) The domain name of the backend's notebooks
+        timeout: (number) How long (in seconds) fan_out waits for the backend
+        storage_class: (string) The storage class of the owners' persistent volumes, or None when the backend has none.
+                       The primary backend uses STORAGE_CLASS.
+        """
+        self.name = name
+        self.primary = name == primary_name
+        if self.primary:
+            api_client = ApiClient()
+        else:
+            configuration = client.Configuration()
+            config.load_kube_config(
+                config_file=kubeconfig,
+                context=context,
+                client_configuration=configuration,
+            )
+            api_client = ApiClient(configuration)
+        self.core = client.CoreV1Api(api_client)
+        self.networking = client.NetworkingV1Api(api_client)
+        self.custom = client.CustomObjectsApi(api_client)
+        self.namespace = namespace or app.config.get("NAMESPACE")
+        self.domain_name = domain_name or app.config.get("DOMAIN_NAME")
+        self.timeout = timeout or default_timeout
+        self.storage_class = (
+            primary_storage_class if self.primary else storage_class
+        ) or None
+        self.executor = ThreadPoolExecutor(max_workers=4)
+
+    def node_name(self, name):
+        """Returns the name of a node of this backend, which is unique across backends."""
+        return name if self.primary else "%s/%s" % (self.name, name)
+
+
+def get_backends():
+    """Returns a list of the backends, the primary backend first. The backends are created on the first call."""
+    with lock:
+        if not registry:
+            registry[primary_name] = Backend(primary_name)
+            for name, settings in app.config.get("BACKENDS", {}).items():
+                registry[name] = Backend(name, **settings)
+                logger.info("Added notebook backend %s" % name)
+        return list(registry.values())
+
+
+def get(name=None):
+    """Returns a backend by name, or the primary backend when name is None."""
+    get_backends()
+    return registry[name or primary_name]
+
+
+def current():
+    """Returns the current backend of the calling thread."""
+    return getattr(local, "backend", None) or get()
+
+
+@contextmanager
+def use(backend):
+    """
+    Sets the current backend of the calling thread inside a with block.
+
+    backend: (Backend or string) A backend or the name of a backend. None selects the primary backend.
+    """
+    if not isinstance(backend, Backend):
+        backend = get(backend)
+    previous = getattr(local, "backend", None)
+    local.backend = backend
+    try:
+        yield backend
+    finally:
+        local.backend = previous
+
+
+def fan_out(fn, *args, **kwargs):
+    """
+    Calls a function on every backend concurrently. Returns a dict with the result of each backend
+    that answered before its timeout. Backends that fail or time out are logged and left out.
+    """
+    targets = get_backends()
+    if len(targets) == 1:
+        with use(targets[0]):
+            return {targets[0].name: fn(*args, **kwargs)}
+
+    deadline = deadlines.current()
+
+    def call(backend):
+        with use(backend), deadlines.use(deadline):
+            return fn(*args, **kwargs)
+
+    futures = {
+        backend.name: backend.executor.submit(call, backend) for backend in targets
+    }
+    start = time.time()
+    results = {}
+    for backend in targets:
+        try:
+            results[backend.name] = futures[backend.name].result(
+                timeout=max(start + backend.timeout - time.time(), 0)
+            )
+        except concurrent.futures.TimeoutError:
+            logger.error(
+                "Backend %s did not answer %s in time" % (backend.name, fn.__name__)
+            )
+        except Exception as err:
+            logger.error(
+                "Backend %s failed to answer %s: %s"
+                % (backend.name, fn.__name__, str(err))
+            )
+    return results
+
+
+def has_notebook(name):
+    """Returns a boolean indicating whether the current backend has a notebook (running or stopped) with this name."""
+    backend = current()
+    try:
+        backend.core.read_namespaced_secret(name.lower(), backend.namespace)
+        return True
+    except ApiException as e:
+        if e.status != 404:
+            raise
+    try:
+        backend.core.read_namespaced_pod(name.lower(), backend.namespace)
+        return True
+    except ApiException as e:
+        if e.status != 404:
+            raise
+    return False
+
+
+def locate(name):
+    """Returns the backend that a notebook was deployed on, or the primary backend when the notebook is not found."""
+    found = fan_out(has_notebook, name)
+    for backend in get_backends():
+        if found.get(backend.name):
+            return backend
+    return get()
+
+
+def of_node(node):
+    """Returns the backend of a GPU node, by the node's name (see Backend.node_name)."""
+    if node and "/" in node:
+        return get(node.split("/", 1)[0])
+    return get()
+
+
+def routed(fn):
+    """
+    Runs a function that takes a notebook name (as its first argument, or as the name keyword argument)
+    on the notebook's backend. When the calling thread already has a current backend, or no name is given,
+    the function runs on the current backend.
+    """
+
+    @wraps(fn)
+    def inner(*args, **kwargs):
+        name = args[0] if args else kwargs.get("name")
+        if (
+            name is None
+            or getattr(local, "backend", None) is not None
+            or len(get_backends()) == 1
+        ):
+            return fn(*args, **kwargs)
+        with use(locate(name)):
+            return fn(*args, **kwargs)
+
+    return inner
@@ -0,0 +1,134 @@
+"""
+A circuit breaker, which stops calling a service that keeps failing or timing out, and probes it until it recovers.
+
+The breaker keeps the outcomes of the last calls in a rolling window. A call fails when it raises a transport error,
+when the service answers with a server error, or when it is slow. Once the window holds at least min_calls calls,
+and the share of failed calls reaches failure_rate, the breaker opens:
+
+closed: calls go through, and their outcomes are recorded
+open: calls are refused right away (allow raises CircuitOpenError), for open_seconds
+half-open: after open_seconds, one call at a time is let through as a probe. A successful probe closes the breaker,
+and a failed probe opens it again for another open_seconds.
+
+Functionality:
+===============
+
+1. The CircuitBreaker class tracks the outcomes of the calls to a service
+2. The allow method raises CircuitOpenError when a call should not be sent
+3. The record method records the outcome of a call, and the release method lets go of a call without an outcome
+4. The stats method returns the state of the breaker and the counts of its window
+
+Example usage:
+===============
+
+cd <path>/<to>/af-portal
+python
+>>> from portal.breaker import CircuitBreaker
+>>> breaker = CircuitBreaker('myservice', window=20, min_calls=5, failure_rate=0.5, open_seconds=30)
+>>> breaker.allow()
+>>> breaker.record(ok=False)
+>>> breaker.stats()
+"""
+
+import collections
+import math
+import threading
+import time
+from portal.app import logger
+from portal.errors import CircuitOpenError
+
+
+class CircuitBreaker:
+    def __init__(self, name, window=20, min_calls=5, failure_rate=0.5, open_seconds=30):
+        """
+        name: (string) The name of the service, for the logs
+        window: (int) The number of recent calls whose outcomes are kept
+        min_calls: (int) The min number of calls in the window before the breaker can open
+        failure_rate: (float) The share of failed calls (between 0 and 1) that opens the breaker
+        open_seconds: (int) How long (in seconds) the breaker stays open before it lets a probe through
+        """
+        self.name = name
+        self.min_calls = min_calls
+        self.failure_rate = failure_rate
+        self.open_seconds = open_seconds
+        self.outcomes = collections.deque(maxlen=window)
+        self.state = "closed"
+        self.opened_at = None
+        self.probing = False
+        self.rejected = 0
+        self.lock = threading.Lock()
+
+    def allow(self):
+        """
+        Raises CircuitOpenError when the breaker is open, or when it is half-open and a probe is already in flight.
+        Otherwise the call may be sent, and its outcome must be recorded with the record method.
+        """
+        with self.lock:
+            if self.state == "open":
+                if time.time() - self.opened_at < self.open_seconds:
+                    self.rejected += 1
+                    raise CircuitOpenError(self.name, self.retry_after())
+                self.state = "half-open"
+                logger.info("Circuit breaker for %s is half-open" % self.name)
+            if self.state == "half-open":
+                if self.probing:
+                    self.rejected += 1
+                    raise CircuitOpenError(self.name, self.retry_after())
+                self.probing = True
+
+    def record(self, ok, slow=False):
+        """
+        Records the outcome of a call that the allow method let through.
+
+        ok: (boolean) False when the call raised a transport error or got a server error
+        slow: (boolean) True when the call took longer than the caller's latency threshold, which counts as a failure
+        """
+        failed = not ok or slow
+        with self.lock:
+            if self.state == "half-open" and self.probing:
+                self.probing = False
+                if failed:
+                    self.trip()
+                else:
+                    self.state = "closed"
+                    self.outcomes.clear()
+                    logger.info("Circuit breaker for %s is closed" % self.name)
+                return
+            self.outcomes.append((ok, slow))
+            if self.state == "closed" and len(self.outcomes) >= self.min_calls:
+                failures = sum(1 for ok, slow in self.outcomes if not ok or slow)
+                if failures >= self.failure_rate * len(self.outcomes):
+                    self.trip()
+
+    def release(self):
+        """Releases a call that the allow method let through, without recording an outcome (e.g. the caller gave up)."""
+        with self.lock:
+            if self.state == "half-open":
+                self.probing = False
+
+    def trip(self):
+        self.state = "open"
+        self.opened_at = time.time()
+        logger.error(
+            "Circuit breaker for %s is open for %d seconds"
+            % (self.name, self.open_seconds)
+        )
+
+    def retry_after(self):
+        """Returns the number of seconds until the breaker lets a probe through."""
+        if self.opened_at is None:
+            return 0
+        return max(0, math.ceil(self.opened_at + self.open_seconds - time.time()))
+
+    def stats(self):
+        """Returns a dict with the state of the breaker, and the counts of the calls in its window."""
+        with self.lock:
+            return dict(
+                name=self.name,
+                state=self.state,
+                calls=len(self.outcomes),
+                errors=sum(1 for ok, slow in self.outcomes if not ok),
+                slow=sum(1 for ok, slow in self.outcomes if ok and slow),
+                rejected=self.rejected,
+                retry_after=self.retry_after() if self.state != "closed" else 0,
+            )
@@ -0,0 +1,109 @@
+"""
+A fit engine that models the free GPUs, CPU cores and memory on each Kubernetes node.
+
+The Kubernetes scheduler places a pod on a single node, so a request only fits when one node has enough
+free GPUs, CPU cores and memory at the same time. Maxima that are computed for a GPU product as a whole
+may come from different nodes, and a request that passes a product-wide check may never be scheduled.
+
+A node is modeled as a dict, as returned by jupyterlab.get_gpu_nodes:
+
+    {
+        'name': 'gpu-node-1',
+        'product': 'NVIDIA-A100-SXM4-40GB',
+        'gpu_total': 4,    # GPU instances that can be allocated on the node
+        'gpu_free': 2,     # GPU instances that are not requested by any pod
+        'cpu_free': 30,    # CPU cores that are not requested by any pod
+        'mem_free': 200,   # Memory (GB) that is not requested by any pod
+        ...
+    }
+
+Functionality:
+===============
+
+1. The fit function returns the names of the nodes that can host a request, best fit first
+2. The largest_fit function returns the largest request that fits on any node, for each GPU count
+3. The could_fit function returns True when a request would fit on an empty node
+
+Example usage:
+===============
+
+cd <path>/<to>/af-portal
+python
+>>> from portal import capacity, jupyterlab
+>>> nodes = jupyterlab.get_gpu_nodes(product='NVIDIA-A100-SXM4-40GB')
+>>> capacity.fit(nodes, gpu_request=2, cpu_request=8, memory_request=64)
+>>> capacity.largest_fit(nodes)
+"""
+
+
+def fits(node, gpu_request, cpu_request, memory_request):
+    """Returns True when a single node has enough free resources to host the request."""
+    return (
+        node["gpu_free"] >= gpu_request
+        and node["cpu_free"] >= cpu_request
+        and node["mem_free"] >= memory_request
+    )
+
+
+def fit(nodes, gpu_request, cpu_request, memory_request, product=None):
+    """
+    Returns the names of the nodes that can host a request, sorted so that the best fit comes first.
+
+    The best fit is the node that has the fewest GPUs left over after hosting the request (ties are broken by
+    the CPU cores left over), which keeps whole nodes free for larger multi-GPU requests.
+
+    Function parameters:
+
+    nodes: (list) The nodes to consider, as returned by jupyterlab.get_gpu_nodes
+    gpu_request: (integer) The number of GPU instances requested
+    cpu_request: (integer) The number of CPU cores requested
+    memory_request: (integer) The amount of memory requested in GB
+    product: (string) When a product is given, only nodes with this GPU product are considered (optional)
+    """
+    candidates = [
+        node
+        for node in nodes
+        if (product is None or node["product"] == product)
+        and fits(node, gpu_request, cpu_request, memory_request)
+    ]
+    candidates.sort(
+        key=lambda node: (
+            node["gpu_free"] - gpu_request,
+            node["cpu_free"] - cpu_request,
+        )
+    )
+    return [node["name"] for node in candidates]
+
+
+def largest_fit(nodes):
+    """
+    Returns the largest request that fits on any node, for each number of GPU instances.
+    Returns a list of dicts sorted by the number of GPU instances, e.g.
+
+        [{'gpu': 1, 'cpu': 30, 'memory': 200}, {'gpu': 2, 'cpu': 12, 'memory': 96}]
+
+    The CPU and memory figures for a GPU count are each the largest on any node with that many free GPUs.
+    They may come from different nodes, so a request for both maxima at once should still be checked with fit.
+    """
+    largest = []
+    max_gpus = max((node["gpu_free"] for node in nodes), default=0)
+    for gpu in range(1, max_gpus + 1):
+        hosts = [node for node in nodes if node["gpu_free"] >= gpu]
+        largest.append(
+            dict(
+                gpu=gpu,
+                cpu=max(node["cpu_free"] for node in hosts),
+                memory=max(node["mem_free"] for node in hosts),
+            )
+        )
+    return largest
+
+
+def could_fit(nodes, gpu_request, cpu_request, memory_request):
+    """Returns True when at least one node could host the request once the node has no other pods."""
+    return any(
+        node["gpu_total"] >= gpu_request
+        and node["cpu_total"] >= cpu_request
+        and node["mem_total"] >= memory_request
+        for node in nodes
+    )
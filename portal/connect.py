@@ -3,7 +3,7 @@ A wrapper for the CI Connect API.
 
 Functionality:
 ===============
-1. get_username looks up a username for a Globus ID
+1. get_username looks up a username for a Globus ID, and find_user looks up the username and the profile together
 2. get_usernames gets the usernames for a group
 3. get_user_profile looks up a user profile
 4. get_user_profiles gets the profiles of all users in a group
@@ -18,12 +18,36 @@ Functionality:
 13. remove_group removes a group
 14. get_subgroups gets the subgroups of a group
 15. create_subgroup creates a subgroup with the given settings
+16. invalidate_group drops a group from the group cache
+17. update_user_roles and remove_users_from_group change the memberships of many users at once (see multiplex)
+18. update_user_profiles updates the profiles of many users at once
+19. get_staleness tells whether the current request was served last known good results (see last_known_good)
+
+Group metadata (display name, description, purpose, creation date...) rarely changes, so it is kept in a process-wide
+cache keyed by group name, along with the subgroup listing of each group, for GROUP_CACHE_TTL seconds.
+update_group_info, create_subgroup and remove_group invalidate the entries they change.
+
+Every call to the Connect API goes through call_api, which sets a timeout and a circuit breaker (see breaker.py).
+When the API fails or slows down, the breaker opens, and calls fail right away with ConnectUnavailableError
+instead of tying up a worker thread. While the API is unavailable, the read functions (get_user_profile,
+get_user_profiles, get_user_groups, get_group_info...) return their last known good result, and the request
+is flagged as stale (see get_staleness); the write functions raise ConnectUnavailableError.
+
+Concurrent calls to get_usernames and get_user_profiles with the same arguments share one call (see singleflight.py).
 
 Dependencies:
 ===============
 
 A portal.conf file properly filled out, with the URL of the Connect API and a token for the Connect API.
 The portal.conf file should be saved in the directory af-portal/portal/secrets.
+The optional setting GROUP_CACHE_TTL sets how long (in seconds) group metadata is cached. The default is 3600.
+The optional setting MULTIPLEX_BATCH_SIZE sets the max number of calls in a multiplexed request. The default is 50.
+The optional setting MULTIPLEX_WORKERS sets the max number of multiplexed requests in flight at a time. The default is 4.
+The optional setting CONNECT_TIMEOUT sets how long (in seconds) a call waits for a response. The default is 10.
+The optional setting CONNECT_MULTIPLEX_TIMEOUT sets how long (in seconds) a multiplexed call waits for a response. The default is 60.
+The optional settings CONNECT_BREAKER_WINDOW, CONNECT_BREAKER_MIN_CALLS, CONNECT_BREAKER_FAILURE_RATE and
+CONNECT_BREAKER_OPEN_SECONDS configure the circuit breaker (see breaker.py). The defaults are 20, 5, 0.5 and 30.
+The optional setting CONNECT_STALE_CACHE_SIZE sets the max number of last known good results. The default is 1000.
 
 Example usage:
 ===============
@@ -74,21 +98,184 @@ python
 >>> pprint(info)
 """
 
-from portal import decorators
+from flask import g, has_request_context
+from functools import wraps
+from portal import codec, deadlines, decorators, singleflight
 from portal.app import app, logger
-from portal.errors import ConnectApiError
-from dateutil.parser import parse
+from portal.breaker import CircuitBreaker
+from portal.errors import (
+    CircuitOpenError,
+    ConnectApiError,
+    ConnectUnavailableError,
+    DeadlineExceeded,
+    InvalidParameter,
+    MissingParameter,
+)
+from portal.records import Group, Profile, detach
+import collections
 import requests
 import json
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
 
 url = app.config.get("CONNECT_API_ENDPOINT")
 token = app.config.get("CONNECT_API_TOKEN")
+group_cache_ttl = app.config.get("GROUP_CACHE_TTL", 3600)
+multiplex_batch_size = app.config.get("MULTIPLEX_BATCH_SIZE", 50)
+multiplex_workers = app.config.get("MULTIPLEX_WORKERS", 4)
+timeout = app.config.get("CONNECT_TIMEOUT", 10)
+multiplex_timeout = app.config.get("CONNECT_MULTIPLEX_TIMEOUT", 60)
+stale_cache_size = app.config.get("CONNECT_STALE_CACHE_SIZE", 1000)
+breaker = CircuitBreaker(
+    "the CI Connect API",
+    window=app.config.get("CONNECT_BREAKER_WINDOW", 20),
+    min_calls=app.config.get("CONNECT_BREAKER_MIN_CALLS", 5),
+    failure_rate=app.config.get("CONNECT_BREAKER_FAILURE_RATE", 0.5),
+    open_seconds=app.config.get("CONNECT_BREAKER_OPEN_SECONDS", 30),
+)
+profile_keys = (
+    "name",
+    "institution",
+    "email",
+    "phone",
+    "public_key",
+    "create_totp_secret",
+)
+
+# Maps each group name to a tuple (time fetched, the group's metadata from the Connect API)
+group_cache = {}
+# Maps each group name to a tuple (time fetched, the group's subgroups from the Connect API)
+subgroup_cache = {}
+group_cache_lock = threading.Lock()
+# The fields that a user record must have to be read as a full profile (see records.Profile.from_metadata)
+profile_fields = (
+    "unix_name",
+    "unix_id",
+    "name",
+    "email",
+    "institution",
+    "phone",
+    "join_date",
+    "public_key",
+    "group_memberships",
+)
+# The last result of each read call, by function and arguments: a tuple (timestamp, result)
+last_good = collections.OrderedDict()
+last_good_lock = threading.Lock()
+
+
+def call_api(method, path, timeout=timeout, **kwargs):
+    """
+    Sends a request to the Connect API through the circuit breaker, and returns the response.
+    Raises ConnectUnavailableError right away when the breaker is open, and when the request fails or times out.
+    A call that fails, gets a server error, or takes more than half its timeout counts against the breaker.
+    The timeout is cut short by the deadline of the request (see deadlines.py), and a call that runs out of
+    the request's time raises DeadlineExceeded without counting against the breaker.
+
+    Function parameters:
+
+    method: (string) The HTTP method, e.g. "get"
+    path: (string) The path of the endpoint, e.g. "/v1alpha1/users/myusername"
+    timeout: (int) How long (in seconds) to wait for the response
+    kwargs: The other arguments of requests.request (params, json...)
+    """
+    call_timeout = deadlines.timeout(timeout, "connect")
+    try:
+        breaker.allow()
+    except CircuitOpenError as err:
+        raise ConnectUnavailableError(
+            "please try again in %d seconds" % err.retry_after
+        ) from err
+    start = time.time()
+    try:
+        response = requests.request(method, url + path, timeout=call_timeout, **kwargs)
+    except requests.Timeout as err:
+        if call_timeout < timeout:
+            breaker.release()
+            raise DeadlineExceeded(deadlines.current().seconds) from err
+        breaker.record(ok=False)
+        logger.error("Connect API call %s %s failed: %s" % (method.upper(), path, err))
+        raise ConnectUnavailableError(str(err)) from err
+    except requests.RequestException as err:
+        breaker.record(ok=False)
+        logger.error("Connect API call %s %s failed: %s" % (method.upper(), path, err))
+        raise ConnectUnavailableError(str(err)) from err
+    breaker.record(
+        ok=response.status_code < 500, slow=time.time() - start > timeout / 2
+    )
+    return response
+
+
+def last_known_good(*ignored_options):
+    """
+    Keeps the last result of a read call, for each set of arguments, in a bounded cache (CONNECT_STALE_CACHE_SIZE entries).
+    When the Connect API is unavailable (see call_api), the call returns its last result instead of raising,
+    and the request is flagged as stale (see get_staleness). The options named in ignored_options are not part of the key.
+    The cache keeps its own copy of each result, and hands out copies (see records.detach), so that a caller that changes
+    its result does not change the results of later calls.
+    """
+
+    def decorator(fn):
+        @wraps(fn)
+        def inner(*args, **options):
+            key = (
+                fn.__name__,
+                args,
+                tuple(
+                    sorted(
+                        (name, value)
+                        for name, value in options.items()
+                        if name not in ignored_options
+                    )
+                ),
+            )
+            try:
+                hash(key)
+            except TypeError:
+                return fn(*args, **options)
+            try:
+                result = fn(*args, **options)
+            except ConnectUnavailableError as err:
+                with last_good_lock:
+                    entry = last_good.get(key)
+                if entry is None:
+                    raise
+                age = time.time() - entry[0]
+                logger.error(
+                    "Serving the result of %s%r from %d seconds ago: %s"
+                    % (fn.__name__, args, age, str(err))
+                )
+                if has_request_context():
+                    g.connect_stale = max(g.get("connect_stale", 0), age)
+                return detach(entry[1])
+            with last_good_lock:
+                last_good[key] = (time.time(), detach(result))
+                last_good.move_to_end(key)
+                while len(last_good) > stale_cache_size:
+                    last_good.popitem(last=False)
+            return result
+
+        return inner
+
+    return decorator
+
+
+def get_staleness():
+    """
+    Returns the age (in seconds) of the oldest result that the current request got from the last-known-good cache
+    while the Connect API was unavailable, or None when every result was fresh.
+    """
+    if has_request_context():
+        return g.get("connect_stale")
+    return None
 
 
+@last_known_good()
 def get_username(globus_id):
     """Looks up the username for a globus ID."""
-    response = requests.get(
-        url + "/v1alpha1/find_user", params={"token": token, "globus_id": globus_id}
+    response = call_api(
+        "get", "/v1alpha1/find_user", params={"token": token, "globus_id": globus_id}
     )
     if response.text:
         data = response.json()
@@ -99,10 +286,37 @@ def get_username(globus_id):
     return None
 
 
+@singleflight.coalesce
+@last_known_good()
+def find_user(globus_id, **options):
+    """
+    Looks up the user with a Globus ID. Returns a tuple (username, profile), or (None, None) when there is no such user.
+    The profile is a Profile record (see records.py). When the user record returned by find_user is complete,
+    it is used as the profile, and the login takes a single call; otherwise the profile is looked up by username.
+    """
+    response = call_api(
+        "get", "/v1alpha1/find_user", params={"token": token, "globus_id": globus_id}
+    )
+    if response.text:
+        data = response.json()
+        if data.get("kind") == "Error":
+            logger.error(data["message"])
+        if data.get("kind") == "User":
+            metadata = data["metadata"]
+            username = metadata["unix_name"]
+            if all(key in metadata for key in profile_fields):
+                return username, Profile.from_metadata(
+                    metadata, options.get("date_format", "calendar")
+                )
+            return username, get_user_profile(username, **options)
+    return None, None
+
+
+@last_known_good()
 def get_usernames(group_name, **options):
     """Returns a list of usernames for users in the specified group."""
-    response = requests.get(
-        url + "/v1alpha1/groups/" + group_name + "/members", params={"token": token}
+    response = call_api(
+        "get", "/v1alpha1/groups/" + group_name + "/members", params={"token": token}
     )
     if response.text:
         data = response.json()
@@ -118,97 +332,49 @@ def get_usernames(group_name, **options):
     return []
 
 
+@last_known_good()
 def get_user_profile(username, **options):
-    """Gets a user profile and returns it as a dictionary."""
-    response = requests.get(
-        url + "/v1alpha1/users/" + username, params={"token": token}
-    )
+    """Gets a user profile and returns it as a Profile record (see records.py), which can be read like a dictionary."""
+    response = call_api("get", "/v1alpha1/users/" + username, params={"token": token})
     if response.text:
         data = response.json()
         if data.get("kind") == "Error":
             logger.error(data["message"])
             raise ConnectApiError(data["message"])
         if data.get("kind") == "User":
-            profile = {}
-            metadata = data["metadata"]
-            profile["unix_name"] = metadata["unix_name"]
-            profile["unix_id"] = metadata["unix_id"]
-            profile["name"] = metadata["name"]
-            profile["email"] = metadata["email"]
-            profile["institution"] = metadata["institution"]
-            profile["phone"] = metadata["phone"]
-            profile["public_key"] = metadata["public_key"]
-            if "totp_secret" in metadata.keys():
-                profile["totp_secret"] = metadata["totp_secret"]
-            date_format = options.get("date_format", "calendar")
-            if date_format == "object":
-                profile["join_date"] = parse(metadata["join_date"])
-            elif date_format == "iso":
-                profile["join_date"] = parse(metadata["join_date"]).isoformat()
-            elif date_format == "calendar":
-                profile["join_date"] = parse(metadata["join_date"]).strftime("%B %m %Y")
-            else:
-                profile["join_date"] = parse(metadata["join_date"]).strftime(
-                    date_format
-                )
-            profile["group_memberships"] = metadata["group_memberships"]
-            profile["group_memberships"].sort(key=lambda group: group["name"])
-            membership = list(
-                filter(
-                    lambda group: group["name"] == "root.atlas-af",
-                    metadata["group_memberships"],
-                )
+            return Profile.from_metadata(
+                data["metadata"], options.get("date_format", "calendar")
             )
-            profile["role"] = membership[0]["state"] if membership else "nonmember"
-            return profile
     return None
 
 
+@singleflight.coalesce
+@last_known_good()
 def get_user_profiles(group_name, **options):
-    """Gets the profiles of users in a group and returns them as a list of dictionaries."""
+    """Gets the profiles of users in a group and returns them as a list of Profile records (see records.py)."""
     usernames = get_usernames(group_name, **options)
     request_data = {}
     for username in usernames:
         request_data["/v1alpha1/users/" + username + "?token=" + token] = {
             "method": "GET"
         }
-    response = requests.post(
-        url + "/v1alpha1/multiplex", params={"token": token}, json=request_data
+    response = call_api(
+        "post",
+        "/v1alpha1/multiplex",
+        params={"token": token},
+        json=request_data,
+        timeout=multiplex_timeout,
     )
-    if response.text:
-        data = response.json()
+    if response.content:
+        data = codec.loads(response.content)
         if data.get("kind") == "Error":
             logger.error(data["message"])
             raise ConnectApiError(data["message"])
+        date_format = options.get("date_format", "calendar")
         profiles = []
         for value in data.values():
-            profile = {}
-            metadata = json.loads(value["body"])["metadata"]
-            profile["unix_name"] = metadata["unix_name"]
-            profile["unix_id"] = metadata["unix_id"]
-            profile["name"] = metadata["name"]
-            profile["email"] = metadata["email"]
-            profile["institution"] = metadata["institution"]
-            profile["phone"] = metadata["phone"]
-            date_format = options.get("date_format", "calendar")
-            if date_format == "object":
-                profile["join_date"] = parse(metadata["join_date"])
-            elif date_format == "iso":
-                profile["join_date"] = parse(metadata["join_date"]).isoformat()
-            elif date_format == "calendar":
-                profile["join_date"] = parse(metadata["join_date"]).strftime("%B %m %Y")
-            else:
-                profile["join_date"] = parse(metadata["join_date"]).strftime(
-                    date_format
-                )
-            membership = list(
-                filter(
-                    lambda group: group["name"] == "root.atlas-af",
-                    metadata["group_memberships"],
-                )
-            )
-            profile["role"] = membership[0]["state"] if membership else "nonmember"
-            profiles.append(profile)
+            metadata = codec.loads(value["body"])["metadata"]
+            profiles.append(Profile.from_metadata(metadata, date_format, full=False))
         return profiles
     return []
 
@@ -233,8 +399,8 @@ def create_user_profile(**settings):
             "create_totp_secret": True,
         },
     }
-    response = requests.post(
-        url + "/v1alpha1/users", params={"token": token}, json=request_data
+    response = call_api(
+        "post", "/v1alpha1/users", params={"token": token}, json=request_data
     )
     if response.text:
         data = response.json()
@@ -244,14 +410,12 @@ def create_user_profile(**settings):
     logger.info("Created profile for user %s" % settings["unix_name"])
 
 
-@decorators.permit_keys(
-    "name", "institution", "email", "phone", "public_key", "create_totp_secret"
-)
+@decorators.permit_keys(*profile_keys)
 def update_user_profile(username, **settings):
     """Updates a user profile with the given settings."""
     request_data = {"apiVersion": "v1alpha1", "kind": "User", "metadata": settings}
-    response = requests.put(
-        url + "/v1alpha1/users/" + username, params={"token": token}, json=request_data
+    response = call_api(
+        "put", "/v1alpha1/users/" + username, params={"token": token}, json=request_data
     )
     if response.text:
         data = response.json()
@@ -261,64 +425,147 @@ def update_user_profile(username, **settings):
     logger.info("Updated profile for user %s." % username)
 
 
+def update_user_profiles(rows):
+    """
+    Updates the profiles of many users, with multiplexed requests. The rows of the same user are merged into one update.
+    Returns a list with the result of each row: None when the row was applied, or else an error message.
+
+    Function parameters:
+
+    rows: (list) A list of dicts, each with a username and the settings to update (see update_user_profile)
+    """
+    results = [None] * len(rows)
+    updates = {}
+    row_users = {}
+    for i, row in enumerate(rows):
+        settings = dict(row)
+        username = settings.pop("username", None)
+        if not username:
+            results[i] = str(MissingParameter("username"))
+            continue
+        if not settings:
+            results[i] = str(InvalidParameter("no settings"))
+            continue
+        # The same check as update_user_profile
+        try:
+            decorators.check_keys(settings, profile_keys)
+        except InvalidParameter as err:
+            results[i] = str(err)
+            continue
+        updates.setdefault(username, {}).update(settings)
+        row_users[i] = username
+    paths = {"/v1alpha1/users/" + username: username for username in updates}
+    responses = multiplex(
+        {
+            path: (
+                "PUT",
+                {"apiVersion": "v1alpha1", "kind": "User", "metadata": updates[user]},
+            )
+            for path, user in paths.items()
+        }
+    )
+    errors = {
+        paths[path]: error for path, error in get_multiplex_errors(responses).items()
+    }
+    for i, username in row_users.items():
+        results[i] = errors.get(username)
+    logger.info(
+        "Updated profiles for %d users" % len([u for u in updates if u not in errors])
+    )
+    return results
+
+
+@last_known_good("roles")
 def get_user_groups(username, **options):
-    """Gets all of a user's groups and returns them as a list of dictionaries."""
-    roles = get_user_roles(username)
+    """
+    Gets all of a user's groups and returns them as a list of dictionaries.
+    The groups are filtered by the pattern option (a prefix of the group names) before they are looked up,
+    and only the groups that are not in the group cache are fetched, with a single multiplexed request.
+    The roles option takes the user's roles (see get_user_roles), when the caller already has them.
+    """
+    roles = options.get("roles") or get_user_roles(username)
+    if roles is None:
+        return None
+    pattern = options.get("pattern", None)
+    date_format = options.get("date_format", "calendar")
+    group_names = [
+        group_name
+        for group_name in roles
+        if not pattern or group_name.startswith(pattern)
+    ]
+    groups = []
+    for metadata in get_groups_metadata(group_names).values():
+        group = format_group(metadata, date_format)
+        groups.append(group.replace(role=roles.get(group["name"])))
+    groups.sort(key=lambda group: group["name"])
+    return groups
+
+
+def get_groups_metadata(group_names):
+    """
+    Returns a dict with the metadata of each of the groups that exists, by group name.
+    Groups that are not in the group cache are fetched with a single multiplexed request, and cached.
+    """
+    now = time.time()
+    found = {}
+    with group_cache_lock:
+        for group_name in group_names:
+            entry = group_cache.get(group_name)
+            if entry and now - entry[0] < group_cache_ttl:
+                found[group_name] = entry[1]
+    missing = [group_name for group_name in group_names if group_name not in found]
+    if not missing:
+        return found
     request_data = {}
-    for group_name in roles:
+    for group_name in missing:
         request_data["/v1alpha1/groups/" + group_name + "?token=" + token] = {
             "method": "GET"
         }
-    response = requests.post(
-        url + "/v1alpha1/multiplex", params={"token": token}, json=request_data
+    response = call_api(
+        "post",
+        "/v1alpha1/multiplex",
+        params={"token": token},
+        json=request_data,
+        timeout=multiplex_timeout,
     )
-    if response.text:
-        data = response.json()
+    if response.content:
+        data = codec.loads(response.content)
         if data.get("kind") == "Error":
             logger.error(data["message"])
             raise ConnectApiError(data["message"])
-        pattern = options.get("pattern", None)
-        date_format = options.get("date_format", "calendar")
-        groups = []
         for value in data.values():
             if value["status"] == requests.codes.ok:
-                group = {}
-                metadata = json.loads(value["body"])["metadata"]
-                group["name"] = metadata["name"]
-                if pattern and not group["name"].startswith(pattern):
-                    continue
-                group["display_name"] = metadata["display_name"]
-                group["description"] = metadata["description"]
-                group["email"] = metadata["email"]
-                group["phone"] = metadata["phone"]
-                group["purpose"] = metadata["purpose"]
-                group["unix_id"] = metadata["unix_id"]
-                group["pending"] = metadata["pending"]
-                if date_format == "object":
-                    group["creation_date"] = parse(metadata["creation_date"])
-                elif date_format == "iso":
-                    group["creation_date"] = parse(
-                        metadata["creation_date"]
-                    ).isoformat()
-                elif date_format == "calendar":
-                    group["creation_date"] = parse(metadata["creation_date"]).strftime(
-                        "%B %m %Y"
-                    )
-                else:
-                    group["creation_date"] = parse(metadata["creation_date"]).strftime(
-                        date_format
-                    )
-                group["role"] = roles.get(group["name"])
-                groups.append(group)
-        groups.sort(key=lambda group: group["name"])
-        return groups
-    return None
+                metadata = codec.loads(value["body"])["metadata"]
+                cache_group(metadata, now)
+                found[metadata["name"]] = metadata
+    return found
+
+
+def format_group(metadata, date_format="calendar"):
+    """Returns a group's info as a Group record (see records.py), from the group's metadata in the Connect API."""
+    return Group.from_metadata(metadata, date_format)
+
+
+def cache_group(metadata, now=None):
+    """Adds a group's metadata to the group cache."""
+    with group_cache_lock:
+        group_cache[metadata["name"]] = (now or time.time(), metadata)
+
+
+def invalidate_group(group_name):
+    """Drops a group, its subgroup listing and its parent's subgroup listing from the group cache."""
+    parent = group_name.rsplit(".", 1)[0] if "." in group_name else None
+    with group_cache_lock:
+        group_cache.pop(group_name, None)
+        subgroup_cache.pop(group_name, None)
+        subgroup_cache.pop(parent, None)
 
 
 def remove_user_from_group(username, group_name):
     """Removes a user from a group."""
-    response = requests.delete(
-        url + "/v1alpha1/groups/" + group_name + "/members/" + username,
+    response = call_api(
+        "delete",
+        "/v1alpha1/groups/" + group_name + "/members/" + username,
         params={"token": token},
     )
     if response.text:
@@ -333,18 +580,16 @@ def get_user_roles(username):
     """Gets all of a user's roles and returns them as a dictionary."""
     profile = get_user_profile(username)
     if profile:
-        return {
-            group_membership["name"]: group_membership["state"]
-            for group_membership in profile["group_memberships"]
-        }
+        return dict(profile.roles)
     return None
 
 
 def update_user_role(username, group_name, role):
     """Updates a user's role in a group."""
     request_data = {"apiVersion": "v1alpha1", "group_membership": {"state": role}}
-    response = requests.put(
-        url + "/v1alpha1/groups/" + group_name + "/members/" + username,
+    response = call_api(
+        "put",
+        "/v1alpha1/groups/" + group_name + "/members/" + username,
         params={"token": token},
         json=request_data,
     )
@@ -356,50 +601,153 @@ def update_user_role(username, group_name, role):
     logger.info("Set role to %s for user %s in group %s" % (role, username, group_name))
 
 
-def get_group_info(group_name, **options):
-    """Looks up a group and returns its info as a dictionary."""
-    response = requests.get(
-        url + "/v1alpha1/groups/" + group_name, params={"token": token}
+def multiplex(calls):
+    """
+    Sends many Connect API calls with the multiplex endpoint, in batches of up to MULTIPLEX_BATCH_SIZE calls,
+    with up to MULTIPLEX_WORKERS batches in flight at a time.
+    Returns a dict that maps each path to a tuple (status code, response body as a dictionary or None).
+    The calls of a batch that fails as a whole get the status None and the error message in their body.
+
+    Function parameters:
+
+    calls: (dict) Maps each path (e.g. "/v1alpha1/users/myusername") to a tuple (method, request body as a dictionary or None)
+    """
+    paths = list(calls)
+    batches = [
+        paths[i : i + multiplex_batch_size]
+        for i in range(0, len(paths), multiplex_batch_size)
+    ]
+    results = {}
+    if len(batches) <= 1:
+        for batch in batches:
+            results.update(send_multiplex_batch(calls, batch))
+        return results
+    deadline = deadlines.current()
+
+    def send(batch):
+        with deadlines.use(deadline):
+            return send_multiplex_batch(calls, batch)
+
+    with ThreadPoolExecutor(max_workers=min(multiplex_workers, len(batches))) as pool:
+        for batch_results in pool.map(send, batches):
+            results.update(batch_results)
+    return results
+
+
+def send_multiplex_batch(calls, batch):
+    request_data = {}
+    keys = {}
+    for path in batch:
+        method, body = calls[path]
+        key = path + "?token=" + token
+        keys[key] = path
+        request_data[key] = {"method": method}
+        if body is not None:
+            request_data[key]["body"] = json.dumps(body)
+    try:
+        response = call_api(
+            "post",
+            "/v1alpha1/multiplex",
+            params={"token": token},
+            json=request_data,
+            timeout=multiplex_timeout,
+        )
+        data = codec.loads(response.content) if response.content else {}
+        if data.get("kind") == "Error":
+            raise ConnectApiError(data["message"])
+    except Exception as err:
+        logger.error("Multiplexed request failed: %s" % str(err))
+        return {path: (None, {"message": str(err)}) for path in batch}
+    results = {}
+    for key, path in keys.items():
+        value = data.get(key)
+        if value is None:
+            results[path] = (None, None)
+            continue
+        body = codec.loads(value["body"]) if value.get("body") else None
+        results[path] = (value["status"], body)
+    return results
+
+
+def get_multiplex_errors(results):
+    """Returns a dict with the error message of each failed call in the results of multiplex, by path."""
+    errors = {}
+    for path, (status, body) in results.items():
+        if status is None:
+            errors[path] = (body or {}).get(
+                "message", "No response from the Connect API"
+            )
+        elif status >= 400 or (body or {}).get("kind") == "Error":
+            errors[path] = (body or {}).get("message", "Error %s" % status)
+    return errors
+
+
+def update_user_roles(usernames, group_name, role):
+    """
+    Updates the role of many users in a group, with multiplexed requests.
+    Returns a dict with the result of each user: None when the role was updated, or else an error message.
+    """
+    request_data = {"apiVersion": "v1alpha1", "group_membership": {"state": role}}
+    paths = {
+        "/v1alpha1/groups/" + group_name + "/members/" + username: username
+        for username in usernames
+    }
+    results = multiplex({path: ("PUT", request_data) for path in paths})
+    errors = get_multiplex_errors(results)
+    logger.info(
+        "Set role to %s for %d users in group %s"
+        % (role, len(paths) - len(errors), group_name)
     )
-    data = response.json()
-    if data.get("kind") == "Error":
-        logger.error(data["message"])
-        raise ConnectApiError(data["message"])
-    if data.get("kind") == "Group":
-        group = {}
+    return {username: errors.get(path) for path, username in paths.items()}
+
+
+def remove_users_from_group(usernames, group_name):
+    """
+    Removes many users from a group, with multiplexed requests.
+    Returns a dict with the result of each user: None when the user was removed, or else an error message.
+    """
+    paths = {
+        "/v1alpha1/groups/" + group_name + "/members/" + username: username
+        for username in usernames
+    }
+    results = multiplex({path: ("DELETE", None) for path in paths})
+    errors = get_multiplex_errors(results)
+    logger.info(
+        "Removed %d users from group %s" % (len(paths) - len(errors), group_name)
+    )
+    return {username: errors.get(path) for path, username in paths.items()}
+
+
+@last_known_good()
+def get_group_info(group_name, **options):
+    """Looks up a group (in the group cache, or else in the Connect API) and returns its info as a dictionary."""
+    with group_cache_lock:
+        entry = group_cache.get(group_name)
+    if entry and time.time() - entry[0] < group_cache_ttl:
+        metadata = entry[1]
+    else:
+        response = call_api(
+            "get", "/v1alpha1/groups/" + group_name, params={"token": token}
+        )
+        data = response.json()
+        if data.get("kind") == "Error":
+            logger.error(data["message"])
+            raise ConnectApiError(data["message"])
+        if data.get("kind") != "Group":
+            return None
         metadata = data["metadata"]
-        group["name"] = metadata["name"]
-        group["display_name"] = metadata["display_name"]
-        group["description"] = metadata["description"]
-        group["email"] = metadata["email"]
-        group["phone"] = metadata["phone"]
-        group["purpose"] = metadata["purpose"]
-        group["unix_id"] = metadata["unix_id"]
-        group["pending"] = metadata["pending"]
-        date_format = options.get("date_format", "calendar")
-        if date_format == "object":
-            group["creation_date"] = parse(metadata["creation_date"])
-        elif date_format == "iso":
-            group["creation_date"] = parse(metadata["creation_date"]).isoformat()
-        elif date_format == "calendar":
-            group["creation_date"] = parse(metadata["creation_date"]).strftime(
-                "%B %m %Y"
-            )
-        else:
-            group["creation_date"] = parse(metadata["creation_date"]).strftime(
-                date_format
-            )
-        group["is_removable"] = is_group_removable(group_name)
-        return group
-    return None
+        cache_group(metadata)
+    group = format_group(metadata, options.get("date_format", "calendar"))
+    return group.replace(is_removable=is_group_removable(group_name))
 
 
 @decorators.permit_keys("display_name", "email", "phone", "description")
 def update_group_info(group_name, **settings):
     """Updates a group's info with the given settings."""
     request_data = {"apiVersion": "v1alpha1", "metadata": settings}
-    response = requests.put(
-        url + "/v1alpha1/groups/" + group_name,
+    response = call_api(
+        "put",
+        "/v1alpha1/groups/" + group_name,
         params={"token": token},
         json=request_data,
     )
@@ -408,6 +756,7 @@ def update_group_info(group_name, **settings):
         if data.get("kind") == "Error":
             logger.error(data["message"])
             raise ConnectApiError(data["message"])
+    invalidate_group(group_name)
     logger.info("Updated info for group %s" % group_name)
 
 
@@ -431,30 +780,41 @@ def is_group_removable(group_name):
 def remove_group(group_name):
     """If a group can be removed, removes the group."""
     if is_group_removable(group_name):
-        response = requests.delete(
-            url + "/v1alpha1/groups/" + group_name, params={"token": token}
+        response = call_api(
+            "delete", "/v1alpha1/groups/" + group_name, params={"token": token}
         )
         if response.text:
             data = response.json()
             if data.get("kind") == "Error":
                 logger.error(data["message"])
                 raise ConnectApiError(data["message"])
+        invalidate_group(group_name)
         logger.info("Removed group %s" % group_name)
         return True
     return False
 
 
+@last_known_good()
 def get_subgroups(group_name):
-    """Returns the subgroups of a group as a list of dictionaries."""
-    response = requests.get(
-        url + "/v1alpha1/groups/" + group_name + "/subgroups", params={"token": token}
+    """Returns the subgroups of a group as a list of dictionaries. The list is kept in the group cache."""
+    with group_cache_lock:
+        entry = subgroup_cache.get(group_name)
+    if entry and time.time() - entry[0] < group_cache_ttl:
+        return list(entry[1])
+    response = call_api(
+        "get", "/v1alpha1/groups/" + group_name + "/subgroups", params={"token": token}
     )
     if response.text:
         data = response.json()
         if data.get("kind") == "Error":
             logger.error(data["message"])
             raise ConnectApiError(data["message"])
-        return data.get("groups")
+        subgroups = data.get("groups")
+        if subgroups is not None:
+            with group_cache_lock:
+                subgroup_cache[group_name] = (time.time(), subgroups)
+            subgroups = list(subgroups)
+        return subgroups
     return None
 
 
@@ -464,12 +824,9 @@ def get_subgroups(group_name):
 def create_subgroup(group_name, **settings):
     """Creates a subgroup with the given settings."""
     request_data = {"apiVersion": "v1alpha1", "metadata": settings}
-    response = requests.put(
-        url
-        + "/v1alpha1/groups/"
-        + group_name
-        + "/subgroup_requests/"
-        + settings["name"],
+    response = call_api(
+        "put",
+        "/v1alpha1/groups/" + group_name + "/subgroup_requests/" + settings["name"],
         params={"token": token},
         json=request_data,
     )
@@ -478,4 +835,6 @@ def create_subgroup(group_name, **settings):
         if data.get("kind") == "Error":
             logger.error(data["message"])
             raise ConnectApiError(data["message"])
+    with group_cache_lock:
+        subgroup_cache.pop(group_name, None)
     logger.info("Created subgroup %s in group %s" % (settings["name"], group_name))
@@ -0,0 +1,210 @@
+"""
+Culls notebooks that have been idle for too long, so that scarce GPUs are freed before the notebooks expire.
+
+The culler periodically asks each notebook's Jupyter server for its status (GET /api/status),
+using the token that is stored in the notebook's secret. The status reports the time of the last activity
+of the server and its kernels. A notebook that has been idle for longer than the threshold of its
+resource class is removed (or stopped, so that its owner can resume it later), and the GPU-hours that it would
+have held until its expiration date are reported.
+
+Functionality:
+===============
+
+1. The start_idle_culler function starts a thread that culls idle notebooks on an interval
+2. The cull_idle_notebooks function culls idle notebooks once, and returns the notebooks that were culled
+3. The get_last_activity function asks a notebook's Jupyter server for the time of its last activity
+4. The get_stats function returns the number of culled notebooks and the reclaimed GPU-hours
+
+Dependencies:
+===============
+
+A portal.conf file with the following optional settings:
+
+CULL_IDLE_HOURS: (dict) The idle threshold in hours for each resource class. A resource class is either a GPU product
+                 name, "gpu" (any GPU product), or "cpu" (notebooks without GPUs). Classes without a threshold are never culled.
+                 e.g. {"NVIDIA-A100-SXM4-40GB": 2, "gpu": 4, "cpu": 24}
+CULL_INTERVAL: (int) How often (in seconds) the culler runs. The default is 600.
+CULL_ACTION: (string) "remove" removes idle notebooks, and "stop" stops them (see jupyterlab.stop_notebook).
+             The default is "remove".
+JUPYTER_STATUS_URL: (string) The URL of a notebook's status endpoint, formatted with the notebook's name and the domain name.
+                    The default is "https://{name}.{domain_name}/api/status". Point it at a stub Jupyter server for testing,
+                    e.g. "http://localhost:8888/{name}/api/status".
+
+Example usage:
+===============
+
+cd <path>/<to>/af-portal
+python
+>>> from portal import culler
+>>> culler.get_last_activity('mynotebook')
+>>> culler.cull_idle_notebooks(dry_run=True)
+>>> culler.get_stats()
+"""
+
+import datetime
+import threading
+import time
+import requests
+from dateutil.parser import parse
+from portal import backends, jupyterlab
+from portal.app import app, logger
+
+thresholds = app.config.get("CULL_IDLE_HOURS", {})
+interval = app.config.get("CULL_INTERVAL", 600)
+action = app.config.get("CULL_ACTION", "remove")
+status_url = app.config.get(
+    "JUPYTER_STATUS_URL", "https://{name}.{domain_name}/api/status"
+)
+
+stats = dict(notebooks=0, gpu_hours=0.0, last_run=None)
+lock = threading.Lock()
+started = False
+
+
+def get_resource_class(pod):
+    """Returns the resource classes of a notebook pod, from the most specific to the least specific."""
+    resources = pod.spec.containers[0].resources.requests or {}
+    if int(resources.get("nvidia.com/gpu", 0)) > 0:
+        product = (pod.spec.node_selector or {}).get("nvidia.com/gpu.product")
+        return (product, "gpu") if product else ("gpu",)
+    return ("cpu",)
+
+
+def get_idle_threshold(pod):
+    """Returns the idle threshold of a notebook pod as a timedelta, or None when the notebook is never culled."""
+    for resource_class in get_resource_class(pod):
+        if resource_class in thresholds:
+            return datetime.timedelta(hours=thresholds[resource_class])
+    return None
+
+
+def get_last_activity(name, token=None):
+    """
+    Asks a notebook's Jupyter server for the time of its last activity. Returns a datetime, or None when the
+    server cannot be reached (e.g. while the notebook is starting).
+
+    Function parameters:
+
+    name: (string) The name of the notebook
+    token: (string) The notebook's Jupyter token. When token is None, it is read from the notebook's secret.
+    """
+    backend = backends.current()
+    if token is None:
+        token = backend.core.read_namespaced_secret(name, backend.namespace).data[
+            "token"
+        ]
+    url = status_url.format(name=name, domain_name=backend.domain_name)
+    try:
+        response = requests.get(
+            url, headers={"Authorization": "token %s" % token}, timeout=10
+        )
+        if response.status_code != requests.codes.ok:
+            logger.info(
+                "Status of notebook %s returned %d" % (name, response.status_code)
+            )
+            return None
+        return parse(response.json()["last_activity"])
+    except (requests.RequestException, KeyError, ValueError) as err:
+        logger.info("Unable to get the status of notebook %s: %s" % (name, str(err)))
+        return None
+
+
+def cull_idle_notebooks(dry_run=False):
+    """
+    Removes (or stops) every notebook that has been idle for longer than the threshold of its resource class.
+    Returns a list of dicts with the name, owner, idle hours and reclaimed GPU-hours of each culled notebook.
+
+    Function parameters:
+
+    dry_run: (boolean) When dry_run is True, idle notebooks are reported but not removed
+    """
+    culled = []
+    for found in backends.fan_out(cull_backend, dry_run).values():
+        culled.extend(found)
+    with lock:
+        stats["last_run"] = datetime.datetime.now(datetime.timezone.utc).isoformat()
+    return culled
+
+
+def cull_backend(dry_run=False):
+    """Culls the idle notebooks of the current backend. Takes the same parameters as cull_idle_notebooks."""
+    culled = []
+    now = datetime.datetime.now(datetime.timezone.utc)
+    backend = backends.current()
+    pods = backend.core.list_namespaced_pod(
+        backend.namespace, label_selector="k8s-app=jupyterlab"
+    ).items
+    for pod in pods:
+        if pod.metadata.deletion_timestamp is not None:
+            continue
+        threshold = get_idle_threshold(pod)
+        if threshold is None or now - pod.metadata.creation_timestamp < threshold:
+            continue
+        try:
+            last_activity = get_last_activity(pod.metadata.name)
+        except Exception as err:
+            logger.error(
+                "Unable to check notebook %s for activity: %s"
+                % (pod.metadata.name, str(err))
+            )
+            continue
+        if last_activity is None or now - last_activity < threshold:
+            continue
+        gpus = int(
+            (pod.spec.containers[0].resources.requests or {}).get("nvidia.com/gpu", 0)
+        )
+        expiration_date = jupyterlab.get_expiration_date(pod)
+        hours_left = (
+            max((expiration_date - now).total_seconds() / 3600, 0)
+            if expiration_date
+            else 0
+        )
+        notebook = dict(
+            name=pod.metadata.name,
+            owner=pod.metadata.labels.get("owner"),
+            idle_hours=round((now - last_activity).total_seconds() / 3600, 1),
+            gpu_hours=round(gpus * hours_left, 1),
+        )
+        logger.info(
+            "Notebook %s has been idle for %s hours, reclaiming %s GPU-hours"
+            % (notebook["name"], notebook["idle_hours"], notebook["gpu_hours"])
+        )
+        if not dry_run:
+            cull = (
+                jupyterlab.stop_notebook
+                if action == "stop"
+                else jupyterlab.remove_notebook
+            )
+            if not cull(pod.metadata.name):
+                continue
+            with lock:
+                stats["notebooks"] += 1
+                stats["gpu_hours"] += notebook["gpu_hours"]
+        culled.append(notebook)
+    return culled
+
+
+def get_stats():
+    """Returns the number of notebooks culled and the GPU-hours reclaimed since the portal started."""
+    with lock:
+        return dict(stats, thresholds=thresholds, action=action)
+
+
+def start_idle_culler():
+    """Starts a thread that culls idle notebooks on an interval. Does nothing when it has already started."""
+    global started
+    with lock:
+        if started or not thresholds:
+            return
+        started = True
+
+    def inner():
+        while True:
+            try:
+                cull_idle_notebooks()
+            except Exception as err:
+                logger.error("Unable to cull idle notebooks: %s" % str(err))
+            time.sleep(interval)
+
+    threading.Thread(target=inner, daemon=True).start()
+    logger.info("Started idle notebook culler")
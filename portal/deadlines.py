@@ -0,0 +1,156 @@
+"""
+A deadline for each request, from which the calls to the Connect API, Kubernetes and Mailgun take their timeouts.
+
+A view can chain many upstream calls (e.g. members_only, then configure_notebook, which calls generate_notebook_name
+and get_user_roles), and gunicorn kills a worker that takes longer than --timeout. Instead, each request gets a budget
+of REQUEST_DEADLINE seconds when it starts (see views.start_deadline), and each upstream call waits at most
+for its own timeout or for what is left of the budget, whichever is shorter. A call made after the budget has run out
+raises DeadlineExceeded, so the request fails with an error page, and the worker lives on.
+
+Optional work (e.g. the events and the log of a notebook) is skipped when less than DEADLINE_RESERVE seconds are left.
+When the request ends, the time it used, the upstream calls it made and the work it skipped are logged.
+
+The deadline belongs to the calling thread. A function that hands work to other threads (e.g. backends.fan_out)
+passes the deadline along with the use function. Outside of a request (e.g. in background threads) there is no deadline,
+and the calls only use their own timeouts.
+
+Functionality:
+===============
+
+1. The start and finish functions start and end the deadline of the calling thread
+2. The timeout function returns the timeout of an upstream call
+3. The allows function tells whether there is time left for optional work
+4. The use function sets the deadline of another thread, in a with block
+
+Dependencies:
+===============
+
+A portal.conf file with the following optional settings:
+
+REQUEST_DEADLINE: (number) The budget (in seconds) of each request. The default is 90, below gunicorn's timeout of 120.
+DEADLINE_RESERVE: (number) Optional work is skipped when fewer seconds are left. The default is 10.
+
+Example usage:
+===============
+
+cd <path>/<to>/af-portal
+python
+>>> from portal import deadlines
+>>> deadlines.start(30)
+>>> deadlines.timeout(10, "connect")
+>>> deadlines.allows("events")
+>>> deadlines.finish("GET /jupyterlab")
+"""
+
+import threading
+import time
+from contextlib import contextmanager
+from portal.app import app, logger
+from portal.errors import DeadlineExceeded
+
+budget = app.config.get("REQUEST_DEADLINE", 90)
+reserve = app.config.get("DEADLINE_RESERVE", 10)
+# The shortest timeout that a call is given, so that a call made just before the deadline still has a chance
+min_timeout = 0.5
+
+local = threading.local()
+
+
+class Deadline:
+    def __init__(self, seconds):
+        self.seconds = seconds
+        self.start = time.time()
+        self.expires = self.start + seconds
+        self.calls = {}
+        self.skipped = []
+        self.lock = threading.Lock()
+
+    def remaining(self):
+        return self.expires - time.time()
+
+
+def current():
+    """Returns the deadline of the calling thread, or None."""
+    return getattr(local, "deadline", None)
+
+
+def start(seconds=None):
+    """Starts a deadline for the calling thread, of seconds (the default is REQUEST_DEADLINE). Returns the deadline."""
+    local.deadline = Deadline(seconds or budget)
+    return local.deadline
+
+
+def finish(label):
+    """Ends the deadline of the calling thread, and logs the time it used, its upstream calls and its skipped work."""
+    deadline = current()
+    local.deadline = None
+    if deadline is None or not (deadline.calls or deadline.skipped):
+        return
+    used = time.time() - deadline.start
+    message = "%s used %.1f of %d seconds, with %s" % (
+        label,
+        used,
+        deadline.seconds,
+        ", ".join(
+            "%d %s calls" % (n, kind) for kind, n in sorted(deadline.calls.items())
+        )
+        or "no upstream calls",
+    )
+    if deadline.skipped:
+        message += ", and skipped %s" % ", ".join(deadline.skipped)
+    if used > deadline.seconds:
+        logger.error("Deadline exceeded: %s" % message)
+    else:
+        logger.info(message)
+
+
+@contextmanager
+def use(deadline):
+    """Sets the deadline of the calling thread inside a with block (e.g. in a worker thread of the thread that has it)."""
+    previous = current()
+    local.deadline = deadline
+    try:
+        yield deadline
+    finally:
+        local.deadline = previous
+
+
+def remaining():
+    """Returns the number of seconds left before the deadline of the calling thread, or None when there is no deadline."""
+    deadline = current()
+    return deadline.remaining() if deadline else None
+
+
+def timeout(default, kind):
+    """
+    Returns the timeout (in seconds) of an upstream call: the call's default timeout, or what is left of the deadline
+    when it is shorter. Raises DeadlineExceeded when the deadline has passed.
+
+    default: (number) The call's own timeout, or None for no timeout
+    kind: (string) The kind of the call, for the logs, e.g. "connect", "kubernetes" or "mailgun"
+    """
+    deadline = current()
+    if deadline is None:
+        return default
+    left = deadline.remaining()
+    with deadline.lock:
+        deadline.calls[kind] = deadline.calls.get(kind, 0) + 1
+    if left <= 0:
+        raise DeadlineExceeded(deadline.seconds)
+    left = max(left, min_timeout)
+    return left if default is None else min(default, left)
+
+
+def allows(work):
+    """
+    Returns True when there is time left for optional work, i.e. more than DEADLINE_RESERVE seconds or no deadline.
+    Work that is skipped is logged when the request ends.
+
+    work: (string) A name for the work, e.g. "events"
+    """
+    deadline = current()
+    if deadline is None or deadline.remaining() > reserve:
+        return True
+    with deadline.lock:
+        deadline.skipped.append(work)
+    return False
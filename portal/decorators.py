@@ -107,11 +107,24 @@ In Python, a function is a type of object, and a reference to a function can be
 The decorator pattern makes use of this feature, and allows the programmer to add a pre-defined feature to any function in their code.
 """
 
-from flask import session, request, redirect, render_template, url_for, flash
+from flask import session, request, redirect, render_template, url_for, flash, g
 from functools import wraps
 from portal.app import logger
-from portal import connect, jupyterlab
-from portal.errors import InvalidParameter, MissingParameter, InvalidFormError
+from portal import (
+    backends,
+    capacity,
+    connect,
+    jupyterlab,
+    quotas,
+    reservations,
+    scheduler,
+)
+from portal.errors import (
+    InvalidParameter,
+    MissingParameter,
+    InvalidFormError,
+    InsufficientCapacityError,
+)
 import time
 import string
 
@@ -130,15 +143,20 @@ def timer(fn):
     return inner
 
 
+def check_keys(settings, keys):
+    """Raises InvalidParameter when a key of settings is not one of the permitted keys (see permit_keys)."""
+    for kw in settings:
+        if kw not in keys:
+            raise InvalidParameter(kw)
+
+
 def permit_keys(*keys):
     """A function that returns a decorator. The decorator raises an Exception when a key is not permitted."""
 
     def outer(fn):
         @wraps(fn)
         def inner(*args, **kwargs):
-            for kw in kwargs:
-                if kw not in keys:
-                    raise InvalidParameter(kw)
+            check_keys(kwargs, keys)
             return fn(*args, **kwargs)
 
         return inner
@@ -219,6 +237,8 @@ def validate_notebook(fn):
 
     @wraps(fn)
     def inner(*args, **kwargs):
+        # The name that the quota index holds the request's resources under (see quotas.check)
+        hold = None
         try:
             valid_chars = set(
                 string.ascii_lowercase
@@ -244,13 +264,17 @@ def validate_notebook(fn):
                 raise InvalidFormError("Valid characters are [a-zA-Z0-9._-]")
             if not jupyterlab.notebook_name_available(notebook_name):
                 raise InvalidFormError("The name %s is already taken." % notebook_name)
+            # A queued notebook holds its name until it is deployed (see scheduler.py)
+            if scheduler.holds_name(notebook_name):
+                raise InvalidFormError(
+                    "The name %s is already taken by a queued notebook." % notebook_name
+                )
             if image not in jupyterlab.supported_images():
                 raise InvalidFormError("Docker image %s is not supported." % image)
             if cpu_request < 1 or cpu_request > 16:
                 raise InvalidFormError(
                     "Requests must be between 1 and 16 CPUs." % cpu_request
                 )
-            # TODO : Check group membership
             if memory_request < 0 or memory_request > 256:
                 raise InvalidFormError(
                     "Requests must be between 1 and 256 GB RAM." % memory_request
@@ -261,37 +285,118 @@ def validate_notebook(fn):
                 )
             # if not gpus:
             #    raise InvalidFormError('The GPU product is not supported.')
+            username = session.get("unix_name")
+            notebook_id = jupyterlab.sanitize_k8s_pod_name(
+                notebook_name.strip().lower()
+            )
+            message = quotas.check(
+                username,
+                cpu_request,
+                memory_request,
+                gpu_request,
+                hold=notebook_id,
+            )
+            if message:
+                raise InvalidFormError(message)
+            hold = notebook_id
+            reservation = None
             if gpu_request:
-                gpus = jupyterlab.get_gpu_availability(product=gpu_product_request)
-                gpu_product = gpus[0]["product"]
-                gpu_available = gpus[0]["available"]
+                nodes = jupyterlab.get_gpu_nodes(product=gpu_product_request)
+                if not nodes:
+                    raise InvalidFormError(
+                        "The GPU product %s is not supported." % gpu_product_request
+                    )
+                net = reservations.subtract(nodes)
+                gpu_product = gpu_product_request
+                gpu_available = sum(node["gpu_free"] for node in net)
+                # A request that could fit on an empty node can wait in the deploy queue (see scheduler.py)
+                queueable = capacity.could_fit(
+                    nodes, gpu_request, cpu_request, memory_request
+                )
                 if gpu_available < gpu_request:
                     if gpu_available == 0:
-                        raise InvalidFormError(
-                            "The %s is currently not available" % gpu_product
+                        raise InsufficientCapacityError(
+                            "The %s is currently not available" % gpu_product,
+                            queueable=queueable,
                         )
                     if gpu_available == 1:
-                        raise InvalidFormError(
-                            "The %s has only 1 instance available." % gpu_product
+                        raise InsufficientCapacityError(
+                            "The %s has only 1 instance available." % gpu_product,
+                            queueable=queueable,
                         )
                     if gpu_available > 1:
-                        raise InvalidFormError(
+                        raise InsufficientCapacityError(
                             "The %s has only %s instances available."
-                            % (gpu_product, gpu_available)
+                            % (gpu_product, gpu_available),
+                            queueable=queueable,
                         )
-                if cpu_request > gpus[0]["cpu_request_max"]:
-                    raise InvalidFormError(
+                # The pod runs on a single node, so the request has to fit on one node
+                largest = capacity.largest_fit(net)
+                if largest[-1]["gpu"] < gpu_request:
+                    raise InsufficientCapacityError(
+                        "The %s has %d instances available, but at most %d on a single node."
+                        % (gpu_product, gpu_available, largest[-1]["gpu"]),
+                        queueable=queueable,
+                    )
+                largest = largest[gpu_request - 1]
+                if cpu_request > largest["cpu"]:
+                    raise InsufficientCapacityError(
                         "The request of %d CPUs is more than maximum available(%d) for the selelected GPU type"
-                        % (cpu_request, gpus[0]["cpu_request_max"])
+                        % (cpu_request, largest["cpu"]),
+                        queueable=queueable,
                     )
-                if memory_request > gpus[0]["mem_request_max"]:
-                    raise InvalidFormError(
+                if memory_request > largest["memory"]:
+                    raise InsufficientCapacityError(
                         "The request of %d GB Mem is more than maximum available(%d) for the selelected GPU type"
-                        % (memory_request, gpus[0]["mem_request_max"])
+                        % (memory_request, largest["memory"]),
+                        queueable=queueable,
                     )
-            return fn(*args, **kwargs)
+                if not capacity.fit(net, gpu_request, cpu_request, memory_request):
+                    raise InsufficientCapacityError(
+                        "No single node with the %s can currently host %d CPUs and %d GB Mem together."
+                        % (gpu_product, cpu_request, memory_request),
+                        queueable=queueable,
+                    )
+                # Hold the resources until the notebook is deployed, so that concurrent requests cannot claim them too
+                reservation = reservations.reserve(
+                    nodes,
+                    gpu_request,
+                    cpu_request,
+                    memory_request,
+                    owner=session.get("unix_name"),
+                    notebook=notebook_id,
+                )
+                if reservation is None:
+                    raise InsufficientCapacityError(
+                        "The %s was just reserved by another user." % gpu_product,
+                        queueable=queueable,
+                    )
+                # The notebook is deployed on the reserved node, on that node's backend (see backends.py)
+                g.gpu_node = reservations.get_node(reservation)
+                g.backend = backends.of_node(g.gpu_node).name
+        except InsufficientCapacityError as err:
+            if not err.queueable:
+                quotas.release(hold)
+                flash(str(err), "warning")
+                return redirect(url_for("configure_notebook"))
+            # The view queues the notebook instead of deploying it
+            g.insufficient_capacity = str(err)
         except InvalidFormError as err:
+            quotas.release(hold)
             flash(str(err), "warning")
             return redirect(url_for("configure_notebook"))
+        except Exception:
+            quotas.release(hold)
+            raise
+        try:
+            response = fn(*args, **kwargs)
+        except Exception:
+            reservations.release(reservation)
+            raise
+        finally:
+            # A deployed notebook holds its resources in the quota index from now on, and a queued one is checked again
+            quotas.release(hold)
+        reservations.release(reservation, settle=True)
+        return response
 
     return inner
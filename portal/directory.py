@@ -0,0 +1,231 @@
+"""
+A user directory with a typeahead search index, so that admin pages can look up users as an admin types.
+
+The directory is a snapshot (see snapshots.py) of the profiles of the users in the root group,
+refreshed in the background. Each snapshot is indexed in memory by the words of each user's
+username, name, email and institution:
+
+prefix index: a sorted list of (word, user) pairs, which finds the words that start with a query with a binary search
+trigram index: the users whose fields contain each 3-letter sequence, which finds a query inside a word (e.g. "chic" in "uchicago")
+
+A search ranks the matches (an exact username first, then usernames that start with the query, then words that start
+with the query, then matches inside words) and returns the top k, without calling the Connect API.
+
+The membership views record the role changes they make in the facility group (see record_role_change), and the
+searches apply the changes made since the snapshot was taken, so that an added, approved or removed user is shown
+with their new role right away rather than at the next refresh.
+
+Functionality:
+===============
+
+1. The search function returns the users that best match a query, and search_page returns a page of them
+2. The record_role_change function records a change of users' roles, which the searches apply until the next refresh
+3. The directory_snapshot object refreshes the directory and its index in the background
+
+Dependencies:
+===============
+
+A portal.conf file with the following optional setting:
+
+DIRECTORY_INTERVAL: (int) How often (in seconds) the directory is refreshed. The default is 600.
+
+Example usage:
+===============
+
+cd <path>/<to>/af-portal
+python
+>>> from portal import directory
+>>> directory.search('jdoe')
+>>> directory.search('chicago', k=50, roles=('nonmember', 'pending'))
+"""
+
+import bisect
+import heapq
+import re
+import threading
+import time
+from portal import connect, snapshots
+from portal.app import app
+from portal.records import facility_group
+
+interval = app.config.get("DIRECTORY_INTERVAL", 600)
+fields = ("unix_name", "name", "email", "institution")
+word_pattern = re.compile(r"[^\W_]+")
+# The max number of users that a short query collects from the prefix index
+max_candidates = 200
+
+# The roles set in the facility group by this process, by username: a tuple (time of the change, role)
+role_changes = {}
+lock = threading.Lock()
+
+
+class SearchIndex:
+    def __init__(self, profiles, built_at=0):
+        """
+        profiles: (list) The user profiles to index (see connect.get_user_profiles)
+        built_at: (float) The time when the profiles were requested
+        """
+        self.profiles = profiles
+        self.built_at = built_at
+        self.haystacks = []
+        words = []
+        self.trigrams = {}
+        for i, profile in enumerate(profiles):
+            values = [str(profile.get(field) or "").lower() for field in fields]
+            haystack = " ".join(values)
+            self.haystacks.append(haystack)
+            tokens = set(values)
+            for value in values:
+                tokens.update(word_pattern.findall(value))
+            tokens.discard("")
+            words.extend((token, i) for token in tokens)
+            for j in range(len(haystack) - 2):
+                self.trigrams.setdefault(haystack[j : j + 3], set()).add(i)
+        words.sort()
+        self.words = [word for word, i in words]
+        self.ids = [i for word, i in words]
+
+    def prefix_matches(self, term, limit):
+        """Returns the users with a word that starts with term, up to limit users."""
+        found = set()
+        start = bisect.bisect_left(self.words, term)
+        for j in range(start, len(self.words)):
+            if not self.words[j].startswith(term) or len(found) >= limit:
+                break
+            found.add(self.ids[j])
+        return found
+
+    def substring_matches(self, term):
+        """Returns the users whose fields contain term, which has at least 3 characters."""
+        postings = [
+            self.trigrams.get(term[j : j + 3], set()) for j in range(len(term) - 2)
+        ]
+        postings.sort(key=len)
+        found = set(postings[0])
+        for posting in postings[1:]:
+            found &= posting
+            if not found:
+                break
+        return {i for i in found if term in self.haystacks[i]}
+
+    def rank(self, i, query, prefixed):
+        unix_name = self.haystacks[i].split(" ", 1)[0]
+        if unix_name == query:
+            return 0
+        if unix_name.startswith(query):
+            return 1
+        return 2 if i in prefixed else 3
+
+    def search(self, query, k=20, roles=None, changes=None):
+        """
+        Returns a list of the (at most k) profiles that best match a query.
+        Every word of the query must appear in the user's username, name, email or institution.
+
+        query: (string) The text to look for
+        k: (int) The max number of profiles to return
+        roles: (tuple) When given, only the users with one of these roles are returned
+        changes: (dict) The roles that replace the roles of the profiles, by username (see record_role_change)
+        """
+        _, profiles = self.search_page(
+            query, k=k, roles=roles, changes=changes, exact=False
+        )
+        return profiles
+
+    def search_page(self, query, start=0, k=20, roles=None, changes=None, exact=True):
+        """
+        Returns a tuple (the number of matches, the profiles of the matches ranked start to start + k).
+        Takes the same parameters as search. When exact is False, a short query collects at most max_candidates
+        users from the prefix index and skips the substring matches once it has k users, so the number of matches
+        is a lower bound; when exact is True, every match is counted, so that the pages add up.
+        """
+        changes = changes or {}
+        query = query.strip().lower()
+        terms = query.split()
+        if not terms:
+            return 0, []
+        primary = max(terms, key=len)
+        prefixed = self.prefix_matches(
+            primary, len(self.profiles) if exact else max_candidates
+        )
+        candidates = prefixed
+        if (exact or len(prefixed) < start + k) and len(primary) >= 3:
+            candidates = prefixed | self.substring_matches(primary)
+        matches = [
+            i
+            for i in candidates
+            if all(t in self.haystacks[i] for t in terms)
+            and (roles is None or self.role(i, changes) in roles)
+        ]
+        best = heapq.nsmallest(
+            start + k,
+            matches,
+            key=lambda i: (
+                self.rank(i, query, prefixed),
+                self.haystacks[i],
+            ),
+        )
+        return len(matches), [self.profile(i, changes) for i in best[start:]]
+
+    def role(self, i, changes):
+        profile = self.profiles[i]
+        return changes.get(profile["unix_name"], profile.get("role"))
+
+    def profile(self, i, changes):
+        """Returns a profile, as a dict with its new role when its role has changed."""
+        profile = self.profiles[i]
+        if profile["unix_name"] in changes:
+            return dict(profile, role=changes[profile["unix_name"]])
+        return profile
+
+
+def refresh():
+    """Returns a search index of the profiles of the users in the root group."""
+    start = time.time()
+    return SearchIndex(connect.get_user_profiles("root"), built_at=start)
+
+
+directory_snapshot = snapshots.Snapshot(
+    "directory", refresh, interval=interval, max_age=interval * 6
+)
+
+
+def record_role_change(usernames, group_name, role):
+    """
+    Records that users were given a role in a group, or removed from it when role is None.
+    Only the changes in the facility group, which sets the roles of the directory, are recorded.
+    """
+    if group_name != facility_group:
+        return
+    now = time.time()
+    with lock:
+        for username in usernames:
+            role_changes[username] = (now, role or "nonmember")
+
+
+def get_changes(index):
+    """Returns the roles set since an index was built, by username, and forgets the older changes."""
+    with lock:
+        for username, (changed_at, _) in list(role_changes.items()):
+            if changed_at < index.built_at:
+                del role_changes[username]
+        return {username: role for username, (_, role) in role_changes.items()}
+
+
+def search(query, k=20, roles=None):
+    """Returns a list of the (at most k) profiles that best match a query. See SearchIndex.search."""
+    index, _ = directory_snapshot.get()
+    return index.search(query, k=k, roles=roles, changes=get_changes(index))
+
+
+def search_page(query, start=0, k=20, roles=None):
+    """Returns a tuple (the number of matches, a page of the matches). See SearchIndex.search_page."""
+    index, _ = directory_snapshot.get()
+    return index.search_page(
+        query, start=start, k=k, roles=roles, changes=get_changes(index)
+    )
+
+
+def count():
+    """Returns the number of users in the directory."""
+    index, _ = directory_snapshot.get()
+    return len(index.profiles)
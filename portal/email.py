@@ -1,10 +1,12 @@
 """Functions for sending emails from our email accounts."""
 
-from portal import connect
+from portal import connect, deadlines
 from portal.app import app, logger
 import requests
 
 token = app.config.get("MAILGUN_API_TOKEN")
+# How long (in seconds) to wait for Mailgun, or less when the request is short of time (see deadlines.py)
+timeout = app.config.get("MAILGUN_TIMEOUT", 10)
 
 
 def email_users(sender, recipients, subject, body):
@@ -19,6 +21,7 @@ def email_users(sender, recipients, subject, body):
             "subject": subject,
             "text": body,
         },
+        timeout=deadlines.timeout(timeout, "mailgun"),
     )
     if resp.status_code == requests.codes.ok:
         logger.info("Sent email with subject %s" % subject)
@@ -27,3 +27,42 @@ class MissingParameter(Exception):
 
 class InvalidFormError(Exception):
     pass
+
+
+class InsufficientCapacityError(InvalidFormError):
+    """Raised when a notebook request is valid, but the cluster cannot host it right now."""
+
+    def __init__(self, message, queueable=False):
+        super().__init__(message)
+        self.queueable = queueable
+
+
+class CircuitOpenError(Exception):
+    """Raised when a circuit breaker refuses a call to a service that is failing (see breaker.py)."""
+
+    def __init__(self, service, retry_after=0):
+        self.service = service
+        self.retry_after = retry_after
+
+    def __str__(self):
+        return "%s is unavailable, retry in %d seconds" % (
+            self.service,
+            self.retry_after,
+        )
+
+
+class ConnectUnavailableError(ConnectApiError):
+    """Raised when the Connect API cannot be reached, times out, or its circuit breaker is open."""
+
+    def __str__(self):
+        return "The CI Connect API is unavailable right now: %s" % self.message
+
+
+class DeadlineExceeded(Exception):
+    """Raised when a request has used up its deadline (see deadlines.py) before an upstream call."""
+
+    def __init__(self, seconds):
+        self.seconds = seconds
+
+    def __str__(self):
+        return "The request did not finish within %d seconds" % self.seconds
@@ -0,0 +1,217 @@
+"""
+A history of the GPU, CPU and memory utilization of the cluster, for capacity planning.
+
+A background sampler records the availability of each GPU product (the dicts returned by
+jupyterlab.get_gpu_availability, read from jupyterlab.gpu_snapshot) on an interval.
+The samples are stored in a SQLite database at three resolutions:
+
+raw: every sample, kept for a few days
+5m: the average (and the extremes) of the samples in each 5-minute bucket, kept for a few weeks
+1h: the average (and the extremes) of the samples in each hour, kept for a few years
+
+The 5-minute and hourly buckets are updated with each sample (an upsert that adds the sample to the bucket),
+so no separate downsampling pass is needed, and old rows are deleted after their retention period,
+which bounds the size of the database.
+
+Functionality:
+===============
+
+1. The sample function records the current availability of each GPU product
+2. The get_history function returns the samples in a time range, at a resolution that suits the range
+3. The start_sampler function starts a thread that records a sample on an interval
+
+Dependencies:
+===============
+
+A portal.conf file with the following optional settings:
+
+HISTORY_DB: (string) The path of the SQLite database. The default is /tmp/af-portal-history.db.
+HISTORY_INTERVAL: (int) How often (in seconds) a sample is recorded. The default is 60.
+HISTORY_RETENTION_DAYS: (dict) How long (in days) each resolution is kept. The default is {"raw": 2, "5m": 35, "1h": 730}.
+
+Example usage:
+===============
+
+cd <path>/<to>/af-portal
+python
+>>> import time
+>>> from portal import history
+>>> history.sample()
+>>> now = int(time.time() * 1000)
+>>> history.get_history(now - 86400 * 1000, now)
+"""
+
+import sqlite3
+import threading
+import time
+from portal import jupyterlab
+from portal.app import app, logger
+
+db_path = app.config.get("HISTORY_DB", "/tmp/af-portal-history.db")
+interval = app.config.get("HISTORY_INTERVAL", 60)
+retention = {"raw": 2, "5m": 35, "1h": 730}
+retention.update(app.config.get("HISTORY_RETENTION_DAYS", {}))
+
+# The length of the buckets of each resolution in milliseconds
+resolutions = {"raw": None, "5m": 300000, "1h": 3600000}
+# The longest range (in milliseconds) that is served at each resolution
+max_ranges = {"raw": 6 * 3600000, "5m": 7 * 86400000}
+metrics = (
+    "count",
+    "total_requests",
+    "reserved",
+    "available",
+    "cpu_total",
+    "cpu_free",
+    "mem_total",
+    "mem_free",
+)
+
+lock = threading.Lock()
+started = False
+
+
+def open_db():
+    """Opens a connection to the database, and creates the tables if they do not exist."""
+    conn = sqlite3.connect(db_path, timeout=10, isolation_level=None)
+    conn.execute(
+        "CREATE TABLE IF NOT EXISTS samples_raw (ts INTEGER, product TEXT, %s, "
+        "PRIMARY KEY (ts, product))" % ", ".join("%s REAL" % m for m in metrics)
+    )
+    for resolution in ("5m", "1h"):
+        conn.execute(
+            "CREATE TABLE IF NOT EXISTS samples_%s (ts INTEGER, product TEXT, n INTEGER, %s, "
+            "min_available REAL, max_total_requests REAL, PRIMARY KEY (ts, product))"
+            % (resolution, ", ".join("sum_%s REAL" % m for m in metrics))
+        )
+    return conn
+
+
+def sample():
+    """
+    Records the current availability of each GPU product. Returns the number of products recorded,
+    which is 0 when another worker (or an earlier call) has already recorded a recent sample.
+    """
+    gpus, age = jupyterlab.gpu_snapshot.get()
+    # The sample is timestamped with the time of the snapshot, not the time it was read
+    ts = int((time.time() - age) * 1000)
+    conn = open_db()
+    try:
+        # BEGIN IMMEDIATE takes the database write lock, so that every worker's sampler records each interval once
+        conn.execute("BEGIN IMMEDIATE")
+        (last,) = conn.execute("SELECT MAX(ts) FROM samples_raw").fetchone()
+        if last is not None and ts - last < interval * 500:
+            conn.execute("ROLLBACK")
+            return 0
+        for gpu in gpus:
+            values = [gpu.get(m, 0) for m in metrics]
+            conn.execute(
+                "INSERT INTO samples_raw VALUES (?, ?, %s)"
+                % ", ".join("?" * len(metrics)),
+                [ts, gpu["product"]] + values,
+            )
+            for resolution in ("5m", "1h"):
+                bucket = ts - ts % resolutions[resolution]
+                conn.execute(
+                    "INSERT INTO samples_%s VALUES (?, ?, 1, %s, ?, ?) "
+                    "ON CONFLICT (ts, product) DO UPDATE SET n = n + 1, %s, "
+                    "min_available = MIN(min_available, excluded.min_available), "
+                    "max_total_requests = MAX(max_total_requests, excluded.max_total_requests)"
+                    % (
+                        resolution,
+                        ", ".join("?" * len(metrics)),
+                        ", ".join(
+                            "sum_%s = sum_%s + excluded.sum_%s" % (m, m, m)
+                            for m in metrics
+                        ),
+                    ),
+                    [bucket, gpu["product"]]
+                    + values
+                    + [gpu.get("available", 0), gpu.get("total_requests", 0)],
+                )
+        now = int(time.time() * 1000)
+        for resolution, days in retention.items():
+            conn.execute(
+                "DELETE FROM samples_%s WHERE ts < ?" % resolution,
+                (now - days * 86400000,),
+            )
+        conn.execute("COMMIT")
+    except Exception:
+        if conn.in_transaction:
+            conn.execute("ROLLBACK")
+        raise
+    finally:
+        conn.close()
+    return len(gpus)
+
+
+def choose_resolution(start, end):
+    """Returns the finest resolution that serves a range without returning too many samples."""
+    for resolution in ("raw", "5m"):
+        if end - start <= max_ranges[resolution]:
+            return resolution
+    return "1h"
+
+
+def get_history(start, end, product=None, resolution=None):
+    """
+    Returns the samples in a time range, as a dict with the resolution and a list of samples.
+    Each sample has a timestamp (ts, in milliseconds), a product, and the value of each metric.
+    Downsampled samples have the average of each metric, the lowest availability and the highest number of requests.
+
+    Function parameters:
+
+    start: (int) The start of the range in milliseconds since the epoch
+    end: (int) The end of the range in milliseconds since the epoch
+    product: (string) Only samples of this GPU product are returned (optional)
+    resolution: (string) "raw", "5m" or "1h". The default is the finest resolution that suits the range.
+    """
+    if resolution is None:
+        resolution = choose_resolution(start, end)
+    if resolution not in resolutions:
+        raise ValueError("Unknown resolution %s" % resolution)
+    query = "SELECT * FROM samples_%s WHERE ts >= ? AND ts <= ?" % resolution
+    params = [start, end]
+    if product:
+        query += " AND product = ?"
+        params.append(product)
+    query += " ORDER BY ts, product"
+    conn = open_db()
+    try:
+        cursor = conn.execute(query, params)
+        columns = [column[0] for column in cursor.description]
+        rows = [dict(zip(columns, row)) for row in cursor.fetchall()]
+    finally:
+        conn.close()
+    samples = []
+    for row in rows:
+        if resolution == "raw":
+            samples.append(row)
+            continue
+        n = row.pop("n")
+        entry = dict(ts=row.pop("ts"), product=row.pop("product"), samples=n)
+        for m in metrics:
+            entry[m] = round(row.pop("sum_%s" % m) / n, 2)
+        entry.update(row)
+        samples.append(entry)
+    return dict(resolution=resolution, start=start, end=end, samples=samples)
+
+
+def start_sampler():
+    """Starts a thread that records a sample on an interval. Does nothing when it has already started."""
+    global started
+    with lock:
+        if started:
+            return
+        started = True
+
+    def inner():
+        while True:
+            try:
+                sample()
+            except Exception as err:
+                logger.error("Unable to sample GPU availability: %s" % str(err))
+            time.sleep(interval)
+
+    threading.Thread(target=inner, daemon=True).start()
+    logger.info("Started GPU availability sampler")
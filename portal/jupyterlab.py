@@ -11,6 +11,15 @@ Functionality:
 5. The remove_notebook function lets a user remove a notebook
 6. The list_notebooks function returns a list of the names of all currently running notebooks
 7. The get_gpu_availability function lets a user know which GPU products are available for use
+8. The get_gpu_nodes function models the free GPUs, CPU cores and memory on each GPU node
+9. The gpu_snapshot object serves a recent snapshot of get_gpu_availability, refreshed in the background
+10. The stop_notebook function stops a notebook's pod, and keeps the rest of the notebook so that it can be resumed
+11. The resume_notebook function recreates the pod of a stopped notebook
+
+The functions run against the notebook backends described in backends.py. Functions that look up a notebook by name
+run on the notebook's backend, and functions that list notebooks or GPU nodes gather them from every backend.
+Concurrent calls to get_notebooks, get_gpu_nodes and get_gpu_availability with the same arguments share one call
+(see singleflight.py).
 
 Dependencies:
 ===============
@@ -87,6 +96,7 @@ python
 >>> pprint(gpu1)
 >>> gpu2 = jupyterlab.get_gpu_availability(memory=4864)
 >>> pprint(gpu2)
+>>> gpus, age = jupyterlab.gpu_snapshot.get()
 
 Example #6:
 
@@ -94,22 +104,43 @@ cd <path>/<to>/af-portal
 python
 >>> from portal import jupyterlab
 >>> jupyterlab.list_notebooks()
+
+Example #7:
+
+cd <path>/<to>/af-portal
+python
+>>> from portal import jupyterlab
+>>> jupyterlab.stop_notebook('mynotebook')
+>>> jupyterlab.get_notebooks('myusername')
+>>> jupyterlab.resume_notebook('mynotebook')
 """
 
+import json
 import math
-import yaml
 import time
 import datetime
 import threading
 import os
 import re
 import urllib
-from base64 import b64encode
-from jinja2 import Environment, FileSystemLoader
-from kubernetes import client, config
+from base64 import b64decode, b64encode
+from dateutil.parser import parse
+from kubernetes import config
 from kubernetes.client.exceptions import ApiException
 from kubernetes.utils.quantity import parse_quantity
 from portal.app import app, logger
+from portal import (
+    backends,
+    capacity,
+    deadlines,
+    manifests,
+    quotas,
+    reservations,
+    singleflight,
+    snapshots,
+    startups,
+    usage,
+)
 
 namespace = app.config.get("NAMESPACE")
 kubeconfig = app.config.get("KUBECONFIG")
@@ -125,24 +156,36 @@ else:
 def start_notebook_maintenance():
     def inner():
         while True:
-            api = client.CoreV1Api()
-            pods = api.list_namespaced_pod(
-                namespace, label_selector="k8s-app=jupyterlab"
-            ).items
-            for pod in pods:
-                exp_date = get_expiration_date(pod)
-                if exp_date and exp_date < datetime.datetime.now(datetime.timezone.utc):
-                    logger.info("Notebook %s has expired" % pod.metadata.name)
-                    remove_notebook(pod.metadata.name)
+            backends.fan_out(remove_expired_notebooks)
             time.sleep(1800)
 
     threading.Thread(target=inner).start()
     logger.info("Started notebook maintenance")
 
 
+def remove_expired_notebooks():
+    """Removes the expired notebooks (running or stopped) of the current backend."""
+    api = backends.current().core
+    pods = api.list_namespaced_pod(
+        backends.current().namespace, label_selector="k8s-app=jupyterlab"
+    ).items
+    for pod in pods:
+        exp_date = get_expiration_date(pod)
+        if exp_date and exp_date < datetime.datetime.now(datetime.timezone.utc):
+            logger.info("Notebook %s has expired" % pod.metadata.name)
+            remove_notebook(pod.metadata.name)
+    for notebook in get_stopped_notebooks():
+        if notebook["hours_remaining"] < 0:
+            logger.info("Stopped notebook %s has expired" % notebook["id"])
+            remove_notebook(notebook["id"])
+
+
 def deploy_notebook(**settings):
     """
     Deploys a Jupyter notebook on our Kubernetes cluster.
+    When a call fails, the objects that this deploy created are deleted, and the error is raised.
+    Creating the pod fails with a 409 (Conflict) when a notebook with the same name exists, which is left alone.
+    On a backend with a storage class (see backends.py), the notebook mounts the owner's persistent volume at /workspace.
 
     Function parameters:
     (All settings are required.)
@@ -160,68 +203,129 @@ def deploy_notebook(**settings):
     gpu_request: (integer) The number of GPU instances to request from the k8s cluster
     gpu_limit: (integer) The max number of GPU instances that can be allocated to this pod
     gpu_product: (string) Selects a GPU product based on name
+    gpu_node: (string) The node that the notebook's resources were reserved on (optional, see reservations.get_node).
+              The pod is pinned to this node, so that the reservation ledger charges the node that hosts the pod.
     hours_remaining: (integer) The duration of the notebook in hours
+    backend: (string) The name of the backend to deploy on (optional, see backends.py). The default is the current backend.
     """
-    settings["namespace"] = namespace
-    settings["domain_name"] = app.config["DOMAIN_NAME"]
+    backend = settings.pop("backend", None)
+    if backend is not None:
+        with backends.use(backend):
+            return deploy_notebook(**settings)
+    settings["namespace"] = backends.current().namespace
+    settings["domain_name"] = backends.current().domain_name
     settings["token"] = b64encode(os.urandom(32)).decode()
     settings["start_script"] = "/usr/local/bin/SetupPrivateJupyterLab.sh"
     settings["notebook_id"] = sanitize_k8s_pod_name(settings["notebook_id"])
-    templates = Environment(loader=FileSystemLoader("portal/templates/jupyterlab"))
-    api = client.CoreV1Api()
+    # The node name of a backend other than the primary backend starts with the backend's name
+    settings["gpu_node"] = (settings.get("gpu_node") or "").split("/", 1)[-1]
+    settings["storage_class"] = backends.current().storage_class or ""
+    # Build (and validate) every manifest before anything is created
+    pod = manifests.build("pod", **settings)
+    service = manifests.build("service", **settings)
+    secret = manifests.build("secret", **settings)
+    ingress = manifests.build("ingress", **settings)
+    api = backends.current().core
+    # Create the owner's persistent volume claim, which is shared by all of the owner's notebooks and outlives them
+    if settings["storage_class"]:
+        try:
+            api.create_namespaced_persistent_volume_claim(
+                namespace=backends.current().namespace,
+                body=manifests.build("pvc", **settings),
+            )
+        except ApiException as e:
+            if e.status != 409:
+                raise
+    # The objects that this call created, which are deleted when a later call fails
+    created = []
+    try:
+        create_objects(settings, pod, service, secret, ingress, created)
+    except Exception:
+        for delete in reversed(created):
+            try:
+                delete(settings["notebook_id"], backends.current().namespace)
+            except ApiException as e:
+                logger.error(
+                    "Unable to clean up notebook %s: %s"
+                    % (settings["notebook_id"], str(e))
+                )
+        if created:
+            quotas.remove(settings["notebook_id"])
+        raise
+    logger.info("Deployed notebook %s" % settings["notebook_name"])
+
+
+def create_objects(settings, pod, service, secret, ingress, created):
+    """
+    Creates the pod, service, secret and ingress of a notebook (see deploy_notebook).
+    The delete function of each object that is created is appended to the list created.
+    """
+    api = backends.current().core
     # Create a pod for the notebook (the notebook runs as a container inside the pod)
-    template = templates.get_template("pod.yaml")
-    pod = yaml.safe_load(template.render(**settings))
-    api.create_namespaced_pod(namespace=namespace, body=pod)
+    api.create_namespaced_pod(namespace=backends.current().namespace, body=pod)
+    created.append(api.delete_namespaced_pod)
+    startups.record_deploy(settings["notebook_id"], settings["image"])
+    quotas.add(
+        settings["notebook_id"],
+        settings["owner"],
+        settings["cpu_request"],
+        int(settings["memory_request"].rstrip("Gi")),
+        settings["gpu_request"],
+    )
     # Create a service for the pod
-    template = templates.get_template("service.yaml")
-    service = yaml.safe_load(template.render(**settings))
     # api.create_namespaced_service(namespace=namespace, body=service)
     try:
-        api.create_namespaced_service(namespace=namespace, body=service)
+        api.create_namespaced_service(
+            namespace=backends.current().namespace, body=service
+        )
+        created.append(api.delete_namespaced_service)
     except ApiException as e:
         if e.status == 409:
             api.patch_namespaced_service(
                 name=service["metadata"]["name"],
-                namespace=namespace,
+                namespace=backends.current().namespace,
                 body=service,
             )
         else:
             raise
     # Store the JupyterLab token in a secret
-    template = templates.get_template("secret.yaml")
-    secret = yaml.safe_load(template.render(**settings))
+    # Keep the pod manifest next to the token, so that a stopped notebook can be resumed
+    secret["stringData"] = {"pod": json.dumps(pod)}
     # api.create_namespaced_secret(namespace=namespace, body=secret)
     try:
-        api.create_namespaced_secret(namespace=namespace, body=secret)
+        api.create_namespaced_secret(
+            namespace=backends.current().namespace, body=secret
+        )
+        created.append(api.delete_namespaced_secret)
     except ApiException as e:
         if e.status == 409:
             api.patch_namespaced_secret(
                 name=secret["metadata"]["name"],
-                namespace=namespace,
+                namespace=backends.current().namespace,
                 body=secret,
             )
         else:
             raise
     # Create an ingress for the service (gives the notebook its own domain name and public key certificate)
-    api = client.NetworkingV1Api()
-    template = templates.get_template("ingress.yaml")
-    ingress = yaml.safe_load(template.render(**settings))
+    api = backends.current().networking
     # api.create_namespaced_ingress(namespace=namespace, body=ingress)
     try:
-        api.create_namespaced_ingress(namespace=namespace, body=ingress)
+        api.create_namespaced_ingress(
+            namespace=backends.current().namespace, body=ingress
+        )
+        created.append(api.delete_namespaced_ingress)
     except ApiException as e:
         if e.status == 409:
             api.patch_namespaced_ingress(
                 name=ingress["metadata"]["name"],
-                namespace=namespace,
+                namespace=backends.current().namespace,
                 body=ingress,
             )
         else:
             raise
-    logger.info("Deployed notebook %s" % settings["notebook_name"])
 
 
+@backends.routed
 def get_notebook(name=None, pod=None, **options):
     """
     Looks up a notebook by name or by pod. Returns a dict.
@@ -233,15 +337,19 @@ def get_notebook(name=None, pod=None, **options):
     pod: (object) The pod object returned by the kubernetes client
     log: (boolean) When log is True, the pod log is included in the dict that gets returned
     url: (boolean) When url is True, the notebook URL is included in the dict that gets returned
+    usage: (boolean) When usage is True, the current CPU and memory usage and the usage history are included
     """
-    api = client.CoreV1Api()
+    api = backends.current().core
     if pod is None:
-        pod = api.read_namespaced_pod(name=name.lower(), namespace=namespace)
+        pod = api.read_namespaced_pod(
+            name=name.lower(), namespace=backends.current().namespace
+        )
     notebook = dict()
     try:
         notebook["id"] = pod.metadata.name
         notebook["name"] = pod.metadata.labels.get("notebook-name")
-        notebook["namespace"] = namespace
+        notebook["namespace"] = backends.current().namespace
+        notebook["backend"] = backends.current().name
         notebook["owner"] = pod.metadata.labels.get("owner")
         notebook["image"] = pod.spec.containers[0].image
         notebook["node"] = pod.spec.node_name
@@ -271,10 +379,13 @@ def get_notebook(name=None, pod=None, **options):
                 Ready=4,
             ).get(cond["type"])
         )
-        events = api.list_namespaced_event(
-            namespace=namespace,
-            field_selector="involvedObject.uid=%s" % pod.metadata.uid,
-        ).items
+        # The events and the log are skipped when the request is short of time (see deadlines.py)
+        events = []
+        if deadlines.allows("events"):
+            events = api.list_namespaced_event(
+                namespace=backends.current().namespace,
+                field_selector="involvedObject.uid=%s" % pod.metadata.uid,
+            ).items
         notebook["events"] = [
             {
                 "message": e.message,
@@ -290,21 +401,24 @@ def get_notebook(name=None, pod=None, **options):
                     "memory": node.metadata.labels["nvidia.com/gpu.memory"] + "Mi",
                 }
         if pod.metadata.deletion_timestamp is None:
-            if next(
+            ready = next(
                 filter(
                     lambda c: c.type == "Ready" and c.status == "True",
                     pod.status.conditions,
                 ),
                 None,
-            ):
+            )
+            if ready and deadlines.allows("log"):
                 log = api.read_namespaced_pod_log(
-                    pod.metadata.name, namespace=namespace
+                    pod.metadata.name, namespace=backends.current().namespace
                 )
                 notebook["status"] = (
                     "Ready"
                     if re.search("Jupyter.*is running at", log)
                     else "Starting notebook..."
                 )
+            elif ready:
+                notebook["status"] = "Starting notebook..."
             else:
                 notebook["status"] = "Pending"
         else:
@@ -312,13 +426,16 @@ def get_notebook(name=None, pod=None, **options):
         # Optional fields
         if options.get("log") is True and "log" in locals():
             notebook["log"] = log
+        if options.get("usage") is True:
+            notebook["usage"] = usage.get_usage(pod.metadata.name)
+            notebook["usage_history"] = usage.get_history(pod.metadata.name)
         if options.get("url") is True and pod.metadata.deletion_timestamp is None:
-            token = api.read_namespaced_secret(pod.metadata.name, namespace).data[
-                "token"
-            ]
+            token = api.read_namespaced_secret(
+                pod.metadata.name, backends.current().namespace
+            ).data["token"]
             notebook["url"] = "https://%s.%s?%s" % (
                 pod.metadata.name,
-                app.config["DOMAIN_NAME"],
+                backends.current().domain_name,
                 urllib.parse.urlencode({"token": token}),
             )
     except Exception as e:
@@ -326,9 +443,11 @@ def get_notebook(name=None, pod=None, **options):
     return notebook
 
 
+@singleflight.coalesce
 def get_notebooks(owner=None, **options):
     """
     Retrieves a user's notebooks, or the notebooks for all users. Returns an array of dicts.
+    Every running notebook includes its current CPU and memory usage, or None when it has no metrics yet (see usage.py).
 
     Function parameters:
     (All parameters are optional.)
@@ -338,60 +457,274 @@ def get_notebooks(owner=None, **options):
     url: (boolean) When url is True, the notebook URL is included in the dict that gets returned
     """
     notebooks = []
-    api = client.CoreV1Api()
+    for found in backends.fan_out(get_backend_notebooks, owner, **options).values():
+        notebooks.extend(found)
+    return notebooks
+
+
+def get_backend_notebooks(owner=None, **options):
+    """Retrieves the notebooks of the current backend. Takes the same parameters as get_notebooks."""
+    notebooks = []
+    api = backends.current().core
     pods = api.list_namespaced_pod(
-        namespace,
+        backends.current().namespace,
         label_selector=(
             "k8s-app=jupyterlab"
             if owner is None
             else "k8s-app=jupyterlab,owner=%s" % owner
         ),
     ).items
+    # The usage of the listed notebooks is read from the usage snapshot in one pass (see usage.py)
+    samples = usage.get_backend_usage()
     for pod in pods:
         try:
             notebook = get_notebook(pod=pod, **options)
+            notebook["usage"] = samples.get(pod.metadata.name)
             logger.info("Notebook: %s", notebook)
             notebooks.append(notebook)
         except Exception as err:
             logger.error(
                 "Error adding notebook %s to array.\n%s" % (pod.metadata.name, str(err))
             )
+    notebooks.extend(get_stopped_notebooks(owner))
     return notebooks
 
 
-def list_notebooks():
-    """Returns a list of the names of all notebooks in the namespace."""
-    api = client.CoreV1Api()
-    pods = api.list_namespaced_pod(
-        namespace=namespace, label_selector="k8s-app=jupyterlab"
+def get_stopped_notebooks(owner=None):
+    """
+    Retrieves a user's stopped notebooks, or the stopped notebooks for all users. Returns an array of dicts.
+
+    Function parameters:
+    (All parameters are optional.)
+
+    owner: (string) The username of the owner. When owner is None, the function returns all stopped notebooks.
+    """
+    notebooks = []
+    api = backends.current().core
+    secrets = api.list_namespaced_secret(
+        backends.current().namespace,
+        label_selector=(
+            "k8s-app=jupyterlab,notebook-state=stopped"
+            if owner is None
+            else "k8s-app=jupyterlab,notebook-state=stopped,owner=%s" % owner
+        ),
     ).items
-    return [pod.metadata.name for pod in pods]
+    for secret in secrets:
+        try:
+            pod = json.loads(b64decode(secret.data["pod"]))
+            annotations = secret.metadata.annotations
+            expiration_date = parse(annotations["expiration-date"])
+            time_remaining = expiration_date - datetime.datetime.now(
+                datetime.timezone.utc
+            )
+            container = pod["spec"]["containers"][0]
+            notebooks.append(
+                dict(
+                    id=secret.metadata.name,
+                    name=pod["metadata"]["labels"].get("notebook-name"),
+                    namespace=backends.current().namespace,
+                    backend=backends.current().name,
+                    owner=secret.metadata.labels.get("owner"),
+                    image=container["image"],
+                    node=None,
+                    node_selector=pod["spec"].get("nodeSelector"),
+                    pod_status=None,
+                    creation_date=annotations["creation-date"],
+                    expiration_date=expiration_date.isoformat(),
+                    hours_remaining=int(time_remaining.total_seconds() / 3600),
+                    requests=container["resources"]["requests"],
+                    limits=container["resources"]["limits"],
+                    conditions=[],
+                    events=[],
+                    status="Stopped",
+                )
+            )
+        except Exception as err:
+            logger.error(
+                "Error adding stopped notebook %s to array.\n%s"
+                % (secret.metadata.name, str(err))
+            )
+    return notebooks
+
+
+def list_notebooks():
+    """Returns a list of the names of all notebooks in the namespace of every backend."""
 
+    def inner():
+        api = backends.current().core
+        pods = api.list_namespaced_pod(
+            namespace=backends.current().namespace, label_selector="k8s-app=jupyterlab"
+        ).items
+        return [pod.metadata.name for pod in pods]
+
+    return [name for names in backends.fan_out(inner).values() for name in names]
 
+
+@backends.routed
 def remove_notebook(name):
-    """Removes a notebook from the namespace, and all Kubernetes objects associated with the notebook."""
+    """
+    Removes a notebook from the namespace, and all Kubernetes objects associated with the notebook.
+    A failed delete does not stop the others; whatever is left behind is cleaned up by the reconciler (see reconciler.py).
+    """
     try:
         id = name.lower()
-        api = client.CoreV1Api()
-        api.delete_namespaced_pod(id, namespace)
-        api.delete_namespaced_service(id, namespace)
-        api.delete_namespaced_secret(id, namespace)
-        api = client.NetworkingV1Api()
-        api.delete_namespaced_ingress(id, namespace)
-        logger.info("Removed notebook %s from namespace %s" % (id, namespace))
+        api = backends.current().core
+        networking_api = backends.current().networking
+        failed = None
+        for delete in (
+            api.delete_namespaced_pod,
+            api.delete_namespaced_service,
+            api.delete_namespaced_secret,
+            networking_api.delete_namespaced_ingress,
+        ):
+            try:
+                delete(id, backends.current().namespace)
+            except ApiException as e:
+                # A stopped notebook has no pod
+                if e.status != 404:
+                    failed = failed or e
+        if failed is not None:
+            raise failed
+        quotas.remove(id)
+        logger.info(
+            "Removed notebook %s from namespace %s" % (id, backends.current().namespace)
+        )
         return True
     except Exception as err:
         logger.error(str(err))
         return False
 
 
+@backends.routed
+def stop_notebook(name):
+    """
+    Stops a notebook by deleting its pod, which frees its compute resources right away.
+    The notebook's service, secret and ingress, and the owner's persistent volume claim are kept,
+    so that the notebook can be resumed later with resume_notebook. Returns True when the notebook was stopped.
+    On a backend without persistent volumes, only the files outside of the pod (e.g. in /home) are kept.
+    """
+    try:
+        id = name.lower()
+        api = backends.current().core
+        pod = api.read_namespaced_pod(id, backends.current().namespace)
+        secret = api.read_namespaced_secret(id, backends.current().namespace)
+        if "pod" not in (secret.data or {}):
+            logger.error("Notebook %s was deployed without a saved pod manifest" % id)
+            return False
+        # The time2delete label counts from the pod's creation, so the absolute expiration date is saved
+        body = {
+            "metadata": {
+                "labels": {"notebook-state": "stopped"},
+                "annotations": {
+                    "expiration-date": get_expiration_date(pod).isoformat(),
+                    "creation-date": pod.metadata.creation_timestamp.isoformat(),
+                },
+            }
+        }
+        api.patch_namespaced_secret(id, backends.current().namespace, body=body)
+        api.delete_namespaced_pod(id, backends.current().namespace)
+        quotas.remove(id)
+        logger.info("Stopped notebook %s" % id)
+        return True
+    except Exception as err:
+        logger.error(str(err))
+        return False
+
+
+@backends.routed
+def resume_notebook(name):
+    """
+    Resumes a stopped notebook by recreating its pod from the manifest saved in the notebook's secret.
+    A GPU notebook is resumed only when a node can host it. Returns True when the notebook was resumed.
+    """
+    try:
+        id = name.lower()
+        api = backends.current().core
+        secret = api.read_namespaced_secret(id, backends.current().namespace)
+        if (secret.metadata.labels or {}).get("notebook-state") != "stopped":
+            return False
+        pod = json.loads(b64decode(secret.data["pod"]))
+        expiration_date = parse(secret.metadata.annotations["expiration-date"])
+        time_remaining = expiration_date - datetime.datetime.now(datetime.timezone.utc)
+        hours = math.ceil(time_remaining.total_seconds() / 3600)
+        if hours <= 0:
+            return False
+        pod["metadata"]["labels"]["time2delete"] = "ttl-%d" % hours
+        requests = pod["spec"]["containers"][0]["resources"]["requests"]
+        reservation = None
+        if int(requests.get("nvidia.com/gpu", 0)):
+            # The notebook's service, secret and ingress are on the current backend, so its pod is too
+            nodes = get_backend_gpu_nodes(
+                product=pod["spec"]["nodeSelector"]["nvidia.com/gpu.product"]
+            )
+            reservation = reservations.reserve(
+                nodes,
+                int(requests["nvidia.com/gpu"]),
+                float(parse_quantity(requests["cpu"])),
+                float(parse_quantity(requests["memory"])) / (1024 * 1024 * 1024),
+                owner=secret.metadata.labels.get("owner"),
+                notebook=id,
+            )
+            if reservation is None:
+                logger.info("No node can host notebook %s right now" % id)
+                return False
+            # Pin the pod to the reserved node, which may not be the node it ran on before
+            node = reservations.get_node(reservation).split("/", 1)[-1]
+            pod["spec"]["nodeSelector"]["kubernetes.io/hostname"] = node
+        try:
+            api.create_namespaced_pod(namespace=backends.current().namespace, body=pod)
+        except Exception:
+            reservations.release(reservation)
+            raise
+        reservations.release(reservation, settle=True)
+        startups.record_deploy(id, pod["spec"]["containers"][0]["image"])
+        quotas.add(
+            id, secret.metadata.labels.get("owner"), *quotas.parse_requests(requests)
+        )
+        api.patch_namespaced_secret(
+            id,
+            backends.current().namespace,
+            body={"metadata": {"labels": {"notebook-state": None}}},
+        )
+        logger.info("Resumed notebook %s" % id)
+        return True
+    except Exception as err:
+        logger.error(str(err))
+        return False
+
+
+@backends.routed
+def get_owner(name):
+    """Returns the username of a notebook's owner, whether the notebook is running or stopped."""
+    pod = get_pod(name.lower())
+    if pod:
+        return pod.metadata.labels.get("owner")
+    try:
+        api = backends.current().core
+        secret = api.read_namespaced_secret(name.lower(), backends.current().namespace)
+        return secret.metadata.labels.get("owner")
+    except Exception:
+        return None
+
+
 def notebook_name_available(name):
-    """Returns a boolean indicating whether a notebook name is available for use."""
-    api = client.CoreV1Api()
+    """Returns a boolean indicating whether a notebook name is available for use on every backend."""
+    return all(backends.fan_out(backend_name_available, name).values())
+
+
+def backend_name_available(name):
+    """Returns a boolean indicating whether a notebook name is available for use on the current backend."""
+    api = backends.current().core
     pods = api.list_namespaced_pod(
-        namespace, field_selector="metadata.name={0}".format(name.lower())
+        backends.current().namespace,
+        field_selector="metadata.name={0}".format(name.lower()),
+    )
+    # A stopped notebook has no pod, but keeps its secret
+    secrets = api.list_namespaced_secret(
+        backends.current().namespace,
+        field_selector="metadata.name={0}".format(name.lower()),
     )
-    return len(pods.items) == 0
+    return len(pods.items) == 0 and len(secrets.items) == 0
 
 
 def generate_notebook_name(owner):
@@ -413,39 +746,27 @@ def supported_images():
     )
 
 
-def get_gpu_availability(product=None, memory=None):
+@singleflight.coalesce
+def get_gpu_nodes(product=None, memory=None):
     """
-    Looks up a GPU product by its product name or memory cache size, and gets its availability.
-    When this function is called without arguments, it gets the availability of every GPU product.
-    Returns a list of dicts.
+    Looks up the Kubernetes nodes that have GPUs, and models the resources that are free on each node.
+    Returns a list of dicts (see capacity.py).
 
     Function parameters:
     (Both parameters are optional.)
 
-    product: (string) The GPU product name
-    memory: (int) The GPU memory cache size in megabytes (e.g. 40536)
+    product: (string) Only nodes with this GPU product are returned
+    memory: (int) Only nodes with this GPU memory cache size in megabytes are returned (e.g. 40536)
+    """
+    gpu_nodes = []
+    for nodes in backends.fan_out(get_backend_gpu_nodes, product, memory).values():
+        gpu_nodes.extend(nodes)
+    return gpu_nodes
 
-    Algorithm for getting GPU availability:
 
-    1. Create a hash map of GPUs grouped by their product name.
-    2. Get a set of Kubernetes nodes that have GPU support.
-        a. If a product name or cache size is specified, get the set of nodes that supports the product.
-        b. If no product name or cache size is specified, get the set of all nodes that are labeled gpu=true.
-    3. Iterate over the set of Kubernetes nodes.
-        a. Get the GPU that is used by the node.
-        b. Update the hash map.
-            i. If the GPU is not in our hash map, add its name, cache size, and count to the hash map.
-            ii. If the GPU is in our hash map, increase its count.
-        b. Get the set of pods running on this node.
-        c. Iterate over the set of pods
-            i. Add up all the pod requests for this GPU
-        d. To calculate availability, subtract the total number of requests for this GPU from the total number of instances
-           <Number of available GPU instances> = <Number of GPU instances> - <Number of GPU requests>
-    4. Get the hash map values as a list. Sort the list. Each entry in the list gives the availability of a unique GPU product.
-       Return the sorted list of dicts.
-    """
-    gpus = dict()
-    api = client.CoreV1Api()
+def get_backend_gpu_nodes(product=None, memory=None):
+    """Models the free resources on each GPU node of the current backend. Takes the same parameters as get_gpu_nodes."""
+    api = backends.current().core
     if product:
         nodes = api.list_node(
             label_selector="gpu=true,nvidia.com/gpu.product=%s" % product
@@ -456,22 +777,8 @@ def get_gpu_availability(product=None, memory=None):
         )
     else:
         nodes = api.list_node(label_selector="nvidia.com/gpu.product")
+    gpu_nodes = []
     for node in nodes.items:
-        product = node.metadata.labels["nvidia.com/gpu.product"]
-        memory = int(node.metadata.labels["nvidia.com/gpu.memory"])
-        count = int(node.metadata.labels["nvidia.com/gpu.count"])
-        if product not in gpus:
-            gpus[product] = dict(
-                mem_request_max=0,
-                cpu_request_max=0,
-                product=product,
-                memory=memory,
-                count=count,
-                total_requests=0,
-            )
-        else:
-            gpus[product]["count"] += count
-        gpu = gpus[product]
         pods = api.list_pod_for_all_namespaces(
             field_selector="spec.nodeName=%s,status.phase!=%s,status.phase!=%s"
             % (node.metadata.name, "Succeeded", "Failed")
@@ -479,38 +786,130 @@ def get_gpu_availability(product=None, memory=None):
         mem_request = 0
         cpu_request = 0
         gpu_request = 0
+        # The notebooks that are counted in the node's requests (see reservations.subtract)
+        notebooks = [
+            pod.metadata.name
+            for pod in pods
+            if (pod.metadata.labels or {}).get("k8s-app") == "jupyterlab"
+        ]
         for pod in pods:
             for container in pod.spec.containers:
                 requests = container.resources.requests
                 if requests:
-                    gpu["total_requests"] += int(requests.get("nvidia.com/gpu", 0))
                     gpu_request += int(requests.get("nvidia.com/gpu", 0))
                     mem_request += parse_quantity(requests.get("memory", 0))
                     cpu_request += parse_quantity(requests.get("cpu", 0))
-        # count in max only when there are at least 1 gpu available. the limitation is this guard is only safe if the requested
-        # gpu is not more than 1.
-        if int(node.status.capacity["nvidia.com/gpu"]) > gpu_request:
-            mem_request_max = math.floor(
-                (parse_quantity(node.status.capacity["memory"]) - mem_request)
-                / (1024 * 1024 * 1024)
-            )
-            cpu_request_max = math.floor(
-                parse_quantity(node.status.capacity["cpu"]) - cpu_request
-            )
-            gpu["mem_request_max"] = (
-                mem_request_max
-                if mem_request_max > gpu["mem_request_max"]
-                else gpu["mem_request_max"]
+        # The scheduler places pods against the allocatable resources, which exclude system reservations
+        allocatable = node.status.allocatable or node.status.capacity
+        gpu_total = int(allocatable.get("nvidia.com/gpu", 0))
+        gpu_nodes.append(
+            dict(
+                name=backends.current().node_name(node.metadata.name),
+                backend=backends.current().name,
+                product=node.metadata.labels["nvidia.com/gpu.product"],
+                memory=int(node.metadata.labels["nvidia.com/gpu.memory"]),
+                # The count, the total and the free GPUs all come from the allocatable resources
+                gpu_count=gpu_total,
+                notebooks=notebooks,
+                gpu_requests=gpu_request,
+                gpu_total=gpu_total,
+                cpu_total=math.floor(parse_quantity(allocatable["cpu"])),
+                mem_total=math.floor(
+                    parse_quantity(allocatable["memory"]) / (1024 * 1024 * 1024)
+                ),
+                gpu_free=max(gpu_total - gpu_request, 0),
+                cpu_free=max(
+                    math.floor(parse_quantity(allocatable["cpu"]) - cpu_request), 0
+                ),
+                mem_free=max(
+                    math.floor(
+                        (parse_quantity(allocatable["memory"]) - mem_request)
+                        / (1024 * 1024 * 1024)
+                    ),
+                    0,
+                ),
             )
-            gpu["cpu_request_max"] = (
-                cpu_request_max
-                if cpu_request_max > gpu["cpu_request_max"]
-                else gpu["cpu_request_max"]
+        )
+    return gpu_nodes
+
+
+@singleflight.coalesce
+def get_gpu_availability(product=None, memory=None, subtract_reservations=True):
+    """
+    Looks up a GPU product by its product name or memory cache size, and gets its availability.
+    When this function is called without arguments, it gets the availability of every GPU product.
+    Returns a list of dicts.
+
+    Function parameters:
+    (All parameters are optional.)
+
+    product: (string) The GPU product name
+    memory: (int) The GPU memory cache size in megabytes (e.g. 40536)
+    subtract_reservations: (boolean) When True (the default), resources reserved for notebooks
+                           that are being deployed are subtracted from the availability
+
+    Algorithm for getting GPU availability:
+
+    1. Model the free resources on each Kubernetes node that has GPU support (see get_gpu_nodes).
+        a. If a product name or cache size is specified, get the set of nodes that supports the product.
+        b. If no product name or cache size is specified, get the set of all nodes that are labeled with a GPU product.
+    2. Subtract the outstanding reservations in the reservation ledger from each node (see reservations.py).
+    3. Create a hash map of GPUs grouped by their product name, and add up the instances and requests on each node.
+       <Number of available GPU instances> = Sum of the free instances of each node, after its requests and reservations
+       The instances and the free instances of a node both come from its allocatable resources.
+       Also add up the total and free CPU cores and memory of the nodes that have the product.
+    4. For each GPU product, find the largest request that fits on a single node (see capacity.py).
+        a. max_gpu_request is the largest number of instances that a single node can host.
+        b. cpu_request_max and mem_request_max are the largest requests that fit on a node with at least 1 free instance.
+        c. largest_fit lists the largest CPU and memory requests for each number of instances.
+    5. Get the hash map values as a list. Sort the list. Each entry in the list gives the availability of a unique GPU product.
+       Return the sorted list of dicts.
+    """
+    nodes = get_gpu_nodes(product=product, memory=memory)
+    if subtract_reservations:
+        nodes = reservations.subtract(nodes)
+    gpus = dict()
+    for node in nodes:
+        product = node["product"]
+        if product not in gpus:
+            gpus[product] = dict(
+                product=product,
+                memory=node["memory"],
+                count=0,
+                total_requests=0,
+                reserved=0,
+                available=0,
+                cpu_total=0,
+                cpu_free=0,
+                mem_total=0,
+                mem_free=0,
+                nodes=[],
             )
-        gpu["available"] = max(gpu["count"] - gpu["total_requests"], 0)
+        gpu = gpus[product]
+        gpu["count"] += node["gpu_count"]
+        gpu["total_requests"] += node["gpu_requests"]
+        gpu["reserved"] += node.get("gpu_reserved", 0)
+        gpu["available"] += node["gpu_free"]
+        for key in ("cpu_total", "cpu_free", "mem_total", "mem_free"):
+            gpu[key] += node[key]
+        gpu["nodes"].append(node)
+    for gpu in gpus.values():
+        largest = capacity.largest_fit(gpu.pop("nodes"))
+        gpu["max_gpu_request"] = largest[-1]["gpu"] if largest else 0
+        gpu["cpu_request_max"] = largest[0]["cpu"] if largest else 0
+        gpu["mem_request_max"] = largest[0]["memory"] if largest else 0
+        gpu["largest_fit"] = largest
     return sorted(gpus.values(), key=lambda gpu: gpu["memory"])
 
 
+gpu_snapshot = snapshots.Snapshot(
+    "gpu_availability",
+    get_gpu_availability,
+    interval=app.config.get("GPU_SNAPSHOT_INTERVAL", 30),
+    max_age=app.config.get("GPU_SNAPSHOT_MAX_AGE", 120),
+)
+
+
 def get_expiration_date(pod):
     """Returns the expiration date of the pod."""
     pattern = re.compile(r"ttl-\d+")
@@ -520,11 +919,14 @@ def get_expiration_date(pod):
     return None
 
 
+@backends.routed
 def get_pod(name):
     """Looks up a Kubernetes pod by its name and returns a pod object."""
     try:
-        api = client.CoreV1Api()
-        return api.read_namespaced_pod(name=name, namespace=namespace)
+        api = backends.current().core
+        return api.read_namespaced_pod(
+            name=name, namespace=backends.current().namespace
+        )
     except Exception:
         return None
 
@@ -0,0 +1,182 @@
+"""
+Builds the Kubernetes manifests of a notebook (pod, service, secret, ingress and persistent volume claim).
+
+The manifests are written as Jinja templates in portal/templates/jupyterlab. Rendering a template to text and
+parsing the text back with yaml.safe_load costs a few milliseconds per manifest, on every deploy.
+Instead, each template is compiled once, when this module is imported: it is rendered with a placeholder
+for each setting and parsed into a skeleton (the dicts and lists of the manifest). Building a manifest
+walks the skeleton and fills in the settings, which is a plain copy of a few dozen dicts.
+
+A template with {% if %} blocks is compiled once for each combination of the conditions (e.g. pod.yaml has
+a GPU and a CPU variant), and the variant is chosen by the truthiness of the settings.
+A setting that makes up a whole (unquoted) YAML value keeps its Python type, e.g. cpu_request: 4 is an integer.
+A setting inside a larger string, or inside quotes, is formatted as a string, as Jinja would.
+
+The settings are validated before a manifest is built: every setting of the template is required,
+and the names and resource quantities must be well-formed. An invalid setting raises InvalidParameter,
+and a missing setting raises MissingParameter (see errors.py).
+
+Functionality:
+===============
+
+1. The build function builds a manifest from its template and the settings
+
+Dependencies:
+===============
+
+The templates in portal/templates/jupyterlab
+
+Example usage:
+===============
+
+cd <path>/<to>/af-portal
+python
+>>> from portal import manifests
+>>> manifests.build('service', notebook_id='mynotebook', namespace='af-jupyter')
+"""
+
+import itertools
+import os
+import re
+import yaml
+from jinja2 import Environment, FileSystemLoader
+from portal.errors import InvalidParameter, MissingParameter
+
+template_dir = os.path.join(os.path.dirname(__file__), "templates", "jupyterlab")
+placeholder_pattern = re.compile(r"__tpl_([a-z0-9_]+?)__")
+variable_pattern = re.compile(r"{{\s*(\w+)\s*}}")
+condition_pattern = re.compile(r"{%\s*if\s+(\w+)\s*%}")
+
+dns_label = re.compile(r"^[a-z0-9]([-a-z0-9]*[a-z0-9])?$")
+memory_quantity = re.compile(r"^[0-9]+(\.[0-9]+)?(Ki|Mi|Gi|Ti|K|M|G|T)?$")
+
+# The checks of each setting that has a constraint, and the message of a setting that fails its check
+validators = dict(
+    notebook_id=(
+        lambda v: isinstance(v, str) and len(v) <= 63 and dns_label.match(v),
+        "a DNS label of at most 63 characters",
+    ),
+    namespace=(
+        lambda v: isinstance(v, str) and dns_label.match(v),
+        "a DNS label",
+    ),
+    cpu_request=(lambda v: isinstance(v, (int, float)) and v > 0, "a positive number"),
+    cpu_limit=(lambda v: isinstance(v, (int, float)) and v > 0, "a positive number"),
+    gpu_request=(lambda v: isinstance(v, int) and v >= 0, "a whole number"),
+    gpu_limit=(lambda v: isinstance(v, int) and v >= 0, "a whole number"),
+    memory_request=(
+        lambda v: isinstance(v, str) and memory_quantity.match(v),
+        "a memory quantity (e.g. 4Gi)",
+    ),
+    memory_limit=(
+        lambda v: isinstance(v, str) and memory_quantity.match(v),
+        "a memory quantity (e.g. 4Gi)",
+    ),
+    hours_remaining=(lambda v: isinstance(v, int) and v >= 0, "a whole number"),
+)
+
+
+class Placeholder(str):
+    """The value of a setting while a template is compiled: renders as a marker, and has the truthiness of a variant."""
+
+    def __new__(cls, name, truthy=True):
+        placeholder = super().__new__(cls, "__tpl_%s__" % name)
+        placeholder.truthy = truthy
+        return placeholder
+
+    def __bool__(self):
+        return self.truthy
+
+
+class Field:
+    """A value of a skeleton that is filled in from the settings."""
+
+    def __init__(self, text, quoted):
+        self.parts = placeholder_pattern.split(text)
+        # A whole, unquoted value keeps the type of the setting
+        self.whole = not quoted and len(self.parts) == 3 and not any(self.parts[::2])
+
+    def fill(self, settings):
+        if self.whole:
+            return settings[self.parts[1]]
+        return "".join(
+            part if i % 2 == 0 else str(settings[part])
+            for i, part in enumerate(self.parts)
+        )
+
+
+class Manifest:
+    """A compiled template: a skeleton for each variant, and the settings that the template uses."""
+
+    def __init__(self, environment, filename):
+        source = environment.loader.get_source(environment, filename)[0]
+        self.conditions = sorted(set(condition_pattern.findall(source)))
+        # Jinja's find_undeclared_variables would leave out settings named after Jinja globals (e.g. namespace)
+        self.settings = sorted(
+            set(variable_pattern.findall(source)) | set(self.conditions)
+        )
+        quoted = set(re.findall(r"[\"']{{\s*(\w+)\s*}}[\"']", source))
+        template = environment.get_template(filename)
+        self.variants = {}
+        for truthiness in itertools.product((True, False), repeat=len(self.conditions)):
+            values = {name: Placeholder(name) for name in self.settings}
+            for name, truthy in zip(self.conditions, truthiness):
+                values[name] = Placeholder(name, truthy)
+            skeleton = yaml.safe_load(template.render(**values))
+            self.variants[truthiness] = compile_skeleton(skeleton, quoted)
+
+    def build(self, settings):
+        missing = [name for name in self.settings if name not in settings]
+        if missing:
+            raise MissingParameter(", ".join(missing))
+        for name in self.settings:
+            if name in validators and not validators[name][0](settings[name]):
+                raise InvalidParameter(
+                    "%s must be %s, not %r"
+                    % (name, validators[name][1], settings[name])
+                )
+        truthiness = tuple(bool(settings[name]) for name in self.conditions)
+        return fill(self.variants[truthiness], settings)
+
+
+def compile_skeleton(node, quoted):
+    """Replaces the strings of a parsed template that contain placeholders with fields."""
+    if isinstance(node, dict):
+        return {key: compile_skeleton(value, quoted) for key, value in node.items()}
+    if isinstance(node, list):
+        return [compile_skeleton(value, quoted) for value in node]
+    if isinstance(node, str) and placeholder_pattern.search(node):
+        names = placeholder_pattern.findall(node)
+        return Field(node, quoted=any(name in quoted for name in names))
+    return node
+
+
+def fill(node, settings):
+    """Returns a copy of a skeleton with its fields filled in from the settings."""
+    if isinstance(node, dict):
+        return {key: fill(value, settings) for key, value in node.items()}
+    if isinstance(node, list):
+        return [fill(value, settings) for value in node]
+    if isinstance(node, Field):
+        return node.fill(settings)
+    return node
+
+
+environment = Environment(loader=FileSystemLoader(template_dir))
+compiled = {
+    filename[: -len(".yaml")]: Manifest(environment, filename)
+    for filename in sorted(os.listdir(template_dir))
+    if filename.endswith(".yaml")
+}
+
+
+def build(kind, **settings):
+    """
+    Builds a manifest. Returns a dict that can be passed to the Kubernetes API as the body of a create call.
+
+    Function parameters:
+
+    kind: (string) The name of the template, i.e. "pod", "service", "secret", "ingress" or "pvc"
+    settings: The settings of the notebook (see jupyterlab.deploy_notebook). Settings that the template does not use are ignored.
+    """
+    return compiled[kind].build(settings)
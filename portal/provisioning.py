@@ -0,0 +1,322 @@
+"""
+Bulk provisioning of notebooks for workshops and tutorials.
+
+An admin submits a list of users (or a group, whose members are looked up with connect.get_usernames)
+and one notebook template (image, CPUs, memory, GPUs and duration). The template is validated once,
+and the capacity check places every GPU notebook of the job on the cluster before anything is deployed.
+The notebooks are then deployed in the background by a bounded pool of worker threads.
+A failed deployment is cleaned up (see jupyterlab.deploy_notebook) and retried with a backoff.
+The job's report shows the progress and the status of each notebook.
+
+Each notebook is named <prefix>-<username>. A user who already has a notebook with that name is skipped,
+and so is a user whose quota cannot hold the notebook (see quotas.py).
+Jobs are kept in memory, in the process that runs the portal. Finished jobs are kept for JOB_RETENTION seconds,
+and at most MAX_JOBS of them are kept.
+
+Functionality:
+===============
+
+1. The provision function validates a template and starts a job that deploys one notebook for each user
+2. The get_job function returns the progress and status report of a job
+3. The list_jobs function returns the reports of all jobs
+
+Dependencies:
+===============
+
+A portal.conf file with the following optional settings:
+
+PROVISION_WORKERS: (int) The number of notebooks that are deployed at the same time. The default is 8.
+PROVISION_RETRIES: (int) How many times a failed deployment is retried. The default is 2.
+PROVISION_JOB_RETENTION: (int) How long (in seconds) the report of a finished job is kept. The default is 86400.
+PROVISION_MAX_JOBS: (int) The max number of finished jobs that are kept. The default is 100.
+
+Example usage:
+===============
+
+cd <path>/<to>/af-portal
+python
+>>> from portal import provisioning
+>>> template = dict(image='hub.opensciencegrid.org/usatlas/ml-platform:latest', cpu=2, memory=8, gpu=0, gpu_product='', hours=8)
+>>> job = provisioning.provision(['user1', 'user2'], template, prefix='tutorial', submitted_by='myusername')
+>>> provisioning.get_job(job['id'])
+"""
+
+import copy
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from kubernetes.client.exceptions import ApiException
+from portal import backends, capacity, connect, jupyterlab, quotas, reservations
+from portal.app import app, logger
+from portal.errors import InsufficientCapacityError, InvalidFormError
+
+workers = app.config.get("PROVISION_WORKERS", 8)
+retries = app.config.get("PROVISION_RETRIES", 2)
+job_retention = app.config.get("PROVISION_JOB_RETENTION", 86400)
+max_jobs = app.config.get("PROVISION_MAX_JOBS", 100)
+# The longest duration (in hours) of a notebook, as in jupyterlab.deploy_notebook
+max_hours = 168
+# How long (in seconds) to wait before the first retry. The wait doubles after every retry.
+backoff = 5
+
+jobs = {}
+lock = threading.Lock()
+executor = ThreadPoolExecutor(max_workers=workers)
+
+
+def validate_template(template):
+    """Validates a notebook template, and returns it with integer fields. Raises InvalidFormError."""
+    try:
+        template = dict(
+            image=template["image"],
+            cpu=int(template["cpu"]),
+            memory=int(template["memory"]),
+            gpu=int(template.get("gpu", 0)),
+            gpu_product=template.get("gpu_product", ""),
+            hours=int(template["hours"]),
+        )
+    except (KeyError, TypeError, ValueError) as err:
+        raise InvalidFormError("Invalid notebook template: %s" % str(err)) from err
+    if template["image"] not in jupyterlab.supported_images():
+        raise InvalidFormError("Docker image %s is not supported." % template["image"])
+    if template["cpu"] < 1 or template["cpu"] > 16:
+        raise InvalidFormError("Requests must be between 1 and 16 CPUs.")
+    if template["memory"] < 1 or template["memory"] > 256:
+        raise InvalidFormError("Requests must be between 1 and 256 GB RAM.")
+    if template["gpu"] < 0 or template["gpu"] > 7:
+        raise InvalidFormError("Requests must be between 0 and 7 GPUs")
+    if template["hours"] < 1 or template["hours"] > max_hours:
+        raise InvalidFormError(
+            "The duration must be between 1 and %d hours." % max_hours
+        )
+    return template
+
+
+def check_capacity(template, count):
+    """
+    Checks that the cluster can host a number of GPU notebooks at once, by placing them one by one on the nodes
+    that fit them best. Raises InsufficientCapacityError. Notebooks without GPUs are not checked.
+    """
+    if not template["gpu"]:
+        return
+    nodes = jupyterlab.get_gpu_nodes(product=template["gpu_product"])
+    if not nodes:
+        raise InvalidFormError(
+            "The GPU product %s is not supported." % template["gpu_product"]
+        )
+    net = reservations.subtract(nodes)
+    for placed in range(count):
+        hosts = capacity.fit(net, template["gpu"], template["cpu"], template["memory"])
+        if not hosts:
+            raise InsufficientCapacityError(
+                "Only %d of the %d notebooks with %d x %s fit on the cluster right now."
+                % (placed, count, template["gpu"], template["gpu_product"])
+            )
+        node = next(node for node in net if node["name"] == hosts[0])
+        node["gpu_free"] -= template["gpu"]
+        node["cpu_free"] -= template["cpu"]
+        node["mem_free"] -= template["memory"]
+
+
+def provision(usernames, template, prefix, submitted_by=None):
+    """
+    Validates a template and the cluster's capacity, and starts a job that deploys one notebook for each user.
+    Returns the job's report as a dict. Raises InvalidFormError (or InsufficientCapacityError) when the job cannot run.
+
+    Function parameters:
+
+    usernames: (list) The usernames of the notebooks' owners
+    template: (dict) The image, cpu, memory, gpu, gpu_product and hours of the notebooks
+    prefix: (string) The notebooks are named <prefix>-<username>
+    submitted_by: (string) The username of the admin who submitted the job
+    """
+    template = validate_template(template)
+    usernames = sorted(set(usernames))
+    if not usernames:
+        raise InvalidFormError("There are no users to provision notebooks for.")
+    check_capacity(template, len(usernames))
+    job = dict(
+        id=uuid.uuid4().hex,
+        submitted_by=submitted_by,
+        template=template,
+        status="running",
+        created_at=time.time(),
+        finished_at=None,
+        notebooks=[
+            dict(
+                owner=username,
+                notebook_id=jupyterlab.sanitize_k8s_pod_name(
+                    "%s-%s" % (prefix, username)
+                ),
+                status="pending",
+                attempts=0,
+                message=None,
+            )
+            for username in usernames
+        ],
+    )
+    with lock:
+        prune_jobs()
+        jobs[job["id"]] = job
+    logger.info(
+        "Provisioning %d notebooks for job %s submitted by %s"
+        % (len(usernames), job["id"], submitted_by)
+    )
+    futures = [executor.submit(deploy, job, notebook) for notebook in job["notebooks"]]
+    threading.Thread(target=wait, args=(job, futures), daemon=True).start()
+    return get_job(job["id"])
+
+
+def deploy(job, notebook):
+    """Deploys one notebook of a job, and retries it when the deployment fails."""
+    template = job["template"]
+    try:
+        if not jupyterlab.notebook_name_available(notebook["notebook_id"]):
+            set_status(notebook, "skipped", "The notebook already exists.")
+            return
+        profile = connect.get_user_profile(notebook["owner"])
+        if profile is None:
+            set_status(notebook, "failed", "The user does not exist.")
+            return
+        settings = dict(
+            notebook_name=notebook["notebook_id"],
+            notebook_id=notebook["notebook_id"],
+            image=template["image"],
+            owner=profile["unix_name"],
+            owner_uid=profile["unix_id"],
+            globus_id=profile.get("globus_id") or "none",
+            cpu_request=template["cpu"],
+            cpu_limit=template["cpu"] * 2,
+            memory_request="%dGi" % template["memory"],
+            memory_limit="%dGi" % (template["memory"] * 2),
+            gpu_request=template["gpu"],
+            gpu_limit=template["gpu"],
+            gpu_product=template["gpu_product"],
+            hours_remaining=template["hours"],
+        )
+        message = quotas.check(
+            settings["owner"],
+            template["cpu"],
+            template["memory"],
+            template["gpu"],
+            hold=notebook["notebook_id"],
+        )
+        if message:
+            set_status(notebook, "skipped", message)
+            return
+    except Exception as err:
+        set_status(notebook, "failed", str(err))
+        return
+    try:
+        attempt_deploy(notebook, template, settings)
+    finally:
+        # A deployed notebook holds its resources in the quota index from now on
+        quotas.release(notebook["notebook_id"])
+
+
+def attempt_deploy(notebook, template, settings):
+    """Deploys a notebook with the given settings, and retries it up to PROVISION_RETRIES times."""
+    for attempt in range(retries + 1):
+        with lock:
+            notebook["status"] = "deploying"
+            notebook["attempts"] = attempt + 1
+        reservation = None
+        try:
+            if template["gpu"]:
+                nodes = jupyterlab.get_gpu_nodes(product=template["gpu_product"])
+                reservation = reservations.reserve(
+                    nodes,
+                    template["gpu"],
+                    template["cpu"],
+                    template["memory"],
+                    owner=settings["owner"],
+                    notebook=notebook["notebook_id"],
+                )
+                if reservation is None:
+                    raise InsufficientCapacityError(
+                        "The %s is currently not available" % template["gpu_product"]
+                    )
+            # deploy_notebook adds keys to the settings, so every attempt gets a copy
+            node = reservations.get_node(reservation)
+            jupyterlab.deploy_notebook(
+                backend=backends.of_node(node).name,
+                gpu_node=node,
+                **copy.deepcopy(settings),
+            )
+            reservations.release(reservation, settle=True)
+            set_status(notebook, "deployed")
+            return
+        except Exception as err:
+            reservations.release(reservation)
+            # The notebook was created by someone else after the name was checked, and it is left alone
+            if isinstance(err, ApiException) and err.status == 409:
+                set_status(notebook, "skipped", "The notebook already exists.")
+                return
+            logger.error(
+                "Unable to provision notebook %s (attempt %d): %s"
+                % (notebook["notebook_id"], attempt + 1, str(err))
+            )
+            # deploy_notebook deleted the objects it created, so the next attempt starts clean
+            if attempt < retries:
+                set_status(notebook, "retrying", str(err))
+                time.sleep(backoff * 2**attempt)
+            else:
+                set_status(notebook, "failed", str(err))
+
+
+def set_status(notebook, status, message=None):
+    with lock:
+        notebook["status"] = status
+        notebook["message"] = message
+
+
+def prune_jobs():
+    """Drops the finished jobs that are older than JOB_RETENTION, and the oldest ones beyond MAX_JOBS. Call with the lock held."""
+    now = time.time()
+    finished = sorted(
+        (job for job in jobs.values() if job["finished_at"] is not None),
+        key=lambda job: job["finished_at"],
+        reverse=True,
+    )
+    for i, job in enumerate(finished):
+        if i >= max_jobs or now - job["finished_at"] > job_retention:
+            del jobs[job["id"]]
+
+
+def wait(job, futures):
+    """Marks a job as finished when all of its notebooks have been deployed or have failed."""
+    for future in futures:
+        future.exception()
+    with lock:
+        job["status"] = "finished"
+        job["finished_at"] = time.time()
+    report = get_job(job["id"])
+    logger.info("Finished provisioning job %s: %s" % (job["id"], report["counts"]))
+
+
+def get_job(job_id):
+    """Returns the progress and status report of a job, or None when the job does not exist."""
+    with lock:
+        job = jobs.get(job_id)
+        if job is None:
+            return None
+        report = copy.deepcopy(job)
+    counts = {}
+    for notebook in report["notebooks"]:
+        counts[notebook["status"]] = counts.get(notebook["status"], 0) + 1
+    report["counts"] = counts
+    report["total"] = len(report["notebooks"])
+    report["done"] = sum(
+        counts.get(status, 0) for status in ("deployed", "skipped", "failed")
+    )
+    return report
+
+
+def list_jobs():
+    """Returns the reports of all jobs, the most recent first."""
+    with lock:
+        job_ids = sorted(
+            jobs, key=lambda job_id: jobs[job_id]["created_at"], reverse=True
+        )
+    return [get_job(job_id) for job_id in job_ids]
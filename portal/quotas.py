@@ -0,0 +1,286 @@
+"""
+Per-group quotas on the notebooks, CPUs, memory and GPUs that a user can hold at the same time.
+
+The quotas are set for each group in portal.conf. A user gets the most generous limit of each resource
+among the groups they are an active member of, and the "default" quota otherwise.
+A resource without a limit is not limited.
+
+The resources held by each user are kept in an in-memory owner index, which is updated when a notebook is
+deployed, stopped, resumed or removed. Checking a request against the index takes constant time, and the groups
+of each user are cached for QUOTA_GROUP_TTL seconds, so that a check does not call the Connect API.
+A request that fits is held in the index by check, under the same lock, so that two concurrent requests cannot
+both fit in the space that is left for one. The hold becomes the notebook's entry when the notebook is added,
+and the caller gives it back with release when the notebook is not deployed.
+The index is rebuilt from the running notebook pods on an interval, which corrects it for changes made outside
+of this process (e.g. by another worker, or with kubectl). The holds, and the changes made to the index while
+the pods are listed, are kept by the rebuild. Stopped notebooks do not hold any resources.
+
+Functionality:
+===============
+
+1. The get_limits function returns the quota of a user, from the groups they belong to (see get_groups)
+2. The check function returns why a request would exceed a user's quota, or None when it fits (and holds it)
+3. The add and remove functions update the owner index when a notebook starts or stops holding resources
+   and the release function gives back a hold that did not become a notebook
+4. The get_usage function returns the resources held by a user
+5. The start_quota_index function starts a thread that rebuilds the owner index on an interval
+
+Dependencies:
+===============
+
+A portal.conf file with the following optional setting:
+
+QUOTAS: (dict) The quota of each group, and a "default" quota, e.g.
+        {"default": {"notebooks": 2, "cpu": 16, "memory": 64, "gpu": 1},
+         "root.atlas-af.bigmem": {"memory": 512},
+         "root.atlas-af.gpu": {"notebooks": 4, "gpu": 4}}
+        Users are not limited when QUOTAS is empty.
+QUOTA_GROUP_TTL: (int) How long (in seconds) the groups of a user are cached. The default is 300.
+
+Example usage:
+===============
+
+cd <path>/<to>/af-portal
+python
+>>> from portal import quotas
+>>> quotas.rebuild()
+>>> quotas.get_usage('myusername')
+>>> quotas.check('myusername', cpu=4, memory=16, gpu=1)
+>>> quotas.check('myusername', cpu=4, memory=16, gpu=1, hold='mynotebook')
+>>> quotas.release('mynotebook')
+"""
+
+import threading
+import time
+from kubernetes.utils.quantity import parse_quantity
+from portal import backends, connect
+from portal.app import app, logger
+
+quotas = app.config.get("QUOTAS", {})
+resources = ("notebooks", "cpu", "memory", "gpu")
+# How often (in seconds) the owner index is rebuilt from the running notebook pods
+interval = 300
+group_ttl = app.config.get("QUOTA_GROUP_TTL", 300)
+
+# Maps each notebook to its owner and the resources it holds
+notebooks = {}
+# Maps each owner to the sum of the resources held by their notebooks
+owners = {}
+# The names of the notebooks that check holds resources for, until they are added or released
+holds = set()
+# The names added or removed while a rebuild lists the pods, one set for each rebuild in progress
+changes = []
+# Maps each username to a tuple (time fetched, the names of the user's groups)
+groups_cache = {}
+lock = threading.Lock()
+built = False
+started = False
+
+
+def get_limits(groups):
+    """
+    Returns a dict with the limit of each resource for a member of the given groups.
+    A resource that is missing from the dict is not limited.
+
+    Function parameters:
+
+    groups: (list) The names of the groups that the user is an active member of
+    """
+    limits = dict(quotas.get("default", {}))
+    for group in groups:
+        for resource, limit in quotas.get(group, {}).items():
+            limits[resource] = max(limits.get(resource, limit), limit)
+    return limits
+
+
+def get_usage(owner):
+    """Returns a dict with the number of notebooks, CPUs, memory (GB) and GPUs held by a user."""
+    if not built:
+        rebuild()
+    with lock:
+        return dict(owners.get(owner) or dict.fromkeys(resources, 0))
+
+
+def check(owner, cpu, memory, gpu, groups=None, hold=None):
+    """
+    Checks a notebook request against a user's quota. Returns a message that explains which limit the request
+    would exceed, or None when the request fits in the quota.
+
+    Function parameters:
+
+    owner: (string) The username of the user making the request
+    cpu: (number) The number of CPU cores requested
+    memory: (number) The amount of memory requested in GB
+    gpu: (integer) The number of GPU instances requested
+    groups: (list) The names of the groups that the user is an active member of. When groups is None, they are looked up.
+    hold: (string) The name of the notebook. When the request fits, its resources are held under this name
+          until the notebook is added (see add), or the hold is given back (see release).
+    """
+    if not quotas:
+        return None
+    if groups is None:
+        groups = get_groups(owner)
+    limits = get_limits(groups)
+    if not built:
+        rebuild()
+    request = dict(notebooks=1, cpu=cpu, memory=memory, gpu=gpu)
+    units = dict(notebooks="notebooks", cpu="CPUs", memory="GB of memory", gpu="GPUs")
+    with lock:
+        usage = owners.get(owner) or dict.fromkeys(resources, 0)
+        for resource in resources:
+            if resource not in limits or not request[resource]:
+                continue
+            if usage[resource] + request[resource] > limits[resource]:
+                return (
+                    "Your quota allows %s %s at a time, and your notebooks already hold %s."
+                    % (
+                        limits[resource],
+                        units[resource],
+                        usage[resource],
+                    )
+                )
+        if hold is not None:
+            add_locked(hold, owner, cpu, memory, gpu)
+            holds.add(hold)
+    return None
+
+
+def add(name, owner, cpu, memory, gpu):
+    """Adds a notebook's resources to its owner's usage. A notebook that is already in the index is replaced."""
+    with lock:
+        add_locked(name, owner, cpu, memory, gpu)
+
+
+def add_locked(name, owner, cpu, memory, gpu):
+    remove_locked(name)
+    notebooks[name] = (owner, dict(notebooks=1, cpu=cpu, memory=memory, gpu=gpu))
+    usage = owners.setdefault(owner, dict.fromkeys(resources, 0))
+    for resource, amount in notebooks[name][1].items():
+        usage[resource] += amount
+    for changed in changes:
+        changed.add(name)
+
+
+def remove(name):
+    """Removes a notebook's resources from its owner's usage. Does nothing when the notebook is not in the index."""
+    with lock:
+        remove_locked(name)
+
+
+def release(name):
+    """Gives back the resources held by check for a notebook. Does nothing when the notebook has been added since."""
+    with lock:
+        if name in holds:
+            remove_locked(name)
+
+
+def remove_locked(name):
+    holds.discard(name)
+    for changed in changes:
+        changed.add(name)
+    if name not in notebooks:
+        return
+    owner, held = notebooks.pop(name)
+    usage = owners[owner]
+    for resource, amount in held.items():
+        usage[resource] -= amount
+    if not usage["notebooks"]:
+        del owners[owner]
+
+
+def get_groups(username):
+    """
+    Returns the names of the groups that a user is an active member (or admin) of.
+    The groups are cached for QUOTA_GROUP_TTL seconds.
+    """
+    with lock:
+        entry = groups_cache.get(username)
+    if entry and time.time() - entry[0] < group_ttl:
+        return entry[1]
+    roles = connect.get_user_roles(username) or {}
+    groups = [group for group, role in roles.items() if role in ("active", "admin")]
+    with lock:
+        groups_cache[username] = (time.time(), groups)
+    return groups
+
+
+def parse_requests(requests):
+    """Returns a tuple (cpu, memory, gpu) from the resource requests of a notebook container, with memory in GB."""
+    requests = requests or {}
+    cpu = float(parse_quantity(requests.get("cpu", 0)))
+    memory = float(parse_quantity(requests.get("memory", 0))) / (1024 * 1024 * 1024)
+    gpu = int(requests.get("nvidia.com/gpu", 0))
+    return cpu, memory, gpu
+
+
+def list_notebook_pods():
+    backend = backends.current()
+    return backend.core.list_namespaced_pod(
+        backend.namespace, label_selector="k8s-app=jupyterlab"
+    ).items
+
+
+def rebuild():
+    """
+    Rebuilds the owner index from the notebook pods that are running or starting.
+    The holds, and the notebooks added or removed while the pods are listed, are kept as they are in the index.
+    """
+    global built
+    changed = set()
+    with lock:
+        changes.append(changed)
+    try:
+        pods = [
+            pod
+            for pods in backends.fan_out(list_notebook_pods).values()
+            for pod in pods
+        ]
+    except Exception:
+        with lock:
+            changes[:] = [c for c in changes if c is not changed]
+        raise
+    index = {}
+    for pod in pods:
+        if pod.metadata.deletion_timestamp is not None:
+            continue
+        owner = pod.metadata.labels.get("owner")
+        cpu, memory, gpu = parse_requests(pod.spec.containers[0].resources.requests)
+        index[pod.metadata.name] = (
+            owner,
+            dict(notebooks=1, cpu=cpu, memory=memory, gpu=gpu),
+        )
+    with lock:
+        changes[:] = [c for c in changes if c is not changed]
+        for name in changed | holds:
+            if name in notebooks:
+                index[name] = notebooks[name]
+            else:
+                index.pop(name, None)
+        notebooks.clear()
+        owners.clear()
+        for name, (owner, held) in index.items():
+            notebooks[name] = (owner, held)
+            usage = owners.setdefault(owner, dict.fromkeys(resources, 0))
+            for resource, amount in held.items():
+                usage[resource] += amount
+        built = True
+
+
+def start_quota_index():
+    """Starts a thread that rebuilds the owner index on an interval. Does nothing when quotas are disabled or it has already started."""
+    global started
+    with lock:
+        if started or not quotas:
+            return
+        started = True
+
+    def inner():
+        while True:
+            try:
+                rebuild()
+            except Exception as err:
+                logger.error("Unable to rebuild the quota index: %s" % str(err))
+            time.sleep(interval)
+
+    threading.Thread(target=inner, daemon=True).start()
+    logger.info("Started quota index")
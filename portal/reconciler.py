@@ -0,0 +1,203 @@
+"""
+Finds and cleans up orphaned notebook resources, and the label drift between a notebook's resources.
+
+A notebook is made of a pod, a service, a secret and an ingress with the same name. A failed deploy or removal
+can leave some of them behind, e.g. an ingress and a secret without a pod, which are never removed since
+the maintenance thread only looks at pods. The reconciler lists each of the four kinds once per cycle
+(4 list calls per backend, however many notebooks there are), joins them by name in memory, and finds:
+
+orphans: a service, secret or ingress of a notebook that has no pod and is not stopped (see jupyterlab.stop_notebook)
+drift: a notebook resource whose owner label disagrees with the owner of the notebook's pod
+
+Orphans are deleted, and drifted labels are patched to match the pod, with a bounded number of concurrent API calls.
+Resources younger than a grace period are left alone, since a deploy creates the pod before the other resources.
+In a dry run, the reconciler only reports what it would do.
+
+Functionality:
+===============
+
+1. The reconcile function finds (and unless dry_run is True, cleans up) orphans and drift on every backend
+2. The start_reconciler function starts a thread that reconciles on an interval
+
+Dependencies:
+===============
+
+A portal.conf file with the following optional settings:
+
+RECONCILE_INTERVAL: (int) How often (in seconds) the reconciler runs. The default is 3600.
+RECONCILE_GRACE: (int) How old (in seconds) a resource must be before it can be an orphan. The default is 600.
+RECONCILE_WORKERS: (int) The max number of concurrent delete and patch calls on each backend. The default is 4.
+RECONCILE_DRY_RUN: (boolean) When True, the reconciler thread only reports orphans and drift. The default is True.
+
+Example usage:
+===============
+
+cd <path>/<to>/af-portal
+python
+>>> from portal import reconciler
+>>> reconciler.reconcile(dry_run=True)
+"""
+
+import datetime
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from kubernetes.client.exceptions import ApiException
+from portal import backends
+from portal.app import app, logger
+
+interval = app.config.get("RECONCILE_INTERVAL", 3600)
+grace = app.config.get("RECONCILE_GRACE", 600)
+workers = app.config.get("RECONCILE_WORKERS", 4)
+default_dry_run = app.config.get("RECONCILE_DRY_RUN", True)
+
+lock = threading.Lock()
+started = False
+
+
+def list_resources():
+    """Returns a dict with the notebook pods, services, secrets and ingresses of the current backend, each by name."""
+    backend = backends.current()
+    selector = "k8s-app=jupyterlab"
+    lists = dict(
+        pod=backend.core.list_namespaced_pod,
+        service=backend.core.list_namespaced_service,
+        secret=backend.core.list_namespaced_secret,
+        ingress=backend.networking.list_namespaced_ingress,
+    )
+    return {
+        kind: {
+            item.metadata.name: item
+            for item in fn(backend.namespace, label_selector=selector).items
+        }
+        for kind, fn in lists.items()
+    }
+
+
+def find_problems(resources, now=None):
+    """
+    Joins the resources of a backend by name. Returns a tuple (orphans, drift):
+    orphans is a list of dicts with the kind and the name of each orphaned resource,
+    and drift is a list of dicts with the kind, name, label, expected value and actual value of each drifted label.
+    """
+    now = now or datetime.datetime.now(datetime.timezone.utc)
+    pods = resources["pod"]
+    stopped = {
+        name
+        for name, secret in resources["secret"].items()
+        if (secret.metadata.labels or {}).get("notebook-state") == "stopped"
+    }
+    orphans = []
+    drift = []
+    for kind in ("service", "secret", "ingress"):
+        for name, item in resources[kind].items():
+            labels = item.metadata.labels or {}
+            if name in pods:
+                owner = pods[name].metadata.labels.get("owner")
+                if "owner" in labels and labels["owner"] != owner:
+                    drift.append(
+                        dict(
+                            kind=kind,
+                            name=name,
+                            label="owner",
+                            expected=owner,
+                            actual=labels["owner"],
+                        )
+                    )
+                continue
+            if name in stopped or item.metadata.deletion_timestamp is not None:
+                continue
+            created = item.metadata.creation_timestamp
+            if created and (now - created).total_seconds() < grace:
+                continue
+            orphans.append(dict(kind=kind, name=name, owner=labels.get("owner")))
+    return orphans, drift
+
+
+def fix(problem):
+    """Deletes an orphaned resource, or patches a drifted label. Returns None, or an error message."""
+    backend = backends.current()
+    apis = dict(
+        service=(
+            backend.core.delete_namespaced_service,
+            backend.core.patch_namespaced_service,
+        ),
+        secret=(
+            backend.core.delete_namespaced_secret,
+            backend.core.patch_namespaced_secret,
+        ),
+        ingress=(
+            backend.networking.delete_namespaced_ingress,
+            backend.networking.patch_namespaced_ingress,
+        ),
+    )
+    delete, patch = apis[problem["kind"]]
+    try:
+        if "label" in problem:
+            body = {"metadata": {"labels": {problem["label"]: problem["expected"]}}}
+            patch(problem["name"], backend.namespace, body=body)
+        else:
+            delete(problem["name"], backend.namespace)
+        return None
+    except ApiException as e:
+        if e.status == 404:
+            return None
+        return "%s %s: %s" % (problem["kind"], problem["name"], e.reason)
+    except Exception as err:
+        return "%s %s: %s" % (problem["kind"], problem["name"], str(err))
+
+
+def reconcile_backend(dry_run):
+    """Finds (and unless dry_run is True, cleans up) the orphans and drift of the current backend."""
+    backend = backends.current()
+    orphans, drift = find_problems(list_resources())
+    errors = []
+    if not dry_run and (orphans or drift):
+
+        def call(problem):
+            with backends.use(backend):
+                return fix(problem)
+
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            errors = [err for err in executor.map(call, orphans + drift) if err]
+        for err in errors:
+            logger.error("Unable to reconcile %s" % err)
+    if orphans or drift:
+        logger.info(
+            "%s %d orphaned resources and %d drifted labels on backend %s"
+            % (
+                "Found" if dry_run else "Reconciled",
+                len(orphans),
+                len(drift),
+                backend.name,
+            )
+        )
+    return dict(orphans=orphans, drift=drift, errors=errors)
+
+
+def reconcile(dry_run=True):
+    """
+    Finds orphaned notebook resources and drifted labels on every backend, and cleans them up unless dry_run is True.
+    Returns a dict with the orphans, drift and errors of each backend.
+    """
+    return dict(dry_run=dry_run, backends=backends.fan_out(reconcile_backend, dry_run))
+
+
+def start_reconciler():
+    """Starts a thread that reconciles on an interval. Does nothing when it has already started."""
+    global started
+    with lock:
+        if started:
+            return
+        started = True
+
+    def inner():
+        while True:
+            time.sleep(interval)
+            try:
+                reconcile(dry_run=default_dry_run)
+            except Exception as err:
+                logger.error("Unable to reconcile notebook resources: %s" % str(err))
+
+    threading.Thread(target=inner, daemon=True).start()
+    logger.info("Started notebook resource reconciler")
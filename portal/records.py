@@ -0,0 +1,219 @@
+"""
+Compact record types for the users, group memberships and groups returned by the Connect API (see connect.py).
+
+A profile used to be a fresh dict with a dozen keys, which costs several hundred bytes per user;
+listing the root group keeps tens of thousands of them alive during a request. The records store their fields
+in __slots__, and role strings are interned, so that the profiles of a large group share one copy of each role.
+A profile built from a full user record also keeps a map from each of the user's groups to the user's role.
+
+The records can be read like the dicts they replace (profile["email"], profile.get("phone"), "totp_secret" in profile),
+and a field that was not set raises KeyError, as a missing key would. They are converted to dicts only when they are
+serialized to JSON (see to_dict, and the JSON provider in app.py).
+A record is read-only once it is built, since the same record can be handed to several requests (see
+connect.last_known_good and singleflight.py): replace returns a copy with some fields changed.
+
+Functionality:
+===============
+
+1. The Profile, Membership and Group classes hold a user profile, a group membership and a group
+2. The format_date function formats a date from the Connect API
+3. The detach function copies a result that is handed to several callers
+
+Example usage:
+===============
+
+cd <path>/<to>/af-portal
+python
+>>> from portal import connect
+>>> profile = connect.get_user_profile('myusername')
+>>> profile["email"], profile.get("phone"), profile.to_dict()
+"""
+
+import sys
+from dateutil.parser import parse
+
+# The group that decides a user's role in the portal
+facility_group = "root.atlas-af"
+
+
+def format_date(value, date_format="calendar"):
+    """Formats a date from the Connect API: "object" (a datetime), "iso", "calendar" or a strftime format."""
+    if date_format == "object":
+        return parse(value)
+    if date_format == "iso":
+        return parse(value).isoformat()
+    if date_format == "calendar":
+        return parse(value).strftime("%B %m %Y")
+    return parse(value).strftime(date_format)
+
+
+class Record:
+    """A record with dict-style access to its fields. Subclasses list their fields in __slots__."""
+
+    __slots__ = ()
+    # Fields that are kept in the record, but are not part of its dict
+    hidden = ()
+
+    def __getitem__(self, key):
+        if key in self.__slots__ and key not in self.hidden:
+            try:
+                return getattr(self, key)
+            except AttributeError:
+                pass
+        raise KeyError(key)
+
+    def __setitem__(self, key, value):
+        raise TypeError("%s records are read-only, see replace" % type(self).__name__)
+
+    def replace(self, **fields):
+        """Returns a copy of the record, with the given fields set."""
+        record = type(self).__new__(type(self))
+        for key in self.__slots__:
+            if key in fields:
+                setattr(record, key, fields.pop(key))
+            elif hasattr(self, key):
+                setattr(record, key, getattr(self, key))
+        if fields:
+            raise KeyError(next(iter(fields)))
+        return record
+
+    def __contains__(self, key):
+        return key in self.__slots__ and key not in self.hidden and hasattr(self, key)
+
+    def get(self, key, default=None):
+        try:
+            return self[key]
+        except KeyError:
+            return default
+
+    def keys(self):
+        return [key for key in self.__slots__ if key in self]
+
+    def to_dict(self):
+        """Returns the record as a dict, with its nested records as dicts."""
+        result = {}
+        for key in self.keys():
+            value = getattr(self, key)
+            if isinstance(value, list):
+                value = [v.to_dict() if isinstance(v, Record) else v for v in value]
+            result[key] = value
+        return result
+
+    def __repr__(self):
+        return "%s(%r)" % (type(self).__name__, self.to_dict())
+
+
+class Membership(Record):
+    __slots__ = ("name", "state")
+
+    def __init__(self, name, state):
+        self.name = name
+        self.state = sys.intern(state)
+
+
+class Profile(Record):
+    # The fields are in the order of the profile dicts they replace, which keys() and to_dict() keep
+    __slots__ = (  # noqa: RUF023
+        "unix_name",
+        "unix_id",
+        "name",
+        "email",
+        "institution",
+        "phone",
+        "public_key",
+        "globus_id",
+        "totp_secret",
+        "join_date",
+        "group_memberships",
+        "role",
+        "roles",
+    )
+    hidden = ("roles",)
+
+    @classmethod
+    def from_metadata(cls, metadata, date_format="calendar", full=True):
+        """
+        Builds a profile from the metadata of a user in the Connect API.
+        When full is False, only the fields that are listed for the members of a group are kept.
+        """
+        profile = cls()
+        profile.unix_name = metadata["unix_name"]
+        profile.unix_id = metadata["unix_id"]
+        profile.name = metadata["name"]
+        profile.email = metadata["email"]
+        profile.institution = metadata["institution"]
+        profile.phone = metadata["phone"]
+        profile.join_date = format_date(metadata["join_date"], date_format)
+        memberships = metadata.get("group_memberships", [])
+        if full:
+            profile.public_key = metadata["public_key"]
+            profile.globus_id = metadata.get("globusID")
+            if "totp_secret" in metadata:
+                profile.totp_secret = metadata["totp_secret"]
+            profile.group_memberships = sorted(
+                (Membership(m["name"], m["state"]) for m in memberships),
+                key=lambda membership: membership.name,
+            )
+            profile.roles = {m.name: m.state for m in profile.group_memberships}
+            profile.role = profile.roles.get(facility_group, "nonmember")
+        else:
+            profile.role = "nonmember"
+            for membership in memberships:
+                if membership["name"] == facility_group:
+                    profile.role = sys.intern(membership["state"])
+                    break
+        return profile
+
+
+class Group(Record):
+    # In the order of the group dicts they replace, as for Profile
+    __slots__ = (  # noqa: RUF023
+        "name",
+        "display_name",
+        "description",
+        "email",
+        "phone",
+        "purpose",
+        "unix_id",
+        "pending",
+        "creation_date",
+        "role",
+        "is_removable",
+    )
+
+    @classmethod
+    def from_metadata(cls, metadata, date_format="calendar"):
+        """Builds a group from the metadata of a group in the Connect API."""
+        group = cls()
+        group.name = metadata["name"]
+        group.display_name = metadata["display_name"]
+        group.description = metadata["description"]
+        group.email = metadata["email"]
+        group.phone = metadata["phone"]
+        group.purpose = metadata["purpose"]
+        group.unix_id = metadata["unix_id"]
+        group.pending = metadata["pending"]
+        group.creation_date = format_date(metadata["creation_date"], date_format)
+        return group
+
+
+def detach(value):
+    """
+    Returns a copy of a result that shares nothing that a caller can change: the lists, tuples and dicts are copied.
+    Records are read-only, so a record is copied only when it holds a list or a dict
+    (the group memberships and roles of a profile).
+    """
+    if isinstance(value, Record):
+        fields = {
+            key: detach(getattr(value, key))
+            for key in value.__slots__
+            if isinstance(getattr(value, key, None), (list, tuple, dict))
+        }
+        return value.replace(**fields) if fields else value
+    if isinstance(value, list):
+        return [detach(item) for item in value]
+    if isinstance(value, tuple):
+        return tuple(detach(item) for item in value)
+    if isinstance(value, dict):
+        return {key: detach(item) for key, item in value.items()}
+    return value
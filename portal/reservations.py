@@ -0,0 +1,239 @@
+"""
+A ledger of the GPU, CPU and memory that has been reserved for notebooks which are being deployed.
+
+Checking a GPU product's availability and deploying a notebook are two separate steps.
+Without a ledger, two users who submit the form at the same time can both see one available GPU,
+and both deploy a notebook, which leaves one of the pods pending forever.
+
+The ledger is stored in a SQLite database, so that it is shared by every worker process on the host.
+A reservation is made atomically at validation time on the node that fits the request best (see capacity.py),
+and it is released when the deployment fails. After a successful deployment, the reservation is kept until the
+notebook's pod shows up in the requests of a node (see jupyterlab.get_gpu_nodes), and then it is dropped,
+so that the pod's resources are not counted twice.
+Reservations that are never released (e.g. when a worker dies, or a pod never gets scheduled) expire after a timeout.
+
+Functionality:
+===============
+
+1. The reserve function atomically finds a node that fits a request and reserves the requested resources on it
+2. The release function releases a reservation, or hands it over to the notebook's pod
+3. The subtract function subtracts the outstanding reservations from the free resources of each node
+4. The get_reservations function returns the outstanding reservations for each node
+5. The get_node function returns the node that a reservation is held on
+
+Dependencies:
+===============
+
+A portal.conf file, which may set RESERVATION_DB, RESERVATION_TIMEOUT and RESERVATION_SETTLE_TIME.
+
+Example usage:
+===============
+
+cd <path>/<to>/af-portal
+python
+>>> from portal import jupyterlab, reservations
+>>> nodes = jupyterlab.get_gpu_nodes(product='NVIDIA-A100-SXM4-40GB')
+>>> reservation = reservations.reserve(nodes, gpu_request=1, cpu_request=4, memory_request=16, owner='myusername')
+>>> reservations.get_reservations()
+>>> reservations.release(reservation)
+"""
+
+import sqlite3
+import threading
+import time
+import uuid
+from portal import capacity
+from portal.app import app, logger
+
+db_path = app.config.get("RESERVATION_DB", "/tmp/af-portal-reservations.db")
+# How long (in seconds) a reservation is held before it expires on its own
+timeout = app.config.get("RESERVATION_TIMEOUT", 300)
+# How long (in seconds) a reservation is held after a successful deployment, until the pod gets scheduled
+# (the reservation is dropped as soon as the pod shows up in a node's requests, see subtract)
+settle_time = app.config.get("RESERVATION_SETTLE_TIME", 300)
+
+lock = threading.Lock()
+
+
+def open_db():
+    """Opens a connection to the ledger, and creates the reservations table if it does not exist."""
+    conn = sqlite3.connect(db_path, timeout=10, isolation_level=None)
+    conn.execute(
+        "CREATE TABLE IF NOT EXISTS reservations ("
+        "id TEXT PRIMARY KEY, node TEXT, product TEXT, owner TEXT, "
+        "gpu INTEGER, cpu REAL, memory REAL, expires REAL, notebook TEXT)"
+    )
+    columns = [row[1] for row in conn.execute("PRAGMA table_info(reservations)")]
+    if "notebook" not in columns:
+        # A ledger created before reservations were matched to their notebooks
+        conn.execute("ALTER TABLE reservations ADD COLUMN notebook TEXT")
+    return conn
+
+
+def reserve(nodes, gpu_request, cpu_request, memory_request, owner=None, notebook=None):
+    """
+    Atomically subtracts the outstanding reservations from the free resources of each node,
+    and reserves the requested resources on the node that fits the request best.
+    Returns a reservation ID, or None when no node can host the request.
+
+    Function parameters:
+
+    nodes: (list) The nodes that may host the request, as returned by jupyterlab.get_gpu_nodes
+    gpu_request: (integer) The number of GPU instances to reserve
+    cpu_request: (integer) The number of CPU cores to reserve
+    memory_request: (integer) The amount of memory to reserve in GB
+    owner: (string) The username of the user making the reservation (optional)
+    notebook: (string) The ID of the notebook that the reservation is for (optional). The reservation is dropped
+              once a pod with this name shows up in the requests of a node.
+    """
+    with lock:
+        conn = open_db()
+        try:
+            # BEGIN IMMEDIATE takes the database write lock, so no other worker can reserve in between
+            conn.execute("BEGIN IMMEDIATE")
+            now = time.time()
+            conn.execute("DELETE FROM reservations WHERE expires <= ?", (now,))
+            net = subtract(nodes, conn=conn)
+            hosts = capacity.fit(net, gpu_request, cpu_request, memory_request)
+            if not hosts:
+                conn.execute("ROLLBACK")
+                return None
+            node = next(node for node in net if node["name"] == hosts[0])
+            reservation = uuid.uuid4().hex
+            conn.execute(
+                "INSERT INTO reservations VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                (
+                    reservation,
+                    node["name"],
+                    node["product"],
+                    owner,
+                    gpu_request,
+                    cpu_request,
+                    memory_request,
+                    now + timeout,
+                    notebook,
+                ),
+            )
+            conn.execute("COMMIT")
+        except Exception:
+            if conn.in_transaction:
+                conn.execute("ROLLBACK")
+            raise
+        finally:
+            conn.close()
+    logger.info(
+        "Reserved %d x %s on node %s for %s (reservation %s)"
+        % (gpu_request, node["product"], node["name"], owner, reservation)
+    )
+    return reservation
+
+
+def release(reservation, settle=False):
+    """
+    Releases a reservation.
+
+    Function parameters:
+
+    reservation: (string) The reservation ID returned by reserve. When it is None, nothing is released.
+    settle: (boolean) When settle is True (i.e. the notebook was deployed), the reservation is held until
+            the notebook's pod shows up in the requests of a node, or for at most RESERVATION_SETTLE_TIME seconds.
+    """
+    if reservation is None:
+        return
+    with lock:
+        conn = open_db()
+        try:
+            if settle:
+                conn.execute(
+                    "UPDATE reservations SET expires = MIN(expires, ?) WHERE id = ?",
+                    (time.time() + settle_time, reservation),
+                )
+            else:
+                conn.execute("DELETE FROM reservations WHERE id = ?", (reservation,))
+        finally:
+            conn.close()
+    logger.info("Released reservation %s" % reservation)
+
+
+def get_node(reservation):
+    """Returns the name of the node that a reservation is held on, or None when the reservation does not exist."""
+    if reservation is None:
+        return None
+    conn = open_db()
+    try:
+        row = conn.execute(
+            "SELECT node FROM reservations WHERE id = ?", (reservation,)
+        ).fetchone()
+    finally:
+        conn.close()
+    return row[0] if row else None
+
+
+def drop_bound(nodes, conn):
+    """Drops the reservations of the notebooks whose pods show up in the requests of the nodes."""
+    bound = {name for node in nodes for name in node.get("notebooks", ())}
+    if not bound:
+        return
+    rows = conn.execute(
+        "SELECT id, notebook FROM reservations WHERE notebook IS NOT NULL"
+    ).fetchall()
+    dropped = [(reservation,) for reservation, notebook in rows if notebook in bound]
+    if dropped:
+        conn.executemany("DELETE FROM reservations WHERE id = ?", dropped)
+        logger.info(
+            "Dropped %d reservations of notebooks that have been scheduled"
+            % len(dropped)
+        )
+
+
+def get_reservations(conn=None):
+    """Returns a dict that maps each node to the resources reserved on it."""
+    close = conn is None
+    if conn is None:
+        conn = open_db()
+    try:
+        rows = conn.execute(
+            "SELECT node, SUM(gpu), SUM(cpu), SUM(memory) FROM reservations "
+            "WHERE expires > ? GROUP BY node",
+            (time.time(),),
+        ).fetchall()
+    finally:
+        if close:
+            conn.close()
+    return {
+        node: dict(gpu=gpu or 0, cpu=cpu or 0, memory=memory or 0)
+        for node, gpu, cpu, memory in rows
+    }
+
+
+def subtract(nodes, reserved=None, conn=None):
+    """
+    Returns a copy of a list of nodes, with the outstanding reservations subtracted from the free resources of each node.
+    The reservations of notebooks whose pods already show up in the requests of the nodes are dropped first,
+    since the pods' resources are already counted in the nodes' free resources.
+
+    Function parameters:
+
+    nodes: (list) The nodes, as returned by jupyterlab.get_gpu_nodes
+    reserved: (dict) The outstanding reservations, as returned by get_reservations (optional)
+    """
+    if reserved is None:
+        close = conn is None
+        if conn is None:
+            conn = open_db()
+        try:
+            drop_bound(nodes, conn)
+            reserved = get_reservations(conn=conn)
+        finally:
+            if close:
+                conn.close()
+    net = []
+    for node in nodes:
+        r = reserved.get(node["name"], dict(gpu=0, cpu=0, memory=0))
+        node = dict(node)
+        node["gpu_reserved"] = r["gpu"]
+        node["gpu_free"] = max(node["gpu_free"] - r["gpu"], 0)
+        node["cpu_free"] = max(int(node["cpu_free"] - r["cpu"]), 0)
+        node["mem_free"] = max(int(node["mem_free"] - r["memory"]), 0)
+        net.append(node)
+    return net
@@ -0,0 +1,318 @@
+"""
+A deploy queue with a capacity-aware admission scheduler, for GPU notebooks that cannot be deployed right away.
+
+When the cluster cannot host a GPU request yet, the request is queued instead of rejected.
+The queue is ordered first in, first out for each GPU product, and each user can have a limited number of queued requests.
+A background thread admits queued requests in order when the fit engine (capacity.py) finds a node for them,
+reserves their resources in the reservation ledger (reservations.py), and deploys them with jupyterlab.deploy_notebook.
+A request at the head of a product's queue is never overtaken by later requests for the same product,
+so that large multi-GPU requests are not starved by small ones.
+
+The queue is kept in memory, in the process that runs the portal.
+A queued request holds its notebook name, so that the name is not taken by another notebook while the request waits.
+
+Functionality:
+===============
+
+1. The enqueue function adds a deploy request to the queue
+2. The cancel function removes a queued request
+3. The get_queue function returns a user's requests with their queue position and estimated wait
+4. The holds_name function tells whether a queued request holds a notebook name
+5. The admit function deploys the queued requests that fit on the cluster
+6. The start_scheduler function starts a thread that admits queued requests on an interval
+
+Dependencies:
+===============
+
+A portal.conf file with the following optional settings:
+
+QUEUE_MAX_PER_USER: (int) The number of requests a user can have in the queue. The default is 2.
+QUEUE_INTERVAL: (int) How often (in seconds) the scheduler tries to admit queued requests. The default is 30.
+
+Example usage:
+===============
+
+cd <path>/<to>/af-portal
+python
+>>> from portal import scheduler
+>>> entry = scheduler.enqueue(settings)  # The settings of jupyterlab.deploy_notebook
+>>> scheduler.get_queue('myusername')
+>>> scheduler.admit()
+"""
+
+import datetime
+import threading
+import time
+import uuid
+from portal import backends, capacity, jupyterlab, quotas, reservations
+from portal.app import app, logger
+
+max_per_user = app.config.get("QUEUE_MAX_PER_USER", 2)
+interval = app.config.get("QUEUE_INTERVAL", 30)
+# How long (in seconds) finished requests are shown to their owners
+history_time = 3600
+
+entries = []
+lock = threading.Lock()
+started = False
+
+
+def enqueue(settings):
+    """
+    Adds a deploy request to the end of the queue. Returns the queue entry as a dict,
+    or None when the user already has the maximum number of requests in the queue.
+
+    Function parameters:
+
+    settings: (dict) The settings of the notebook, as passed to jupyterlab.deploy_notebook
+    """
+    with lock:
+        queued = [
+            entry
+            for entry in entries
+            if entry["owner"] == settings["owner"] and entry["status"] == "queued"
+        ]
+        if len(queued) >= max_per_user:
+            return None
+        entry = dict(
+            id=uuid.uuid4().hex,
+            owner=settings["owner"],
+            notebook_name=settings["notebook_name"],
+            notebook_id=jupyterlab.sanitize_k8s_pod_name(settings["notebook_id"]),
+            gpu_product=settings["gpu_product"],
+            gpu_request=settings["gpu_request"],
+            cpu_request=settings["cpu_request"],
+            memory_request=int(settings["memory_request"].rstrip("Gi")),
+            settings=settings,
+            status="queued",
+            message=None,
+            enqueued_at=time.time(),
+            finished_at=None,
+        )
+        entries.append(entry)
+    logger.info(
+        "Queued notebook %s for user %s" % (entry["notebook_name"], entry["owner"])
+    )
+    start_scheduler()
+    return entry
+
+
+def cancel(entry_id, owner):
+    """Cancels a queued request. Returns True when the request was cancelled."""
+    with lock:
+        for entry in entries:
+            if (
+                entry["id"] == entry_id
+                and entry["owner"] == owner
+                and entry["status"] == "queued"
+            ):
+                finish(entry, "cancelled")
+                return True
+    return False
+
+
+def finish(entry, status, message=None):
+    entry["status"] = status
+    entry["message"] = message
+    entry["finished_at"] = time.time()
+    entry.pop("settings", None)
+
+
+def holds_name(name):
+    """Returns a boolean indicating whether a queued (or deploying) request holds a notebook name."""
+    notebook_id = jupyterlab.sanitize_k8s_pod_name(name)
+    with lock:
+        return any(
+            entry["notebook_id"] == notebook_id
+            and entry["status"] in ("queued", "deploying")
+            for entry in entries
+        )
+
+
+def list_notebook_pods():
+    backend = backends.current()
+    return backend.core.list_namespaced_pod(
+        backend.namespace, label_selector="k8s-app=jupyterlab"
+    ).items
+
+
+def get_release_times(product):
+    """Returns a sorted list of the times (epoch seconds) when running notebooks release instances of a GPU product."""
+    pods = [
+        pod for pods in backends.fan_out(list_notebook_pods).values() for pod in pods
+    ]
+    times = []
+    for pod in pods:
+        if (pod.spec.node_selector or {}).get("nvidia.com/gpu.product") != product:
+            continue
+        expiration_date = jupyterlab.get_expiration_date(pod)
+        if expiration_date is None:
+            continue
+        gpus = int(
+            (pod.spec.containers[0].resources.requests or {}).get("nvidia.com/gpu", 0)
+        )
+        times.extend([expiration_date.timestamp()] * gpus)
+    return sorted(times)
+
+
+def estimate_wait(needed, available, release_times):
+    """
+    Estimates how long (in seconds) a queued request waits before it is admitted. Returns None when it cannot be estimated.
+
+    The request is admitted when the instances that are available, plus the instances released by expiring notebooks,
+    cover the instances needed by this request and by every request ahead of it.
+    Notebooks may be removed before they expire, so this is an upper bound.
+    """
+    shortfall = needed - available
+    if shortfall <= 0:
+        return 0
+    if shortfall > len(release_times):
+        return None
+    return max(release_times[shortfall - 1] - time.time(), 0)
+
+
+def get_queue(owner):
+    """Returns a list of a user's queued and recently finished requests, with their queue position and estimated wait."""
+    mine = []
+    with lock:
+        for entry in entries:
+            if entry["owner"] != owner:
+                continue
+            entry = dict(entry)
+            entry.pop("settings", None)
+            if entry["status"] == "queued":
+                ahead = [
+                    e
+                    for e in entries
+                    if e["status"] == "queued"
+                    and e["gpu_product"] == entry["gpu_product"]
+                    and e["enqueued_at"] <= entry["enqueued_at"]
+                ]
+                entry["position"] = len(ahead)
+                entry["needed"] = sum(e["gpu_request"] for e in ahead)
+            mine.append(entry)
+    gpus = {}
+    for entry in mine:
+        entry["enqueued_at"] = datetime.datetime.fromtimestamp(
+            entry["enqueued_at"], datetime.timezone.utc
+        ).isoformat()
+        if entry["status"] != "queued":
+            continue
+        product = entry["gpu_product"]
+        if product not in gpus:
+            availability = jupyterlab.get_gpu_availability(product=product)
+            gpus[product] = (
+                availability[0]["available"] if availability else 0,
+                get_release_times(product),
+            )
+        entry["estimated_wait"] = estimate_wait(entry.pop("needed"), *gpus[product])
+    return mine
+
+
+def admit():
+    """
+    Deploys the queued requests that fit on the cluster, in first in, first out order for each GPU product.
+    Returns the number of notebooks that were deployed.
+    """
+    deployed = 0
+    blocked = set()
+    with lock:
+        queued = [entry for entry in entries if entry["status"] == "queued"]
+    for entry in queued:
+        product = entry["gpu_product"]
+        if product in blocked:
+            continue
+        nodes = jupyterlab.get_gpu_nodes(product=product)
+        if not capacity.could_fit(
+            nodes, entry["gpu_request"], entry["cpu_request"], entry["memory_request"]
+        ):
+            with lock:
+                # The request may have been cancelled in the meantime
+                if entry["status"] == "queued":
+                    finish(
+                        entry,
+                        "failed",
+                        "No node with the %s can host this request." % product,
+                    )
+            continue
+        reservation = reservations.reserve(
+            nodes,
+            entry["gpu_request"],
+            entry["cpu_request"],
+            entry["memory_request"],
+            owner=entry["owner"],
+            notebook=entry["notebook_id"],
+        )
+        if reservation is None:
+            # Later requests for this product wait behind the head of the queue
+            blocked.add(product)
+            continue
+        with lock:
+            if entry["status"] != "queued":
+                reservations.release(reservation)
+                continue
+            entry["status"] = "deploying"
+            settings = entry["settings"]
+        try:
+            if not jupyterlab.notebook_name_available(settings["notebook_id"]):
+                raise ValueError(
+                    "The name %s is already taken." % settings["notebook_id"]
+                )
+            # The user may have deployed other notebooks while this one was queued
+            message = quotas.check(
+                entry["owner"],
+                entry["cpu_request"],
+                entry["memory_request"],
+                entry["gpu_request"],
+                hold=entry["notebook_id"],
+            )
+            if message:
+                raise ValueError(message)
+            node = reservations.get_node(reservation)
+            jupyterlab.deploy_notebook(
+                backend=backends.of_node(node).name,
+                gpu_node=node,
+                **settings,
+            )
+        except Exception as err:
+            reservations.release(reservation)
+            quotas.release(entry["notebook_id"])
+            logger.error(
+                "Unable to deploy queued notebook %s: %s"
+                % (entry["notebook_name"], str(err))
+            )
+            with lock:
+                finish(entry, "failed", str(err))
+            continue
+        reservations.release(reservation, settle=True)
+        with lock:
+            finish(entry, "deployed")
+        deployed += 1
+    with lock:
+        now = time.time()
+        entries[:] = [
+            entry
+            for entry in entries
+            if entry["finished_at"] is None or now - entry["finished_at"] < history_time
+        ]
+    return deployed
+
+
+def start_scheduler():
+    """Starts a thread that admits queued requests on an interval. Does nothing when it has already started."""
+    global started
+    with lock:
+        if started:
+            return
+        started = True
+
+    def inner():
+        while True:
+            try:
+                admit()
+            except Exception as err:
+                logger.error("Unable to admit queued notebooks: %s" % str(err))
+            time.sleep(interval)
+
+    threading.Thread(target=inner, daemon=True).start()
+    logger.info("Started notebook admission scheduler")
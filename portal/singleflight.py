@@ -0,0 +1,156 @@
+"""
+Request coalescing (single-flight) for expensive reads.
+
+When several requests make the same expensive read at the same time (e.g. admins opening groups.html call
+connect.get_user_profiles for the same group, or users opening the notebook form call jupyterlab.get_gpu_availability),
+each of them would do the full upstream work. A function decorated with coalesce runs once for each set of arguments
+that is in flight: the first caller (the leader) makes the call, and the callers with the same arguments that arrive
+while it runs wait for its result, or its exception, instead of making the call again.
+Nothing is cached: a caller that arrives after the call has returned makes a new call.
+
+A waiting caller waits no longer than the deadline of its own request (see deadlines.py).
+A call made with less than DEADLINE_RESERVE seconds left may skip optional work, or run out of time, so it is not shared:
+a caller with little time left makes its own call, and when a leader skipped work or ran out of time, the callers
+that waited for it make their own calls.
+Each caller gets its own copy of the result (see records.detach), so that a caller can change it.
+The number of calls, the number of callers that shared a call, and the time they waited are kept for each key (see get_stats).
+
+Functionality:
+===============
+
+1. The coalesce decorator collapses concurrent calls with the same arguments into one
+2. The get_stats function returns the wait metrics of each function and key
+
+Example usage:
+===============
+
+cd <path>/<to>/af-portal
+python
+>>> from portal import singleflight, jupyterlab
+>>> jupyterlab.get_gpu_availability()
+>>> singleflight.get_stats()
+"""
+
+import collections
+import threading
+import time
+from functools import wraps
+from portal import deadlines
+from portal.errors import DeadlineExceeded
+from portal.records import detach
+
+# The max number of keys whose metrics are kept, for each function
+max_keys = 500
+
+lock = threading.Lock()
+# The calls in flight, by (function name, key)
+in_flight = {}
+# The metrics of each key, by function name
+stats = {}
+
+
+class Call:
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+        # The number of callers that wait for the call
+        self.followers = 0
+        # Whether the call skipped optional work or ran out of time, so that its result cannot be shared
+        self.degraded = False
+
+
+def record(name, key, shared, wait):
+    """Adds a call (or a caller that shared a call, and the time it waited) to the metrics of a key."""
+    with lock:
+        keys = stats.setdefault(name, collections.OrderedDict())
+        entry = keys.get(key)
+        if entry is None:
+            entry = keys[key] = dict(calls=0, shared=0, wait_total=0.0, wait_max=0.0)
+        keys.move_to_end(key)
+        while len(keys) > max_keys:
+            keys.popitem(last=False)
+        if shared:
+            entry["shared"] += 1
+            entry["wait_total"] += wait
+            entry["wait_max"] = max(entry["wait_max"], wait)
+        else:
+            entry["calls"] += 1
+
+
+def coalesce(fn):
+    """
+    Runs a function once for each set of arguments that is in flight, and hands its result to every concurrent caller.
+    A call with arguments that cannot be hashed, or made with little time left, is not coalesced.
+    """
+    name = "%s.%s" % (fn.__module__.rsplit(".", 1)[-1], fn.__name__)
+
+    @wraps(fn)
+    def inner(*args, **kwargs):
+        key = (args, tuple(sorted(kwargs.items())))
+        try:
+            hash(key)
+        except TypeError:
+            return fn(*args, **kwargs)
+        deadline = deadlines.current()
+        if deadline is not None and deadline.remaining() <= deadlines.reserve:
+            return fn(*args, **kwargs)
+        with lock:
+            call = in_flight.get((name, key))
+            leader = call is None
+            if leader:
+                call = in_flight[(name, key)] = Call()
+            else:
+                call.followers += 1
+        if leader:
+            record(name, key, False, 0)
+            skipped = len(deadline.skipped) if deadline else 0
+            try:
+                call.result = fn(*args, **kwargs)
+            except Exception as err:
+                call.error = err
+                call.degraded = isinstance(err, DeadlineExceeded)
+            finally:
+                if deadline is not None and len(deadline.skipped) > skipped:
+                    call.degraded = True
+                with lock:
+                    del in_flight[(name, key)]
+                call.done.set()
+            if call.error is not None:
+                raise call.error
+            # No caller can join the call once it is done, so the copy is only needed when some waited for it
+            return detach(call.result) if call.followers else call.result
+        start = time.time()
+        finished = call.done.wait(deadlines.remaining())
+        record(name, key, True, time.time() - start)
+        if not finished:
+            raise DeadlineExceeded(deadline.seconds)
+        if call.degraded:
+            return fn(*args, **kwargs)
+        if call.error is not None:
+            raise call.error
+        return detach(call.result)
+
+    return inner
+
+
+def get_stats():
+    """
+    Returns a dict with the metrics of each coalesced function: for each key (the arguments, as a string),
+    the number of calls made, the number of callers that shared a call, and their total and max wait in seconds.
+    """
+    with lock:
+        return {
+            name: {
+                ", ".join(
+                    [repr(arg) for arg in key[0]]
+                    + ["%s=%r" % (k, v) for k, v in key[1]]
+                ): dict(
+                    entry,
+                    wait_total=round(entry["wait_total"], 3),
+                    wait_max=round(entry["wait_max"], 3),
+                )
+                for key, entry in keys.items()
+            }
+            for name, keys in stats.items()
+        }
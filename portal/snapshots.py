@@ -0,0 +1,91 @@
+"""
+Snapshots of expensive reads that are served stale while they are refreshed in the background.
+
+A snapshot holds the last value returned by a refresh function, and the time when it was computed.
+A background thread refreshes the snapshot on an interval, and readers get the last snapshot immediately.
+When a snapshot is older than its staleness bound (e.g. when the background thread has fallen behind),
+the reader refreshes it synchronously. Concurrent refreshes are collapsed into one.
+
+Functionality:
+===============
+
+1. The Snapshot.get method returns the last snapshot and its age in seconds
+2. The Snapshot.refresh method recomputes the snapshot, unless another thread has just recomputed it
+3. The Snapshot.start method starts the background refresher
+
+Example usage:
+===============
+
+cd <path>/<to>/af-portal
+python
+>>> from portal import jupyterlab
+>>> gpus, age = jupyterlab.gpu_snapshot.get()
+"""
+
+import threading
+import time
+from portal.app import logger
+
+
+class Snapshot:
+    def __init__(self, name, fn, interval=30, max_age=120):
+        """
+        name: (string) A name for the snapshot, used in the logs
+        fn: (function) A function without arguments that computes the value of the snapshot
+        interval: (number) How often (in seconds) the background thread refreshes the snapshot
+        max_age: (number) How old (in seconds) a snapshot can be before readers refresh it synchronously
+        """
+        self.name = name
+        self.fn = fn
+        self.interval = interval
+        self.max_age = max_age
+        self.value = None
+        self.timestamp = 0
+        self.lock = threading.Lock()
+        self.started = False
+
+    def get(self):
+        """Returns a tuple (value, age) with the last snapshot and its age in seconds."""
+        if not self.started:
+            self.start()
+        if time.time() - self.timestamp > self.max_age:
+            try:
+                self.refresh()
+            except Exception as err:
+                if self.value is None:
+                    raise
+                logger.error("Serving stale snapshot %s: %s" % (self.name, str(err)))
+        return self.value, time.time() - self.timestamp
+
+    def refresh(self):
+        """Recomputes the snapshot. When another thread is already refreshing it, waits for its result instead."""
+        requested = time.time()
+        with self.lock:
+            if self.timestamp >= requested:
+                return
+            start = time.time()
+            self.value = self.fn()
+            self.timestamp = time.time()
+        logger.info(
+            "Refreshed snapshot %s in %f seconds" % (self.name, self.timestamp - start)
+        )
+
+    def start(self):
+        """Starts a daemon thread that refreshes the snapshot on an interval."""
+        with self.lock:
+            if self.started:
+                return
+            self.started = True
+
+        def inner():
+            while True:
+                try:
+                    self.refresh()
+                except Exception as err:
+                    logger.error(
+                        "Unable to refresh snapshot %s: %s" % (self.name, str(err))
+                    )
+                time.sleep(self.interval)
+
+        threading.Thread(target=inner, daemon=True).start()
+        logger.info("Started refreshing snapshot %s" % self.name)
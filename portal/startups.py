@@ -0,0 +1,313 @@
+"""
+Tracks how long notebooks take to start, from deploy_notebook to the "Jupyter ... is running at" line in the pod log.
+
+For every deployed notebook, the tracker records four timestamps:
+
+deployed: when the portal created the pod (or claimed it from the warm pool, see warmpool.py)
+scheduled: when the pod was bound to a node (the PodScheduled condition)
+containers_ready: when the image was pulled and the container started (the ContainersReady condition)
+jupyter_ready: when the start script finished and Jupyter started listening (the kubelet's timestamp of the log line)
+
+The time between these timestamps shows whether a slow start comes from scheduling, image pulls or the start script.
+Each record keeps the backend that the notebook was deployed on, and the time its log was last read,
+so that each check reads only the log lines written since the last one.
+The timestamps are stored in a SQLite database next to the reservation ledger, one row per notebook,
+and rows are deleted after a retention period.
+
+Functionality:
+===============
+
+1. The record_deploy function records that a notebook was deployed
+2. The track function fills in the timestamps of the notebooks that are starting
+3. The get_stats function returns percentiles and a histogram of each startup phase, grouped by image, node or resource class
+4. The start_tracker function starts a thread that tracks starting notebooks on an interval
+
+Dependencies:
+===============
+
+A portal.conf file with the following optional settings:
+
+STARTUP_DB: (string) The path of the SQLite database. The default is /tmp/af-portal-startups.db.
+STARTUP_RETENTION_DAYS: (int) How long (in days) the timestamps of a notebook are kept. The default is 30.
+
+Example usage:
+===============
+
+cd <path>/<to>/af-portal
+python
+>>> from portal import startups
+>>> startups.track()
+>>> startups.get_stats(by='image', hours=24)
+"""
+
+import datetime
+import math
+import re
+import sqlite3
+import threading
+import time
+from dateutil.parser import parse
+from kubernetes.client.exceptions import ApiException
+from portal import backends
+from portal.app import app, logger
+
+db_path = app.config.get("STARTUP_DB", "/tmp/af-portal-startups.db")
+retention = app.config.get("STARTUP_RETENTION_DAYS", 30) * 86400
+# How often (in seconds) the tracker checks the notebooks that are starting
+interval = 15
+# How long (in seconds) the tracker waits for a notebook to start before giving up on it
+max_startup_time = 3600
+# How far back (in seconds) before the last read the log is read again, for clock skew between the portal and the kubelet
+log_overlap = 5
+
+phases = dict(
+    scheduling=("deployed", "scheduled"),
+    container_start=("scheduled", "containers_ready"),
+    start_script=("containers_ready", "jupyter_ready"),
+    total=("deployed", "jupyter_ready"),
+)
+# The upper bounds (in seconds) of the histogram buckets
+buckets = [5, 10, 30, 60, 120, 300, 600, 1800]
+groupings = ("image", "node", "resource_class", "warm")
+
+lock = threading.Lock()
+started = False
+
+
+def open_db():
+    """Opens a connection to the database, and creates the startups table if it does not exist."""
+    conn = sqlite3.connect(db_path, timeout=10, isolation_level=None)
+    conn.execute(
+        "CREATE TABLE IF NOT EXISTS startups ("
+        "notebook TEXT PRIMARY KEY, image TEXT, node TEXT, resource_class TEXT, warm INTEGER, "
+        "deployed REAL, scheduled REAL, containers_ready REAL, jupyter_ready REAL, "
+        "backend TEXT, log_checked REAL)"
+    )
+    columns = [row[1] for row in conn.execute("PRAGMA table_info(startups)")]
+    # A database created before the backend and the log position were recorded
+    for column in ("backend TEXT", "log_checked REAL"):
+        if column.split()[0] not in columns:
+            conn.execute("ALTER TABLE startups ADD COLUMN %s" % column)
+    return conn
+
+
+def record_deploy(name, image, warm=False, backend=None):
+    """
+    Records that a notebook was deployed. A notebook that is deployed again (e.g. resumed) starts a new record.
+
+    Function parameters:
+
+    name: (string) The ID of the notebook
+    image: (string) The Docker image of the notebook
+    warm: (boolean) Whether the notebook was claimed from the warm pool
+    backend: (string) The name of the notebook's backend. The default is the current backend.
+    """
+    conn = open_db()
+    try:
+        conn.execute(
+            "INSERT OR REPLACE INTO startups (notebook, image, warm, deployed, backend) "
+            "VALUES (?, ?, ?, ?, ?)",
+            (name, image, int(warm), time.time(), backend or backends.current().name),
+        )
+    finally:
+        conn.close()
+
+
+def get_resource_class(pod):
+    """Returns the GPU product of a notebook pod, or "cpu" for notebooks without GPUs."""
+    resources = pod.spec.containers[0].resources.requests or {}
+    if int(resources.get("nvidia.com/gpu", 0)) > 0:
+        return (pod.spec.node_selector or {}).get("nvidia.com/gpu.product", "gpu")
+    return "cpu"
+
+
+def get_jupyter_ready(name, since=None):
+    """
+    Returns the time (epoch seconds) when Jupyter started in a notebook pod, or None when it has not started yet.
+
+    name: (string) The name of the notebook
+    since: (number) Only the log lines written after this time (epoch seconds) are read. The default is the whole log.
+    """
+    backend = backends.current()
+    options = dict(timestamps=True)
+    if since is not None:
+        options["since_seconds"] = max(math.ceil(time.time() - since), 1)
+    log = backend.core.read_namespaced_pod_log(
+        name, namespace=backend.namespace, **options
+    )
+    for line in log.splitlines():
+        if re.search("Jupyter.*is running at", line):
+            # The kubelet prefixes each line with an RFC 3339 timestamp
+            return parse(line.split(" ", 1)[0]).timestamp()
+    return None
+
+
+def track():
+    """
+    Fills in the timestamps of the notebooks that are starting, and deletes old records.
+    Returns the number of notebooks that finished starting.
+    """
+    finished = 0
+    now = time.time()
+    conn = open_db()
+    try:
+        conn.execute("DELETE FROM startups WHERE deployed < ?", (now - retention,))
+        rows = conn.execute(
+            "SELECT notebook, deployed, scheduled, containers_ready, backend, log_checked "
+            "FROM startups WHERE jupyter_ready IS NULL AND deployed > ?",
+            (now - max_startup_time,),
+        ).fetchall()
+        for name, deployed, scheduled, containers_ready, backend, log_checked in rows:
+            try:
+                backend = backends.get(backend)
+            except KeyError:
+                # The backend was removed from the configuration
+                continue
+            try:
+                pod = backend.core.read_namespaced_pod(name, backend.namespace)
+            except ApiException as e:
+                if e.status != 404:
+                    logger.error(
+                        "Unable to read the pod of notebook %s: %s" % (name, str(e))
+                    )
+                continue
+            conditions = {
+                c.type: c.last_transition_time.timestamp()
+                for c in pod.status.conditions or []
+                if c.status == "True" and c.last_transition_time
+            }
+            # A warm pod was scheduled and started before it was claimed, so its phases start at the claim
+            scheduled = scheduled or conditions.get("PodScheduled")
+            if scheduled:
+                scheduled = max(scheduled, deployed)
+            containers_ready = containers_ready or conditions.get("ContainersReady")
+            if containers_ready:
+                containers_ready = max(containers_ready, deployed)
+            jupyter_ready = None
+            if containers_ready:
+                # Jupyter starts after the container, so the lines written before it started are never read
+                since = max(log_checked or 0, containers_ready) - log_overlap
+                checked = time.time()
+                try:
+                    with backends.use(backend):
+                        jupyter_ready = get_jupyter_ready(name, since=since)
+                    log_checked = checked
+                except ApiException as e:
+                    logger.error(
+                        "Unable to read the log of notebook %s: %s" % (name, str(e))
+                    )
+                if jupyter_ready:
+                    jupyter_ready = max(jupyter_ready, containers_ready)
+                    finished += 1
+            conn.execute(
+                "UPDATE startups SET node = ?, resource_class = ?, scheduled = ?, "
+                "containers_ready = ?, jupyter_ready = ?, log_checked = ? WHERE notebook = ?",
+                (
+                    backend.node_name(pod.spec.node_name)
+                    if pod.spec.node_name
+                    else None,
+                    get_resource_class(pod),
+                    scheduled,
+                    containers_ready,
+                    jupyter_ready,
+                    log_checked,
+                    name,
+                ),
+            )
+    finally:
+        conn.close()
+    return finished
+
+
+def percentile(values, p):
+    """Returns the p-th percentile of a sorted list, using the nearest-rank method."""
+    rank = max(math.ceil(p / 100 * len(values)) - 1, 0)
+    return values[min(rank, len(values) - 1)]
+
+
+def summarize(durations):
+    """Returns the count, percentiles and histogram of a list of durations in seconds."""
+    durations = sorted(durations)
+    if not durations:
+        return dict(count=0)
+    histogram = [0] * (len(buckets) + 1)
+    for duration in durations:
+        histogram[next((i for i, b in enumerate(buckets) if duration <= b), -1)] += 1
+    return dict(
+        count=len(durations),
+        p50=round(percentile(durations, 50), 1),
+        p90=round(percentile(durations, 90), 1),
+        p99=round(percentile(durations, 99), 1),
+        max=round(durations[-1], 1),
+        histogram=[
+            dict(le=bucket, count=count)
+            for bucket, count in zip(buckets + ["+Inf"], histogram)
+        ],
+    )
+
+
+def get_stats(by="image", hours=168):
+    """
+    Returns the percentiles and histogram of each startup phase, for each group of notebooks. Returns a dict.
+
+    Function parameters:
+
+    by: (string) Groups the notebooks by "image", "node", "resource_class" or "warm"
+    hours: (number) Only notebooks deployed in the last number of hours are included
+    """
+    if by not in groupings:
+        raise ValueError("Cannot group startups by %s" % by)
+    since = time.time() - hours * 3600
+    conn = open_db()
+    try:
+        rows = conn.execute(
+            "SELECT %s, deployed, scheduled, containers_ready, jupyter_ready FROM startups "
+            "WHERE deployed > ?" % by,
+            (since,),
+        ).fetchall()
+    finally:
+        conn.close()
+    groups = {}
+    for row in rows:
+        key = str(bool(row[0])).lower() if by == "warm" else row[0] or "unknown"
+        timestamps = dict(
+            zip(("deployed", "scheduled", "containers_ready", "jupyter_ready"), row[1:])
+        )
+        group = groups.setdefault(key, dict(notebooks=0, incomplete=0, phases={}))
+        group["notebooks"] += 1
+        if timestamps["jupyter_ready"] is None:
+            group["incomplete"] += 1
+        for phase, (begin, end) in phases.items():
+            if timestamps[begin] is not None and timestamps[end] is not None:
+                group["phases"].setdefault(phase, []).append(
+                    timestamps[end] - timestamps[begin]
+                )
+    for group in groups.values():
+        group["phases"] = {
+            phase: summarize(group["phases"].get(phase, [])) for phase in phases
+        }
+    return dict(
+        by=by,
+        since=datetime.datetime.fromtimestamp(since, datetime.timezone.utc).isoformat(),
+        groups=groups,
+    )
+
+
+def start_tracker():
+    """Starts a thread that tracks starting notebooks on an interval. Does nothing when it has already started."""
+    global started
+    with lock:
+        if started:
+            return
+        started = True
+
+    def inner():
+        while True:
+            try:
+                track()
+            except Exception as err:
+                logger.error("Unable to track notebook startups: %s" % str(err))
+            time.sleep(interval)
+
+    threading.Thread(target=inner, daemon=True).start()
+    logger.info("Started notebook startup tracker")
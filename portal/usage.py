@@ -0,0 +1,185 @@
+"""
+The live CPU and memory usage of notebooks, from the Kubernetes metrics API (metrics.k8s.io).
+
+Requests and limits show what a notebook reserved, but not what it uses.
+The usage of every notebook is read with one PodMetrics list for each backend's namespace, on an interval,
+and joined to the notebooks in memory (see jupyterlab.get_notebooks). The last samples of each pod are kept
+as a rolling usage history. Pods are keyed by backend and name, since two backends can run pods with the same name.
+The metrics are served from a snapshot (see snapshots.py), so reading them does not call the metrics API.
+
+Functionality:
+===============
+
+1. The get_usage function returns the current CPU and memory usage of a notebook
+2. The get_history function returns the rolling usage history of a notebook
+3. The get_backend_usage function returns the current usage of every notebook of a backend
+4. The get_report function returns the requests and usage of every notebook, to spot notebooks that reserve more than they use
+5. The usage_snapshot object refreshes the metrics in the background
+
+Dependencies:
+===============
+
+A portal.conf file with the following optional settings:
+
+USAGE_INTERVAL: (int) How often (in seconds) the metrics are read. The default is 60.
+USAGE_HISTORY_SIZE: (int) How many samples of each pod are kept in the usage history. The default is 60.
+METRICS_URL: (string) The URL of a PodMetricsList to read instead of the metrics API of each backend,
+             e.g. a local stand-in for testing: "http://localhost:8001/pod-metrics.json".
+             Its pods are read as pods of the primary backend.
+
+Example usage:
+===============
+
+cd <path>/<to>/af-portal
+python
+>>> from portal import usage
+>>> usage.get_usage('mynotebook')
+>>> usage.get_history('mynotebook')
+>>> usage.get_report()
+"""
+
+import collections
+import threading
+import time
+import requests
+from dateutil.parser import parse
+from kubernetes.utils.quantity import parse_quantity
+from portal import backends, quotas, snapshots
+from portal.app import app, logger
+
+interval = app.config.get("USAGE_INTERVAL", 60)
+history_size = app.config.get("USAGE_HISTORY_SIZE", 60)
+metrics_url = app.config.get("METRICS_URL")
+
+# Maps each pod, by (backend name, pod name), to a deque of its last samples
+history = {}
+lock = threading.Lock()
+
+
+def list_pod_metrics():
+    """Returns the PodMetrics items of the notebooks on the current backend."""
+    if metrics_url:
+        response = requests.get(metrics_url, timeout=10)
+        response.raise_for_status()
+        return response.json()["items"]
+    backend = backends.current()
+    return backend.custom.list_namespaced_custom_object(
+        "metrics.k8s.io",
+        "v1beta1",
+        backend.namespace,
+        "pods",
+        label_selector="k8s-app=jupyterlab",
+    )["items"]
+
+
+def parse_pod_metrics(item):
+    """Returns a dict with the CPU usage (cores), memory usage (GB) and timestamp of a PodMetrics item."""
+    cpu = 0
+    memory = 0
+    for container in item["containers"]:
+        cpu += parse_quantity(container["usage"].get("cpu", 0))
+        memory += parse_quantity(container["usage"].get("memory", 0))
+    return dict(
+        cpu=round(float(cpu), 3),
+        memory=round(float(memory) / (1024 * 1024 * 1024), 3),
+        timestamp=parse(item["timestamp"]).isoformat()
+        if item.get("timestamp")
+        else None,
+    )
+
+
+def refresh():
+    """
+    Reads the metrics of every notebook, and appends them to the usage history.
+    Returns a dict of the usage of each pod, by (backend name, pod name).
+    """
+    if metrics_url:
+        results = {backends.get().name: list_pod_metrics()}
+    else:
+        results = backends.fan_out(list_pod_metrics)
+    current = {}
+    for backend, items in results.items():
+        for item in items:
+            current[(backend, item["metadata"]["name"])] = parse_pod_metrics(item)
+    with lock:
+        for name, sample in current.items():
+            history.setdefault(name, collections.deque(maxlen=history_size)).append(
+                sample
+            )
+        # Forget the pods that are gone, unless their backend did not answer this time
+        if len(results) == len(backends.get_backends()) or metrics_url:
+            for name in list(history):
+                if name not in current:
+                    del history[name]
+    return current
+
+
+usage_snapshot = snapshots.Snapshot(
+    "pod_usage", refresh, interval=interval, max_age=interval * 3
+)
+
+
+def get_usage(name, backend=None):
+    """
+    Returns a dict with the current CPU and memory usage of a notebook, or None when it has no metrics yet.
+    The notebook is looked up on the current backend when backend (a backend name) is None.
+    """
+    current, _ = usage_snapshot.get()
+    return current.get((backend or backends.current().name, name.lower()))
+
+
+def get_history(name, backend=None):
+    """Returns a list of the last samples of a notebook's usage, the oldest first. Takes the same parameters as get_usage."""
+    usage_snapshot.get()
+    with lock:
+        return list(history.get((backend or backends.current().name, name.lower()), []))
+
+
+def get_backend_usage(backend=None):
+    """
+    Returns a dict with the current usage of every notebook of a backend (the current backend when backend is None),
+    by pod name. Returns an empty dict when the metrics cannot be read, so that the notebook listings do not fail with them.
+    """
+    backend = backend or backends.current().name
+    try:
+        current, _ = usage_snapshot.get()
+    except Exception as err:
+        logger.error("Unable to read the notebook usage: %s" % str(err))
+        return {}
+    return {name: sample for (b, name), sample in current.items() if b == backend}
+
+
+def list_notebook_pods():
+    backend = backends.current()
+    return backend.core.list_namespaced_pod(
+        backend.namespace, label_selector="k8s-app=jupyterlab"
+    ).items
+
+
+def get_report():
+    """
+    Returns a list of dicts with the requests and the current usage of every notebook,
+    sorted by the CPU cores that are reserved but not used, the largest first.
+    """
+    current, age = usage_snapshot.get()
+    report = []
+    for backend, pods in backends.fan_out(list_notebook_pods).items():
+        for pod in pods:
+            cpu_request, mem_request, _ = quotas.parse_requests(
+                pod.spec.containers[0].resources.requests
+            )
+            used = current.get((backend, pod.metadata.name))
+            report.append(
+                dict(
+                    name=pod.metadata.name,
+                    backend=backend,
+                    owner=pod.metadata.labels.get("owner"),
+                    cpu_request=cpu_request,
+                    mem_request=round(mem_request, 3),
+                    cpu_usage=used["cpu"] if used else None,
+                    mem_usage=used["memory"] if used else None,
+                    cpu_idle=round(cpu_request - used["cpu"], 3) if used else None,
+                )
+            )
+    report.sort(key=lambda notebook: notebook["cpu_idle"] or 0, reverse=True)
+    return dict(notebooks=report, age=int(age), timestamp=time.time())
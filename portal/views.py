@@ -13,15 +13,49 @@ in the decorator's namespace.
 For more documentation on decorators and the @app.route decorator, see decorators.py
 """
 
-from flask import session, request, render_template, url_for, redirect, jsonify, flash
+from flask import (
+    session,
+    request,
+    render_template,
+    url_for,
+    redirect,
+    jsonify,
+    flash,
+    g,
+)
 from flask_qrcode import QRcode
-from portal import connect, jupyterlab, email, math, decorators
+from portal import (
+    auth,
+    backends,
+    connect,
+    jupyterlab,
+    email,
+    history,
+    math,
+    decorators,
+    directory,
+    provisioning,
+    quotas,
+    reconciler,
+    culler,
+    deadlines,
+    scheduler,
+    singleflight,
+    startups,
+    usage,
+    warmpool,
+)
 from portal.app import app, logger
-from portal.errors import ConnectApiError
+from portal.errors import (
+    ConnectApiError,
+    ConnectUnavailableError,
+    DeadlineExceeded,
+    InvalidFormError,
+)
 from urllib.parse import urlparse, urljoin
-import globus_sdk
 import threading
 import queue
+import time
 
 QRcode(app)
 
@@ -91,8 +125,25 @@ def hardware():
 
 @app.route("/hardware/gpus")
 def get_gpus():
-    gpus = jupyterlab.get_gpu_availability()
-    return jsonify(gpus=gpus)
+    gpus, age = jupyterlab.gpu_snapshot.get()
+    response = jsonify(gpus=gpus)
+    response.headers["Age"] = str(int(age))
+    return response
+
+
+@app.route("/hardware/history")
+def get_hardware_history():
+    now = int(time.time() * 1000)
+    end = request.args.get("end", now, type=int)
+    start = request.args.get("start", end - 86400000, type=int)
+    resolution = request.args.get("resolution")
+    if start > end or resolution not in (None, *history.resolutions):
+        return jsonify(message="Invalid range or resolution"), 400
+    return jsonify(
+        history.get_history(
+            start, end, product=request.args.get("product"), resolution=resolution
+        )
+    )
 
 
 @app.route("/signup")
@@ -104,17 +155,14 @@ def signup():
 def login():
     redirect_uri = url_for("login", _scheme="https", _external=True)
     logger.info("redirect_uri: " + redirect_uri)
-    client = globus_sdk.ConfidentialAppAuthClient(
-        app.config["CLIENT_ID"], app.config["CLIENT_SECRET"]
-    )
-    client.oauth2_start_flow(redirect_uri, refresh_tokens=True)
+    flow = auth.start_flow(redirect_uri)
     if "code" not in request.args:
-        auth_uri = client.oauth2_get_authorize_url()
+        auth_uri = flow.get_authorize_url()
         return redirect(auth_uri)
     else:
         code = request.args.get("code")
-        tokens = client.oauth2_exchange_code_for_tokens(code)
-        id_token = tokens.decode_id_token()
+        tokens = flow.exchange_code_for_tokens(code)
+        id_token = auth.decode_id_token(tokens)
         session.update(
             tokens=tokens.by_resource_server,
             is_authenticated=True,
@@ -124,9 +172,8 @@ def login():
             globus_id=id_token.get("sub", ""),
             last_authentication=id_token.get("last_authentication", -1),
         )
-        username = connect.get_username(session["globus_id"])
+        username, profile = connect.find_user(session["globus_id"])
         if username:
-            profile = connect.get_user_profile(username)
             if profile:
                 session["unix_name"] = profile["unix_name"]
                 session["unix_id"] = profile["unix_id"]
@@ -142,13 +189,8 @@ def login():
 @app.route("/logout")
 @decorators.login_required
 def logout():
-    client = globus_sdk.ConfidentialAppAuthClient(
-        app.config["CLIENT_ID"], app.config["CLIENT_SECRET"]
-    )
-    for token in (
-        token_info["access_token"] for token_info in session["tokens"].values()
-    ):
-        client.oauth2_revoke_token(token)
+    tokens = [token_info["access_token"] for token_info in session["tokens"].values()]
+    my_job_queue.put((auth.revocation_job(tokens), ()))
     session.clear()
     return redirect(url_for("home"))
 
@@ -217,6 +259,9 @@ def create_profile():
             }
             connect.create_user_profile(**profile)
             connect.update_user_role(profile["unix_name"], "root.atlas-af", "pending")
+            directory.record_role_change(
+                [profile["unix_name"]], "root.atlas-af", "pending"
+            )
             session.update(
                 unix_name=profile["unix_name"],
                 name=profile["name"],
@@ -276,6 +321,7 @@ def get_user_groups():
 def request_membership(unix_name):
     try:
         connect.update_user_role(unix_name, "root.atlas-af", "pending")
+        directory.record_role_change([unix_name], "root.atlas-af", "pending")
         flash("Requested membership in the ATLAS Analysis Facility group", "success")
         return redirect(url_for("profile"))
     except ConnectApiError as err:
@@ -307,15 +353,18 @@ def get_notebooks():
 def configure_notebook():
     username = session["unix_name"]
     notebook_name = jupyterlab.generate_notebook_name(username)
-    groups = connect.get_user_roles(username)
-    if "root.atlas-af.bigmem" in groups:
-        return render_template(
-            "jupyterlab_form.html", max_mem=256, notebook_name=notebook_name
-        )
+    groups = quotas.get_groups(username)
+    limits = quotas.get_limits(groups)
+    # A notebook can request at most 256 GB (see decorators.validate_notebook), and no more than the user's quota
+    if "memory" in limits:
+        max_mem = min(int(limits["memory"]), 256)
+    elif "root.atlas-af.bigmem" in groups:
+        max_mem = 256
     else:
-        return render_template(
-            "jupyterlab_form.html", max_mem=32, notebook_name=notebook_name
-        )
+        max_mem = 32
+    return render_template(
+        "jupyterlab_form.html", max_mem=max_mem, notebook_name=notebook_name
+    )
 
 
 @app.route("/jupyterlab/deploy", methods=["POST"])
@@ -338,20 +387,100 @@ def deploy_notebook():
         "gpu_product": request.form["gpu-product"],
         "hours_remaining": int(request.form["duration"]),
     }
-    jupyterlab.deploy_notebook(**settings)
+    if g.get("insufficient_capacity"):
+        entry = scheduler.enqueue(settings)
+        if entry is None:
+            flash(
+                "%s You already have %d notebooks waiting in the queue."
+                % (g.insufficient_capacity, scheduler.max_per_user),
+                "warning",
+            )
+            return redirect(url_for("configure_notebook"))
+        flash(
+            "%s Notebook %s was added to the queue, and it will start when the resources become available."
+            % (g.insufficient_capacity, settings["notebook_name"]),
+            "info",
+        )
+        return redirect(url_for("open_jupyterlab"))
+    if g.get("backend"):
+        settings["backend"] = g.backend
+        settings["gpu_node"] = g.gpu_node
+    if warmpool.claim(**settings) is None:
+        jupyterlab.deploy_notebook(**settings)
     return redirect(url_for("open_jupyterlab"))
 
 
+@app.route("/jupyterlab/queue")
+@decorators.members_only
+def get_queue():
+    username = session["unix_name"]
+    return jsonify(queue=scheduler.get_queue(username))
+
+
+@app.route("/jupyterlab/queue/cancel/<entry_id>")
+@decorators.members_only
+def cancel_queued_notebook(entry_id):
+    username = session["unix_name"]
+    if scheduler.cancel(entry_id, username):
+        return jsonify(success=True, message="Removed the notebook from the queue.")
+    return jsonify(
+        success=False, message="Unable to remove the notebook from the queue."
+    )
+
+
 @app.route("/jupyterlab/remove/<notebook>")
 @decorators.members_only
 def remove_notebook(notebook):
-    pod = jupyterlab.get_pod(notebook)
-    if pod and pod.metadata.labels["owner"] == session["unix_name"]:
+    if jupyterlab.get_owner(notebook) == session["unix_name"]:
         if jupyterlab.remove_notebook(notebook):
             return jsonify(success=True, message="Notebook %s was deleted." % notebook)
     return jsonify(success=False, message="Unable to delete notebook %s" % notebook)
 
 
+@app.route("/jupyterlab/stop/<notebook>")
+@decorators.members_only
+def stop_notebook(notebook):
+    if jupyterlab.get_owner(notebook) == session["unix_name"]:
+        if jupyterlab.stop_notebook(notebook):
+            return jsonify(success=True, message="Notebook %s was stopped." % notebook)
+    return jsonify(success=False, message="Unable to stop notebook %s" % notebook)
+
+
+@app.route("/jupyterlab/resume/<notebook>")
+@decorators.members_only
+def resume_notebook(notebook):
+    username = session["unix_name"]
+    if jupyterlab.get_owner(notebook) == username:
+        stopped = next(
+            (
+                n
+                for found in backends.fan_out(
+                    jupyterlab.get_stopped_notebooks, username
+                ).values()
+                for n in found
+                if n["id"] == notebook.lower()
+            ),
+            None,
+        )
+        if stopped:
+            message = quotas.check(
+                username,
+                *quotas.parse_requests(stopped["requests"]),
+                hold=stopped["id"],
+            )
+            if message:
+                return jsonify(success=False, message=message)
+        try:
+            if jupyterlab.resume_notebook(notebook):
+                return jsonify(
+                    success=True, message="Notebook %s was resumed." % notebook
+                )
+        finally:
+            # A resumed notebook holds its resources in the quota index from now on
+            quotas.release(notebook.lower())
+    return jsonify(success=False, message="Unable to resume notebook %s" % notebook)
+
+
 @app.route("/monitoring/login_nodes")
 @decorators.members_only
 def login_nodes():
@@ -394,10 +523,101 @@ def list_notebooks():
 @app.route("/admin/get_notebook/<notebook_name>")
 @decorators.admins_only
 def get_notebook(notebook_name):
-    notebook = jupyterlab.get_notebook(name=notebook_name, log=True)
+    notebook = jupyterlab.get_notebook(name=notebook_name, log=True, usage=True)
     return jsonify(notebook=notebook)
 
 
+@app.route("/admin/usage")
+@decorators.admins_only
+def get_usage_report():
+    return jsonify(usage.get_report())
+
+
+@app.route("/admin/connect_status")
+@decorators.admins_only
+def get_connect_status():
+    return jsonify(
+        breaker=connect.breaker.stats(), stale_cache_size=len(connect.last_good)
+    )
+
+
+@app.route("/admin/coalescing")
+@decorators.admins_only
+def get_coalescing_stats():
+    return jsonify(singleflight.get_stats())
+
+
+@app.route("/admin/culler")
+@decorators.admins_only
+def get_culler_stats():
+    return jsonify(culler=culler.get_stats())
+
+
+@app.route("/admin/warmpool")
+@decorators.admins_only
+def get_warm_pool():
+    return jsonify(pool=warmpool.get_pool())
+
+
+@app.route("/admin/reconcile", methods=["GET", "POST"])
+@decorators.admins_only
+def reconcile_resources():
+    # GET reports orphans and drift, and POST cleans them up
+    return jsonify(reconciler.reconcile(dry_run=request.method == "GET"))
+
+
+@app.route("/admin/startups")
+@decorators.admins_only
+def get_startup_stats():
+    by = request.args.get("by", "image")
+    if by not in startups.groupings:
+        return jsonify(message="Cannot group startups by %s" % by), 400
+    hours = request.args.get("hours", 168, type=float)
+    return jsonify(startups=startups.get_stats(by=by, hours=hours))
+
+
+@app.route("/admin/quotas/<username>")
+@decorators.admins_only
+def get_quota(username):
+    groups = quotas.get_groups(username)
+    return jsonify(limits=quotas.get_limits(groups), usage=quotas.get_usage(username))
+
+
+@app.route("/admin/provision", methods=["POST"])
+@decorators.admins_only
+def provision_notebooks():
+    data = request.get_json(silent=True) or {}
+    try:
+        if data.get("group"):
+            usernames = connect.get_usernames(data["group"], roles=("admin", "active"))
+        else:
+            usernames = data.get("users", [])
+        job = provisioning.provision(
+            usernames,
+            data.get("template", {}),
+            prefix=data.get("prefix", "notebook"),
+            submitted_by=session.get("unix_name"),
+        )
+    except (ConnectApiError, InvalidFormError) as err:
+        return jsonify(success=False, message=str(err))
+    return jsonify(success=True, job=job)
+
+
+@app.route("/admin/provision/<job_id>")
+@decorators.admins_only
+def get_provisioning_job(job_id):
+    job = provisioning.get_job(job_id)
+    if job is None:
+        return jsonify(success=False, message="Job %s does not exist." % job_id)
+    return jsonify(success=True, job=job)
+
+
+@app.route("/admin/provision")
+@decorators.admins_only
+def list_provisioning_jobs():
+    return jsonify(jobs=provisioning.list_jobs())
+
+
 @app.route("/admin/users")
 @decorators.admins_only
 def user_info():
@@ -431,6 +651,25 @@ def update_user_institution():
     return jsonify(success=True)
 
 
+@app.route("/admin/update_user_profiles", methods=["POST"])
+@decorators.admins_only
+def update_user_profiles():
+    """
+    Updates many profiles at once. Takes a JSON body with a list of rows, each with a username and the fields to change,
+    e.g. {"rows": [{"username": "user1", "institution": "University of Chicago"}]}, and returns the result of each row.
+    """
+    data = request.get_json(silent=True) or {}
+    rows = data.get("rows", [])
+    results = connect.update_user_profiles(rows)
+    return jsonify(
+        success=all(result is None for result in results),
+        results=[
+            dict(username=row.get("username"), success=result is None, message=result)
+            for row, result in zip(rows, results)
+        ],
+    )
+
+
 @app.route("/admin/plot_users_over_time")
 @decorators.admins_only
 def plot_users_over_time():
@@ -486,6 +725,30 @@ def get_potential_members(group_name):
     return jsonify(potential_members=potential_members)
 
 
+@app.route("/admin/search_users/<group_name>")
+@decorators.admins_only
+def search_users(group_name):
+    """
+    Returns the users that match a query (the q parameter, or the search value of a DataTables server-side request),
+    among the users that can be added to a group. Answers DataTables server-side requests in their own format.
+    """
+    query = request.args.get("q", request.args.get("search[value]", ""))
+    k = request.args.get("length", request.args.get("k", 20), type=int)
+    # DataTables asks for length -1 when paging is off
+    k = min(k, 100) if k and k > 0 else 20
+    roles = ("nonmember", "pending")
+    if "draw" in request.args:
+        start = max(request.args.get("start", 0, type=int), 0)
+        total, users = directory.search_page(query, start=start, k=k, roles=roles)
+        return jsonify(
+            draw=request.args.get("draw", type=int),
+            recordsTotal=directory.count(),
+            recordsFiltered=total,
+            data=users,
+        )
+    return jsonify(users=directory.search(query, k=k, roles=roles))
+
+
 @app.route("/admin/email/<group_name>", methods=["POST"])
 @decorators.admins_only
 def send_email(group_name):
@@ -504,6 +767,7 @@ def send_email(group_name):
 @decorators.admins_only
 def add_group_member(unix_name, group_name):
     connect.update_user_role(unix_name, group_name, "active")
+    directory.record_role_change([unix_name], group_name, "active")
     return jsonify(success=True)
 
 
@@ -511,6 +775,7 @@ def add_group_member(unix_name, group_name):
 @decorators.admins_only
 def remove_group_member(unix_name, group_name):
     connect.remove_user_from_group(unix_name, group_name)
+    directory.record_role_change([unix_name], group_name, None)
     return jsonify(success=True)
 
 
@@ -520,6 +785,7 @@ def approve_membership_request(unix_name, group_name):
     approver = session["unix_name"]
 
     connect.update_user_role(unix_name, group_name, "active")
+    directory.record_role_change([unix_name], group_name, "active")
     logger.info("[approve] Updated role for %s in %s", unix_name, group_name)
 
     # Add job to queue
@@ -531,10 +797,71 @@ def approve_membership_request(unix_name, group_name):
     return jsonify(success=True)
 
 
+@app.route("/admin/bulk_membership/<group_name>/<action>", methods=["POST"])
+@decorators.admins_only
+def bulk_membership(group_name, action):
+    """
+    Adds, approves, denies or removes many users at once. Takes a JSON body with a list of usernames, e.g.
+    {"users": ["user1", "user2"]}, and returns the result of each user (None, or an error message).
+    """
+    data = request.get_json(silent=True) or {}
+    usernames = sorted(set(data.get("users", [])))
+    if not usernames:
+        return jsonify(success=False, message="No users were given.")
+    try:
+        if action in ("add", "approve"):
+            results = connect.update_user_roles(usernames, group_name, "active")
+        elif action in ("deny", "remove"):
+            results = connect.remove_users_from_group(usernames, group_name)
+        else:
+            return jsonify(success=False, message="Unknown action %s" % action)
+    except ConnectApiError as err:
+        return jsonify(success=False, message=str(err))
+    done = [username for username, error in results.items() if error is None]
+    directory.record_role_change(
+        done, group_name, "active" if action in ("add", "approve") else None
+    )
+    if action == "approve" and done:
+        # One email for the whole batch
+        my_job_queue.put(
+            (
+                send_bulk_approval_email,
+                (session["unix_name"], done, group_name),
+            )
+        )
+        logger.info("[approve] Queued email job for %d users", len(done))
+    return jsonify(success=len(done) == len(usernames), results=results)
+
+
+def send_bulk_approval_email(approver, usernames, group_name):
+    approved = set(usernames)
+    profiles = [
+        profile
+        for profile in connect.get_user_profiles(group_name)
+        if profile["unix_name"] in approved
+    ]
+    subject = "Account approval (%d users)" % len(usernames)
+    body = "User %s approved requests from %d users to join group %s.\n" % (
+        approver,
+        len(usernames),
+        group_name,
+    )
+    for profile in profiles:
+        body += "\nUnix name: %s\nFull name: %s\nEmail: %s\nInstitution: %s\n" % (
+            profile["unix_name"],
+            profile["name"],
+            profile["email"],
+            profile["institution"],
+        )
+    email.email_staff(subject, body)
+    logger.info("[email-job] Email sent successfully!")
+
+
 @app.route("/admin/deny_membership_request/<group_name>/<unix_name>")
 @decorators.admins_only
 def deny_membership_request(unix_name, group_name):
     connect.remove_user_from_group(unix_name, group_name)
+    directory.record_role_change([unix_name], group_name, None)
     return jsonify(success=True)
 
 
@@ -598,12 +925,41 @@ def internal_server_error(e):
     return render_template("500.html")
 
 
+@app.errorhandler(ConnectUnavailableError)
+def connect_unavailable(e):
+    return render_template("500.html", error_message=str(e)), 503
+
+
+@app.errorhandler(DeadlineExceeded)
+def deadline_exceeded(e):
+    return render_template("500.html", error_message=str(e)), 503
+
+
 @app.after_request
 def add_cache_control(response):
     response.cache_control.max_age = 0
+    staleness = connect.get_staleness()
+    if staleness is not None:
+        response.headers["X-Connect-Stale"] = str(int(staleness))
     return response
 
 
+@app.before_request
+def start_deadline():
+    deadlines.start()
+
+
+@app.teardown_request
+def finish_deadline(e):
+    deadlines.finish("%s %s" % (request.method, request.path))
+
+
 @app.before_request
 def start_notebook_maintenance():
     jupyterlab.start_notebook_maintenance()
+    culler.start_idle_culler()
+    warmpool.start_warm_pool()
+    startups.start_tracker()
+    quotas.start_quota_index()
+    history.start_sampler()
+    reconciler.start_reconciler()
@@ -0,0 +1,330 @@
+"""
+A warm pool of pre-started notebook pods, which cuts the time it takes a CPU notebook to become ready.
+
+Pulling a notebook image and starting its container takes most of the time between deploy_notebook and a ready notebook.
+The warm pool keeps a configurable number of pods running for each pool entry (an image with a CPU and memory request).
+A warm pod has already pulled its image and started its container, but it is not assigned to a user:
+its container waits until the pod's annotations name an owner (they are mounted with the downward API),
+and only then runs the notebook's start script.
+
+A deploy request that matches a pool entry claims a warm pod instead of creating a new pod.
+The claim relabels the pod with the owner, the notebook name and the TTL, sets the owner and token annotations,
+and creates the notebook's service, secret and ingress. The pool is then refilled in the background.
+A claimed notebook is named after its warm pod (e.g. warm-1a2b3c4d), and its display name is the name the user chose.
+Warm pods do not mount the owner's persistent volume, because the owner is not known when the pod is created
+(they are built without a storage class, see jupyterlab.deploy_notebook).
+The warm pool runs on the primary backend (see backends.py).
+
+Functionality:
+===============
+
+1. The claim function assigns a warm pod to a user, when one matches the notebook settings
+2. The refill function creates warm pods until every pool entry has its configured number of pods
+3. The start_warm_pool function starts a thread that refills the pool
+4. The get_pool function returns the number of warm pods for each pool entry
+
+Dependencies:
+===============
+
+A portal.conf file with the following optional setting:
+
+WARM_POOL: (list) The pool entries. Each entry is a dict with an image, a CPU request, a memory request in GB,
+           and the number of warm pods to keep, e.g.
+           [{"image": "hub.opensciencegrid.org/usatlas/ml-platform:latest", "cpu": 1, "memory": 2, "size": 2}]
+           The warm pool is disabled when WARM_POOL is empty.
+
+Example usage:
+===============
+
+cd <path>/<to>/af-portal
+python
+>>> from portal import warmpool
+>>> warmpool.refill()
+>>> warmpool.get_pool()
+>>> warmpool.claim(**settings)  # The settings of jupyterlab.deploy_notebook
+"""
+
+import copy
+import datetime
+import hashlib
+import json
+import math
+import os
+import threading
+import time
+from base64 import b64encode
+from kubernetes.client.exceptions import ApiException
+from portal import backends, manifests, quotas, startups
+from portal.app import app, logger
+
+pool = app.config.get("WARM_POOL", [])
+# How often (in seconds) the pool is checked when nothing has been claimed
+interval = 300
+
+# The container waits for the claim, and then runs the start script as the owner
+wait_script = """
+until grep -q '^af-portal/owner=' /etc/podinfo/annotations; do sleep 1; done
+get() { sed -n "s|^af-portal/$1=\\"\\(.*\\)\\"$|\\1|p" /etc/podinfo/annotations; }
+export OWNER="$(get owner)" OWNER_UID="$(get owner-uid)" JUPYTER_TOKEN="$(get token)"
+exec %s
+"""
+
+lock = threading.Lock()
+refill_requested = threading.Event()
+started = False
+
+
+def get_pool_key(entry):
+    """Returns a label value that identifies a pool entry."""
+    key = "%s:%s:%s" % (entry["image"], entry["cpu"], entry["memory"])
+    return hashlib.sha1(key.encode()).hexdigest()[:10]
+
+
+def find_entry(settings):
+    """Returns the pool entry that matches the settings of a notebook, or None."""
+    if settings.get("gpu_request"):
+        return None
+    for entry in pool:
+        if (
+            entry["image"] == settings["image"]
+            and entry["cpu"] == settings["cpu_request"]
+            and "%dGi" % entry["memory"] == settings["memory_request"]
+        ):
+            return entry
+    return None
+
+
+def build_warm_pod(entry, name):
+    """Builds the manifest of an unassigned warm pod from the notebook pod template."""
+    backend = backends.get()
+    settings = dict(
+        notebook_name=name,
+        notebook_id=name,
+        image=entry["image"],
+        owner="warm-pool",
+        owner_uid=0,
+        globus_id="none",
+        cpu_request=entry["cpu"],
+        cpu_limit=entry["cpu"] * 2,
+        memory_request="%dGi" % entry["memory"],
+        memory_limit="%dGi" % (entry["memory"] * 2),
+        gpu_request=0,
+        gpu_limit=0,
+        gpu_product="",
+        gpu_node="",
+        storage_class="",
+        hours_remaining=0,
+        namespace=backend.namespace,
+        domain_name=backend.domain_name,
+        token="",
+        start_script="/usr/local/bin/SetupPrivateJupyterLab.sh",
+    )
+    pod = manifests.build("pod", **settings)
+    pod["metadata"]["labels"] = {
+        "k8s-app": "jupyterlab-warm",
+        "warm-pool": get_pool_key(entry),
+        "notebook-id": name,
+    }
+    container = pod["spec"]["containers"][0]
+    container["args"] = ["/bin/bash", "-c", wait_script % settings["start_script"]]
+    container["env"] = [
+        env
+        for env in container["env"]
+        if env["name"] not in ("JUPYTER_TOKEN", "OWNER", "OWNER_UID")
+    ]
+    container["volumeMounts"].append(dict(name="podinfo", mountPath="/etc/podinfo"))
+    pod["spec"]["volumes"].append(
+        dict(
+            name="podinfo",
+            downwardAPI=dict(
+                items=[
+                    dict(
+                        path="annotations",
+                        fieldRef=dict(fieldPath="metadata.annotations"),
+                    )
+                ]
+            ),
+        )
+    )
+    return pod
+
+
+def list_warm_pods(entry):
+    """Returns the warm pods of a pool entry that are not being deleted."""
+    backend = backends.get()
+    pods = backend.core.list_namespaced_pod(
+        backend.namespace,
+        label_selector="k8s-app=jupyterlab-warm,warm-pool=%s" % get_pool_key(entry),
+    ).items
+    return [pod for pod in pods if pod.metadata.deletion_timestamp is None]
+
+
+def get_pool():
+    """Returns a list of dicts with the number of warm pods (and running warm pods) for each pool entry."""
+    status = []
+    for entry in pool:
+        pods = list_warm_pods(entry)
+        status.append(
+            dict(
+                entry,
+                pods=len(pods),
+                running=len([pod for pod in pods if pod.status.phase == "Running"]),
+            )
+        )
+    return status
+
+
+def refill():
+    """Creates warm pods until every pool entry has its configured number of pods. Returns the number of pods created."""
+    created = 0
+    backend = backends.get()
+    for entry in pool:
+        missing = entry["size"] - len(list_warm_pods(entry))
+        for _ in range(max(missing, 0)):
+            name = "warm-%s" % os.urandom(4).hex()
+            backend.core.create_namespaced_pod(
+                namespace=backend.namespace, body=build_warm_pod(entry, name)
+            )
+            created += 1
+    if created:
+        logger.info("Created %d warm notebook pods" % created)
+    return created
+
+
+def claim(**settings):
+    """
+    Assigns a running warm pod to a user, and creates the notebook's service, secret and ingress.
+    Returns the ID of the notebook, or None when no warm pod matches the settings, or when the claim fails.
+    A claimed pod has started the notebook as its owner, so a failed claim deletes the pod instead of returning it to the pool.
+
+    Function parameters:
+
+    The settings of jupyterlab.deploy_notebook
+    """
+    entry = find_entry(settings)
+    if entry is None:
+        return None
+    start = time.time()
+    backend = backends.get()
+    with lock:
+        pods = [pod for pod in list_warm_pods(entry) if pod.status.phase == "Running"]
+        pods.sort(key=lambda pod: pod.metadata.creation_timestamp)
+        for pod in pods:
+            name = pod.metadata.name
+            now = datetime.datetime.now(datetime.timezone.utc)
+            # time2delete counts from the pod's creation, so the time the pod spent in the pool is added
+            age = (now - pod.metadata.creation_timestamp).total_seconds() / 3600
+            token = b64encode(os.urandom(32)).decode()
+            labels = {
+                "k8s-app": "jupyterlab",
+                "warm-pool": None,
+                "notebook-name": settings["notebook_name"],
+                "owner": settings["owner"],
+                "globus-id": settings["globus_id"],
+                "time2delete": "ttl-%d"
+                % (settings["hours_remaining"] + math.ceil(age)),
+            }
+            annotations = {
+                "af-portal/owner": settings["owner"],
+                "af-portal/owner-uid": str(settings["owner_uid"]),
+                "af-portal/token": token,
+            }
+            body = {
+                "metadata": {
+                    "labels": labels,
+                    "annotations": annotations,
+                    # The claim fails with a conflict when another worker claims the pod first
+                    "resourceVersion": pod.metadata.resource_version,
+                }
+            }
+            try:
+                backend.core.patch_namespaced_pod(name, backend.namespace, body=body)
+            except ApiException as e:
+                if e.status in (404, 409):
+                    continue
+                raise
+            break
+        else:
+            return None
+    try:
+        manifest = build_warm_pod(entry, name)
+        manifest["metadata"]["labels"].update(
+            {key: value for key, value in labels.items() if value is not None}
+        )
+        manifest["metadata"]["annotations"] = annotations
+        create_notebook_objects(name, settings["owner"], token, manifest)
+    except Exception as err:
+        logger.error("Unable to claim warm pod %s: %s" % (name, str(err)))
+        try:
+            backend.core.delete_namespaced_pod(name, backend.namespace)
+        except ApiException as e:
+            if e.status != 404:
+                logger.error("Unable to delete warm pod %s: %s" % (name, str(e)))
+        refill_requested.set()
+        return None
+    startups.record_deploy(name, entry["image"], warm=True, backend=backend.name)
+    quotas.add(name, settings["owner"], entry["cpu"], entry["memory"], 0)
+    refill_requested.set()
+    logger.info(
+        "Claimed warm pod %s for notebook %s in %f seconds"
+        % (name, settings["notebook_name"], time.time() - start)
+    )
+    return name
+
+
+def create_notebook_objects(name, owner, token, pod):
+    """
+    Creates the service, secret and ingress of a claimed notebook.
+    When a call fails, the objects that this call created are deleted, and the error is raised.
+    """
+    backend = backends.get()
+    settings = dict(
+        notebook_id=name,
+        owner=owner,
+        token=token,
+        namespace=backend.namespace,
+        domain_name=backend.domain_name,
+    )
+    service = manifests.build("service", **settings)
+    secret = manifests.build("secret", **settings)
+    secret["stringData"] = {"pod": json.dumps(copy.deepcopy(pod))}
+    ingress = manifests.build("ingress", **settings)
+    created = []
+    try:
+        backend.core.create_namespaced_service(
+            namespace=backend.namespace, body=service
+        )
+        created.append(backend.core.delete_namespaced_service)
+        backend.core.create_namespaced_secret(namespace=backend.namespace, body=secret)
+        created.append(backend.core.delete_namespaced_secret)
+        backend.networking.create_namespaced_ingress(
+            namespace=backend.namespace, body=ingress
+        )
+    except Exception:
+        for delete in created:
+            try:
+                delete(name, backend.namespace)
+            except ApiException as e:
+                logger.error("Unable to clean up notebook %s: %s" % (name, str(e)))
+        raise
+
+
+def start_warm_pool():
+    """Starts a thread that refills the warm pool. Does nothing when the pool is disabled or has already started."""
+    global started
+    with lock:
+        if started or not pool:
+            return
+        started = True
+
+    def inner():
+        while True:
+            try:
+                refill()
+            except Exception as err:
+                logger.error("Unable to refill the warm pool: %s" % str(err))
+            refill_requested.wait(interval)
+            refill_requested.clear()
+
+    threading.Thread(target=inner, daemon=True).start()
+    logger.info("Started warm pool")
@@ -0,0 +1,36 @@
+# The environment configures the portal when it is imported, so it comes before the portal
+import environment
+import pytest
+from fake_kubernetes import FakeCluster
+from portal import backends, jupyterlab, reservations
+
+
+@pytest.fixture
+def cluster():
+    """A fake Kubernetes cluster, installed as the only notebook backend."""
+    cluster = FakeCluster()
+    cluster.install()
+    yield cluster
+    with backends.lock:
+        backends.registry.clear()
+    conn = reservations.open_db()
+    try:
+        conn.execute("DELETE FROM reservations")
+    finally:
+        conn.close()
+
+
+@pytest.fixture
+def deploy(cluster):
+    """
+    Deploys a notebook on the fake cluster with jupyterlab.deploy_notebook. Returns the notebook's name.
+    Takes the parameters of environment.notebook_settings.
+    """
+
+    def deploy(name, hours=24, **changes):
+        jupyterlab.deploy_notebook(
+            **environment.notebook_settings(name, hours=hours, **changes)
+        )
+        return name
+
+    return deploy
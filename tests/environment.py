@@ -0,0 +1,102 @@
+"""
+A throwaway configuration for the tests and benchmarks, so that the portal can be imported without
+the secrets of a deployment or access to a Kubernetes cluster.
+
+The configure function writes a portal.conf file and a kubeconfig file (whose cluster is never contacted)
+to a temporary directory, and points the app at them with PORTAL_CONFIG. It is called when this module is imported,
+so the module must be imported before the portal.
+
+The notebook_settings function returns the settings of a notebook, which the tests and the benchmarks share.
+"""
+
+import os
+import tempfile
+
+kubeconfig = """
+apiVersion: v1
+kind: Config
+clusters:
+- name: test
+  cluster:
+    server: https://127.0.0.1:6443
+contexts:
+- name: test
+  context:
+    cluster: test
+    user: test
+current-context: test
+users:
+- name: test
+  user:
+    token: test
+"""
+
+portal_conf = """
+SECRET_KEY = "test"
+WTF_CSRF_ENABLED = False
+CLIENT_ID = "test"
+CLIENT_SECRET = "test"
+CONNECT_API_ENDPOINT = "http://127.0.0.1:18080"
+CONNECT_API_TOKEN = "test"
+NAMESPACE = "af-jupyter"
+DOMAIN_NAME = "af.uchicago.edu"
+KUBECONFIG = %(kubeconfig)r
+RESERVATION_DB = %(reservation_db)r
+STARTUP_DB = %(startup_db)r
+HISTORY_DB = %(history_db)r
+"""
+
+
+directory = None
+
+
+def configure():
+    """
+    Writes the configuration to a temporary directory and sets PORTAL_CONFIG. Returns the directory.
+    Does nothing when the configuration has already been written.
+    """
+    global directory
+    if directory is not None:
+        return directory
+    directory = tempfile.mkdtemp(prefix="af-portal-tests-")
+    paths = dict(
+        kubeconfig=os.path.join(directory, "kubeconfig"),
+        reservation_db=os.path.join(directory, "reservations.db"),
+        startup_db=os.path.join(directory, "startups.db"),
+        history_db=os.path.join(directory, "history.db"),
+    )
+    with open(paths["kubeconfig"], "w") as f:
+        f.write(kubeconfig)
+    with open(os.path.join(directory, "portal.conf"), "w") as f:
+        f.write(portal_conf % paths)
+    os.environ["PORTAL_CONFIG"] = os.path.join(directory, "portal.conf")
+    return directory
+
+
+def notebook_settings(name, owner="alice", gpu=0, hours=8, **changes):
+    """
+    Returns the settings of jupyterlab.deploy_notebook for a small notebook.
+    gpu sets the GPU request, limit and product, and changes replace any other setting.
+    """
+    return dict(
+        dict(
+            notebook_name=name,
+            notebook_id=name,
+            image="hub.opensciencegrid.org/usatlas/ml-platform:latest",
+            owner=owner,
+            owner_uid=1000,
+            globus_id="00000000-0000-0000-0000-000000000000",
+            cpu_request=1,
+            cpu_limit=2,
+            memory_request="4Gi",
+            memory_limit="8Gi",
+            gpu_request=gpu,
+            gpu_limit=gpu,
+            gpu_product="NVIDIA-A100-SXM4-40GB" if gpu else "",
+            hours_remaining=hours,
+        ),
+        **changes,
+    )
+
+
+configure()
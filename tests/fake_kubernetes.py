@@ -0,0 +1,400 @@
+"""
+An in-memory stand-in for the Kubernetes API of a notebook backend, for the tests and benchmarks.
+
+The fake keeps the objects of each kind as dicts in their API form, and answers the calls of CoreV1Api,
+NetworkingV1Api and CustomObjectsApi that the portal makes with the same models that the kubernetes client returns.
+Label selectors (k=v, k!=v, k, !k) and field selectors on dotted paths (e.g. spec.nodeName=node1) are supported.
+Creating an object that exists raises a 409, and reading, patching or deleting a missing object raises a 404,
+as the API server does.
+
+A pod is Pending for startup_seconds after it is created (e.g. while its image is pulled), and then Running and Ready.
+Every call sleeps for latency seconds, to model the round trip to an API server, and is counted in calls.
+
+Example usage:
+===============
+
+>>> from fake_kubernetes import FakeCluster
+>>> cluster = FakeCluster(latency=0.005, startup_seconds=0.5)
+>>> cluster.install()
+>>> cluster.add_node('node1', gpu_product='NVIDIA-A100-SXM4-40GB', gpus=4)
+>>> cluster.calls
+"""
+
+import collections
+import copy
+import datetime
+import json
+import threading
+import time
+from base64 import b64encode
+from types import SimpleNamespace
+from kubernetes import client
+from kubernetes.client.rest import ApiException
+from portal import backends
+
+models = dict(
+    pod="V1Pod",
+    secret="V1Secret",
+    service="V1Service",
+    ingress="V1Ingress",
+    persistent_volume_claim="V1PersistentVolumeClaim",
+    event="CoreV1Event",
+    node="V1Node",
+)
+api_client = client.ApiClient()
+
+
+class Response:
+    def __init__(self, data):
+        self.data = json.dumps(data)
+
+
+def to_model(kind, data):
+    return api_client.deserialize(Response(data), models[kind])
+
+
+def to_dict(body):
+    if isinstance(body, dict):
+        return copy.deepcopy(body)
+    return api_client.sanitize_for_serialization(body)
+
+
+def encode_string_data(data):
+    """Moves the stringData of a secret into its data, base64-encoded, as the API server does."""
+    for key, value in (data.pop("stringData", None) or {}).items():
+        data.setdefault("data", {})[key] = b64encode(value.encode()).decode()
+    return data
+
+
+def merge(target, patch):
+    """Merges a patch into a dict, as a merge patch does: a None value deletes a key."""
+    for key, value in patch.items():
+        if value is None:
+            target.pop(key, None)
+        elif isinstance(value, dict) and isinstance(target.get(key), dict):
+            merge(target[key], value)
+        else:
+            target[key] = copy.deepcopy(value)
+
+
+def lookup(data, path):
+    for key in path.split("."):
+        if not isinstance(data, dict):
+            return None
+        data = data.get(key)
+    return data
+
+
+def matches(data, label_selector=None, field_selector=None):
+    labels = (data.get("metadata") or {}).get("labels") or {}
+    for term in filter(None, (label_selector or "").split(",")):
+        if "!=" in term:
+            key, value = term.split("!=", 1)
+            if labels.get(key) == value:
+                return False
+        elif "=" in term:
+            key, value = term.split("=", 1)
+            if labels.get(key) != value:
+                return False
+        elif term.startswith("!"):
+            if term[1:] in labels:
+                return False
+        elif term not in labels:
+            return False
+    for term in filter(None, (field_selector or "").split(",")):
+        if "!=" in term:
+            path, value = term.split("!=", 1)
+            if str(lookup(data, path)) == value:
+                return False
+        else:
+            path, value = term.split("=", 1)
+            if str(lookup(data, path)) != value:
+                return False
+    return True
+
+
+class FakeCluster:
+    def __init__(self, namespace="af-jupyter", latency=0, startup_seconds=0):
+        """
+        namespace: (string) The namespace of the backend
+        latency: (number) How long (in seconds) each call takes
+        startup_seconds: (number) How long (in seconds) a new pod is Pending before it is Running
+        """
+        self.namespace = namespace
+        self.latency = latency
+        self.startup_seconds = startup_seconds
+        # The objects of each kind, by (namespace, name)
+        self.objects = collections.defaultdict(dict)
+        # The time each pod was created, by (namespace, name)
+        self.created = {}
+        self.logs = {}
+        self.metrics = []
+        self.calls = collections.Counter()
+        self.lock = threading.Lock()
+        self.core = FakeApi(self)
+        self.networking = self.core
+        self.custom = self.core
+
+    def install(self, **options):
+        """Makes the fake the only backend of the portal, in place of the primary backend. Takes the options of FakeBackend."""
+        backend = FakeBackend(self, **options)
+        with backends.lock:
+            backends.registry.clear()
+            backends.registry[backends.primary_name] = backend
+        return backend
+
+    def add_node(
+        self, name, gpu_product=None, gpus=0, gpu_memory=40536, cpu=64, memory="512Gi"
+    ):
+        """Adds a node, which is a GPU node when gpu_product is given."""
+        labels = {"kubernetes.io/hostname": name}
+        if gpu_product:
+            labels.update(
+                {
+                    "gpu": "true",
+                    "nvidia.com/gpu.product": gpu_product,
+                    "nvidia.com/gpu.count": str(gpus),
+                    "nvidia.com/gpu.memory": str(gpu_memory),
+                }
+            )
+        resources = {"cpu": str(cpu), "memory": memory, "nvidia.com/gpu": str(gpus)}
+        self.objects["node"][(None, name)] = {
+            "metadata": {"name": name, "labels": labels},
+            "status": {"allocatable": resources, "capacity": resources},
+        }
+
+    def add_log(self, name, line, at=None, namespace=None):
+        """Adds a line to the log of a pod, written at a time (epoch seconds). The default is now."""
+        with self.lock:
+            self.logs.setdefault((namespace or self.namespace, name), []).append(
+                (at or time.time(), line)
+            )
+
+    def set_age(self, name, hours, namespace=None):
+        """Moves the creation of a pod back by a number of hours."""
+        created = datetime.datetime.now(datetime.timezone.utc) - datetime.timedelta(
+            hours=hours
+        )
+        with self.lock:
+            pod = self.objects["pod"][(namespace or self.namespace, name)]
+            pod["metadata"]["creationTimestamp"] = created.isoformat()
+
+    def call(self, method):
+        self.calls[method] += 1
+        if self.latency:
+            time.sleep(self.latency)
+
+    def pod_status(self, key, data):
+        created = self.created.get(key, 0)
+        ready_at = created + self.startup_seconds
+        running = time.time() >= ready_at
+
+        def condition(kind, status, at):
+            return {
+                "type": kind,
+                "status": "True" if status else "False",
+                "lastTransitionTime": datetime.datetime.fromtimestamp(
+                    at, datetime.timezone.utc
+                ).isoformat(),
+            }
+
+        data["status"] = dict(
+            data.get("status") or {},
+            phase="Running" if running else "Pending",
+            conditions=[
+                condition("PodScheduled", True, created),
+                condition("ContainersReady", running, ready_at if running else created),
+                condition("Ready", running, ready_at if running else created),
+            ],
+        )
+        return data
+
+    def get(self, kind, name, namespace):
+        key = (namespace, name)
+        with self.lock:
+            data = self.objects[kind].get(key)
+            if data is None:
+                raise ApiException(status=404, reason="Not Found")
+            data = copy.deepcopy(data)
+        if kind == "pod":
+            self.pod_status(key, data)
+        return to_model(kind, data)
+
+    def list(self, kind, namespace, label_selector=None, field_selector=None):
+        with self.lock:
+            found = [
+                (key, copy.deepcopy(data))
+                for key, data in self.objects[kind].items()
+                if namespace == "*" or key[0] == namespace
+            ]
+        items = []
+        for key, data in found:
+            if kind == "pod":
+                self.pod_status(key, data)
+            if matches(data, label_selector, field_selector):
+                items.append(to_model(kind, data))
+        return SimpleNamespace(items=items, metadata=SimpleNamespace())
+
+    def create(self, kind, namespace, body):
+        data = encode_string_data(to_dict(body))
+        metadata = data.setdefault("metadata", {})
+        metadata["namespace"] = namespace
+        metadata.setdefault(
+            "creationTimestamp",
+            datetime.datetime.now(datetime.timezone.utc).isoformat(),
+        )
+        metadata.setdefault("uid", "%s-%s" % (kind, metadata["name"]))
+        key = (namespace, metadata["name"])
+        if kind == "pod":
+            # A pod that is pinned to a node is scheduled on it
+            spec = data.setdefault("spec", {})
+            node = (spec.get("nodeSelector") or {}).get("kubernetes.io/hostname")
+            if node and not spec.get("nodeName"):
+                spec["nodeName"] = node
+        with self.lock:
+            if key in self.objects[kind]:
+                raise ApiException(status=409, reason="Conflict")
+            self.objects[kind][key] = data
+            if kind == "pod":
+                self.created[key] = time.time()
+        return self.get(kind, metadata["name"], namespace)
+
+    def patch(self, kind, name, namespace, body):
+        key = (namespace, name)
+        with self.lock:
+            if key not in self.objects[kind]:
+                raise ApiException(status=404, reason="Not Found")
+            merge(self.objects[kind][key], encode_string_data(to_dict(body)))
+        return self.get(kind, name, namespace)
+
+    def delete(self, kind, name, namespace):
+        with self.lock:
+            if self.objects[kind].pop((namespace, name), None) is None:
+                raise ApiException(status=404, reason="Not Found")
+            if kind == "pod":
+                self.created.pop((namespace, name), None)
+                self.logs.pop((namespace, name), None)
+        return SimpleNamespace(status="Success")
+
+
+class FakeApi:
+    """The calls of CoreV1Api, NetworkingV1Api and CustomObjectsApi, on a fake cluster."""
+
+    actions = ("create", "read", "patch", "replace", "delete", "list")
+
+    def __init__(self, cluster):
+        self.cluster = cluster
+
+    def __getattr__(self, method):
+        action, _, kind = method.partition("_namespaced_")
+        if action not in self.actions or kind not in models:
+            raise AttributeError(method)
+        cluster = self.cluster
+
+        def call(*args, **kwargs):
+            cluster.call(method)
+            args = list(args)
+            name = (
+                None
+                if action in ("create", "list")
+                else kwargs.pop("name", None) or args.pop(0)
+            )
+            namespace = kwargs.pop("namespace", None) or args.pop(0)
+            if action == "list":
+                return cluster.list(
+                    kind,
+                    namespace,
+                    kwargs.get("label_selector"),
+                    kwargs.get("field_selector"),
+                )
+            if action == "read":
+                return cluster.get(kind, name, namespace)
+            if action == "delete":
+                return cluster.delete(kind, name, namespace)
+            body = kwargs.pop("body", None) or args.pop(0)
+            if action == "create":
+                return cluster.create(kind, namespace, body)
+            if action == "replace":
+                cluster.delete(kind, name, namespace)
+                return cluster.create(kind, namespace, body)
+            return cluster.patch(kind, name, namespace, body)
+
+        return call
+
+    def list_node(self, label_selector=None, **kwargs):
+        self.cluster.call("list_node")
+        return self.cluster.list("node", None, label_selector)
+
+    def read_node(self, name, **kwargs):
+        self.cluster.call("read_node")
+        return self.cluster.get("node", name, None)
+
+    def list_pod_for_all_namespaces(
+        self, label_selector=None, field_selector=None, **kwargs
+    ):
+        self.cluster.call("list_pod_for_all_namespaces")
+        return self.cluster.list("pod", "*", label_selector, field_selector)
+
+    def read_namespaced_pod_log(self, name, namespace, **kwargs):
+        self.cluster.call("read_namespaced_pod_log")
+        self.cluster.get("pod", name, namespace)
+        lines = self.cluster.logs.get((namespace, name), [])
+        if kwargs.get("since_seconds"):
+            lines = [
+                line
+                for line in lines
+                if line[0] >= time.time() - kwargs["since_seconds"]
+            ]
+        if kwargs.get("tail_lines"):
+            lines = lines[-kwargs["tail_lines"] :]
+        return "".join(
+            "%s %s\n"
+            % (
+                datetime.datetime.fromtimestamp(at, datetime.timezone.utc).isoformat(),
+                line,
+            )
+            if kwargs.get("timestamps")
+            else line + "\n"
+            for at, line in lines
+        )
+
+    def list_namespaced_custom_object(
+        self, group, version, namespace, plural, **kwargs
+    ):
+        """Answers the metrics API's PodMetrics list (metrics.k8s.io/v1beta1 pods)."""
+        self.cluster.call("list_namespaced_custom_object")
+        if (group, plural) != ("metrics.k8s.io", "pods"):
+            raise ApiException(status=404, reason="Not Found")
+        items = [
+            item
+            for item in self.cluster.metrics
+            if item["metadata"].get("namespace", namespace) == namespace
+            and matches(item, kwargs.get("label_selector"))
+        ]
+        return {
+            "kind": "PodMetricsList",
+            "apiVersion": "metrics.k8s.io/v1beta1",
+            "items": copy.deepcopy(items),
+        }
+
+
+class FakeBackend(backends.Backend):
+    """A backend whose API clients are a fake cluster."""
+
+    def __init__(
+        self,
+        cluster,
+        name=None,
+        domain_name="af.uchicago.edu",
+        storage_class="rook-cephfs",
+    ):
+        self.name = name or backends.primary_name
+        self.primary = self.name == backends.primary_name
+        self.core = cluster.core
+        self.networking = cluster.networking
+        self.custom = cluster.custom
+        self.namespace = cluster.namespace
+        self.domain_name = domain_name
+        self.storage_class = storage_class
+        self.timeout = backends.default_timeout
+        self.executor = backends.ThreadPoolExecutor(max_workers=4)
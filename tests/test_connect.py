@@ -0,0 +1,55 @@
+import pytest
+from portal import connect
+from portal.errors import ConnectUnavailableError
+from portal.records import Group, Membership, Profile
+
+
+def make_group(name):
+    return Group.from_metadata(
+        dict(
+            name=name,
+            display_name=name,
+            description="",
+            email="",
+            phone="",
+            purpose="",
+            unix_id=1,
+            pending=False,
+            creation_date="2024-01-01",
+        )
+    )
+
+
+def test_a_record_is_changed_by_replacing_it():
+    group = make_group("root.atlas-af")
+    with pytest.raises(TypeError):
+        group["is_removable"] = True
+    removable = group.replace(is_removable=True)
+    assert removable["is_removable"] is True
+    assert "is_removable" not in group
+    with pytest.raises(KeyError):
+        group.replace(colour="blue")
+
+
+def test_a_stale_result_is_not_changed_by_earlier_callers(monkeypatch):
+    monkeypatch.setattr(connect, "last_good", connect.collections.OrderedDict())
+    profile = Profile()
+    profile.unix_name = "alice"
+    profile.group_memberships = [Membership("root.atlas-af", "active")]
+    available = [True]
+
+    @connect.last_known_good()
+    def get_groups(username):
+        if not available[0]:
+            raise ConnectUnavailableError("down")
+        return [make_group("root.atlas-af"), dict(profile=profile)]
+
+    first = get_groups("alice")
+    first.append(make_group("root.atlas-af.other"))
+    first[1]["profile"].group_memberships.clear()
+    available[0] = False
+    stale = get_groups("alice")
+    assert len(stale) == 2
+    assert len(stale[1]["profile"]["group_memberships"]) == 1
+    stale[1]["profile"].group_memberships.clear()
+    assert len(get_groups("alice")[1]["profile"]["group_memberships"]) == 1
@@ -0,0 +1,138 @@
+import datetime
+import json
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import pytest
+from portal import culler
+
+
+class StubJupyter(BaseHTTPRequestHandler):
+    """Answers GET /<notebook>/api/status as a Jupyter server does, for the notebooks in the server's activity map."""
+
+    def do_GET(self):
+        name, _, path = self.path.strip("/").partition("/")
+        last_activity = self.server.activity.get(name)
+        if path != "api/status" or last_activity is None:
+            self.send_response(404)
+            self.end_headers()
+            return
+        if self.headers.get("Authorization") != "token %s" % self.server.tokens.get(
+            name
+        ):
+            self.send_response(403)
+            self.end_headers()
+            return
+        body = json.dumps(
+            dict(
+                started=last_activity.isoformat(),
+                last_activity=last_activity.isoformat(),
+                kernels=1,
+            )
+        ).encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+@pytest.fixture
+def jupyter(cluster, monkeypatch):
+    """A stub Jupyter server that the culler asks for the status of every notebook."""
+    server = ThreadingHTTPServer(("127.0.0.1", 0), StubJupyter)
+    server.activity = {}
+    server.tokens = {}
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    monkeypatch.setattr(
+        culler,
+        "status_url",
+        "http://127.0.0.1:%d/{name}/api/status" % server.server_port,
+    )
+    yield server
+    server.shutdown()
+
+
+def idle(server, cluster, name, hours):
+    """Sets the last activity of a notebook to a number of hours ago, and lets the stub server accept its token."""
+    now = datetime.datetime.now(datetime.timezone.utc)
+    server.activity[name] = now - datetime.timedelta(hours=hours)
+    secret = cluster.core.read_namespaced_secret(name, cluster.namespace)
+    server.tokens[name] = secret.data["token"]
+
+
+def test_get_last_activity(jupyter, cluster, deploy):
+    deploy("active")
+    idle(jupyter, cluster, "active", 1)
+    last_activity = culler.get_last_activity("active")
+    assert last_activity == jupyter.activity["active"]
+    assert culler.get_last_activity("unknown", token="x") is None
+
+
+def test_culls_idle_notebooks_past_their_class_threshold(
+    jupyter, cluster, deploy, monkeypatch
+):
+    monkeypatch.setattr(culler, "thresholds", {"NVIDIA-A100-SXM4-40GB": 2, "cpu": 24})
+    monkeypatch.setattr(culler, "action", "remove")
+    cluster.add_node("gpu1", gpu_product="NVIDIA-A100-SXM4-40GB", gpus=4)
+    deploy("idlegpu", gpu=1, hours=48)
+    deploy("busygpu", gpu=1, hours=48)
+    deploy("idlecpu", hours=48)
+    for name in ("idlegpu", "busygpu", "idlecpu"):
+        cluster.set_age(name, 6)
+    idle(jupyter, cluster, "idlegpu", 3)
+    idle(jupyter, cluster, "busygpu", 1)
+    # A CPU notebook is culled after 24 hours, not after the 2 hours of the A100s
+    idle(jupyter, cluster, "idlecpu", 3)
+    before = culler.get_stats()
+
+    culled = culler.cull_idle_notebooks()
+
+    assert [notebook["name"] for notebook in culled] == ["idlegpu"]
+    assert culled[0]["idle_hours"] == 3.0
+    # The notebook had 42 of its 48 hours left, on 1 GPU
+    assert culled[0]["gpu_hours"] == pytest.approx(42, abs=0.2)
+    names = [
+        pod.metadata.name
+        for pod in cluster.core.list_namespaced_pod(cluster.namespace).items
+    ]
+    assert sorted(names) == ["busygpu", "idlecpu"]
+    stats = culler.get_stats()
+    assert stats["notebooks"] == before["notebooks"] + 1
+    assert stats["gpu_hours"] == pytest.approx(
+        before["gpu_hours"] + culled[0]["gpu_hours"]
+    )
+
+
+def test_dry_run_and_unreachable_notebooks_are_not_culled(
+    jupyter, cluster, deploy, monkeypatch
+):
+    monkeypatch.setattr(culler, "thresholds", {"cpu": 1})
+    deploy("idle", hours=48)
+    deploy("starting", hours=48)
+    cluster.set_age("idle", 5)
+    cluster.set_age("starting", 5)
+    idle(jupyter, cluster, "idle", 4)
+
+    culled = culler.cull_idle_notebooks(dry_run=True)
+
+    # The stub server does not know the starting notebook, so its activity is unknown
+    assert [notebook["name"] for notebook in culled] == ["idle"]
+    assert len(cluster.core.list_namespaced_pod(cluster.namespace).items) == 2
+
+
+def test_stop_action_keeps_the_notebook_resumable(
+    jupyter, cluster, deploy, monkeypatch
+):
+    monkeypatch.setattr(culler, "thresholds", {"cpu": 1})
+    monkeypatch.setattr(culler, "action", "stop")
+    deploy("idle", hours=48)
+    cluster.set_age("idle", 5)
+    idle(jupyter, cluster, "idle", 4)
+
+    assert [notebook["name"] for notebook in culler.cull_idle_notebooks()] == ["idle"]
+
+    assert cluster.core.list_namespaced_pod(cluster.namespace).items == []
+    secret = cluster.core.read_namespaced_secret("idle", cluster.namespace)
+    assert secret.metadata.labels["notebook-state"] == "stopped"
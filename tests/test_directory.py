@@ -0,0 +1,52 @@
+from portal import directory
+from portal.directory import SearchIndex
+
+
+def profile(unix_name, role="nonmember"):
+    return dict(
+        unix_name=unix_name,
+        name="User %s" % unix_name,
+        email="%s@uchicago.edu" % unix_name,
+        institution="University of Chicago",
+        role=role,
+    )
+
+
+def test_the_pages_add_up_to_the_matches():
+    index = SearchIndex(
+        [profile("user%03d" % i) for i in range(250)] + [profile("admin", "admin")]
+    )
+    pages = []
+    for start in range(0, 300, 100):
+        total, users = index.search_page(
+            "user", start=start, k=100, roles=("nonmember",)
+        )
+        assert total == 250
+        pages.extend(user["unix_name"] for user in users)
+    assert pages == ["user%03d" % i for i in range(250)]
+
+
+def test_a_substring_query_is_counted_exactly():
+    index = SearchIndex([profile("jdoe"), profile("doej"), profile("smith")])
+    total, users = index.search_page("doe", start=1, k=1)
+    assert total == 2
+    # "doej" starts with the query, so it ranks first
+    assert [user["unix_name"] for user in users] == ["jdoe"]
+
+
+def test_a_role_change_is_applied_until_the_next_refresh(monkeypatch):
+    index = SearchIndex([profile("jdoe"), profile("jsmith", "active")], built_at=100)
+    monkeypatch.setattr(directory, "role_changes", {})
+    monkeypatch.setattr(directory.directory_snapshot, "get", lambda: (index, 0))
+    monkeypatch.setattr(directory.time, "time", lambda: 200)
+    directory.record_role_change(["jdoe"], "root.atlas-af", "active")
+    directory.record_role_change(["jsmith"], "root.atlas-af", None)
+    # A change in another group does not change the role in the directory
+    directory.record_role_change(["jsmith"], "root.atlas-af.bigmem", "active")
+    users = directory.search("j", roles=("nonmember", "pending"))
+    assert [user["unix_name"] for user in users] == ["jsmith"]
+    assert users[0]["role"] == "nonmember"
+    # A snapshot taken after the changes has the new roles, so the changes are forgotten
+    index.built_at = 300
+    directory.search("j")
+    assert directory.role_changes == {}
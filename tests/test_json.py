@@ -0,0 +1,16 @@
+import pytest
+from flask import jsonify
+from portal.app import app
+from portal.records import Membership
+
+
+def test_a_response_reads_its_arguments_as_jsonify_does():
+    with app.app_context():
+        assert jsonify(Membership("root", "active")).get_json() == dict(
+            name="root", state="active"
+        )
+        assert jsonify(1, 2).get_json() == [1, 2]
+        assert jsonify(success=True).get_json() == dict(success=True)
+        assert jsonify().get_json() is None
+        with pytest.raises(TypeError):
+            jsonify(1, success=True)
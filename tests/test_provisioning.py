@@ -0,0 +1,79 @@
+import time
+import pytest
+from environment import notebook_settings
+from kubernetes.client.rest import ApiException
+from portal import connect, jupyterlab, provisioning
+
+template = dict(
+    image=notebook_settings("tutorial")["image"],
+    cpu=1,
+    memory=4,
+    gpu=0,
+    gpu_product="",
+    hours=8,
+)
+
+
+@pytest.fixture
+def job(cluster, monkeypatch):
+    monkeypatch.setattr(provisioning, "backoff", 0)
+    monkeypatch.setattr(
+        connect,
+        "get_user_profile",
+        lambda username: dict(unix_name=username, unix_id=1000, globus_id=None),
+    )
+    notebook = dict(
+        owner="bob", notebook_id="tutorial-bob", status="pending", attempts=0
+    )
+    return dict(template=provisioning.validate_template(template), notebooks=[notebook])
+
+
+def test_a_notebook_created_by_someone_else_is_skipped_and_kept(
+    cluster, job, deploy, monkeypatch
+):
+    # Someone deploys the notebook after its name was checked
+    monkeypatch.setattr(jupyterlab, "notebook_name_available", lambda name: True)
+    deploy("tutorial-bob", owner="carol")
+    notebook = job["notebooks"][0]
+    provisioning.deploy(job, notebook)
+    assert notebook["status"] == "skipped"
+    pod = cluster.core.read_namespaced_pod("tutorial-bob", cluster.namespace)
+    assert pod.metadata.labels["owner"] == "carol"
+
+
+def test_a_failed_attempt_deletes_only_what_it_created(cluster, job, monkeypatch):
+    def create_namespaced_ingress(*args, **kwargs):
+        raise ApiException(status=500, reason="Internal Server Error")
+
+    monkeypatch.setattr(
+        cluster.networking, "create_namespaced_ingress", create_namespaced_ingress
+    )
+    notebook = job["notebooks"][0]
+    provisioning.deploy(job, notebook)
+    assert notebook["status"] == "failed"
+    assert notebook["attempts"] == provisioning.retries + 1
+    for kind in ("pod", "service", "secret", "ingress"):
+        assert (cluster.namespace, "tutorial-bob") not in cluster.objects[kind]
+    # The owner's volume claim is shared by the owner's notebooks, so it is kept
+    assert (cluster.namespace, "bob-cephfs-pvc") in cluster.objects[
+        "persistent_volume_claim"
+    ]
+
+
+def test_the_duration_is_capped_at_a_week():
+    assert provisioning.validate_template(dict(template, hours=168))["hours"] == 168
+    with pytest.raises(provisioning.InvalidFormError):
+        provisioning.validate_template(dict(template, hours=169))
+
+
+def test_finished_jobs_are_pruned(monkeypatch):
+    monkeypatch.setattr(provisioning, "jobs", {})
+    monkeypatch.setattr(provisioning, "max_jobs", 2)
+    now = time.time()
+    for i, finished_at in enumerate(
+        [now - 2 * provisioning.job_retention, now - 30, now - 20, now - 10, None]
+    ):
+        provisioning.jobs[str(i)] = dict(id=str(i), finished_at=finished_at)
+    with provisioning.lock:
+        provisioning.prune_jobs()
+    assert sorted(provisioning.jobs) == ["2", "3", "4"]
@@ -0,0 +1,78 @@
+import threading
+import pytest
+from portal import connect, quotas
+
+
+@pytest.fixture
+def index(cluster, monkeypatch):
+    """An empty owner index, with a quota of 2 notebooks and 8 CPUs for every user."""
+    monkeypatch.setattr(quotas, "quotas", {"default": {"notebooks": 2, "cpu": 8}})
+    lookups = []
+
+    def get_user_roles(username):
+        lookups.append(username)
+        return {"root.atlas-af": "active"}
+
+    monkeypatch.setattr(connect, "get_user_roles", get_user_roles)
+    quotas.rebuild()
+    yield lookups
+    with quotas.lock:
+        quotas.notebooks.clear()
+        quotas.owners.clear()
+        quotas.holds.clear()
+        quotas.groups_cache.clear()
+
+
+def test_the_groups_are_looked_up_once(index):
+    for i in range(3):
+        assert quotas.check("alice", 1, 4, 0) is None
+    assert index == ["alice"]
+
+
+def test_concurrent_requests_cannot_both_take_the_last_slot(index):
+    quotas.add("first", "alice", 4, 4, 0)
+    messages = []
+    barrier = threading.Barrier(8)
+
+    def request(i):
+        barrier.wait()
+        messages.append(quotas.check("alice", 1, 4, 0, hold="notebook-%d" % i))
+
+    threads = [threading.Thread(target=request, args=(i,)) for i in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert messages.count(None) == 1
+    assert quotas.get_usage("alice")["notebooks"] == 2
+
+
+def test_a_released_hold_frees_the_quota(index):
+    assert quotas.check("alice", 4, 4, 0, hold="one") is None
+    assert quotas.check("alice", 4, 4, 0, hold="two") is None
+    assert quotas.check("alice", 4, 4, 0, hold="three") is not None
+    quotas.release("two")
+    assert quotas.get_usage("alice")["cpu"] == 4
+    # A hold that became a notebook is not given back
+    quotas.add("one", "alice", 4, 4, 0)
+    quotas.release("one")
+    assert quotas.get_usage("alice")["notebooks"] == 1
+
+
+def test_a_rebuild_keeps_the_changes_made_while_it_lists_the_pods(
+    index, cluster, deploy, monkeypatch
+):
+    deploy("kept")
+    deploy("removed")
+    real_list_notebook_pods = quotas.list_notebook_pods
+
+    def list_then_change():
+        pods = real_list_notebook_pods()
+        quotas.add("added", "alice", 1, 4, 0)
+        quotas.remove("removed")
+        return pods
+
+    monkeypatch.setattr(quotas, "list_notebook_pods", list_then_change)
+    assert quotas.check("bob", 1, 4, 0, hold="held") is None
+    quotas.rebuild()
+    assert sorted(quotas.notebooks) == ["added", "held", "kept"]
@@ -0,0 +1,47 @@
+import pytest
+from environment import notebook_settings
+from portal import scheduler
+
+
+@pytest.fixture
+def queue():
+    yield scheduler.entries
+    with scheduler.lock:
+        scheduler.entries.clear()
+
+
+def test_a_queued_request_holds_its_name(queue, monkeypatch):
+    monkeypatch.setattr(scheduler, "start_scheduler", lambda: None)
+    entry = scheduler.enqueue(notebook_settings("Queued", gpu=1))
+    assert scheduler.holds_name("queued")
+    assert not scheduler.holds_name("other")
+    assert scheduler.cancel(entry["id"], "alice")
+    assert not scheduler.holds_name("queued")
+    # Finishing twice is harmless
+    scheduler.finish(entry, "cancelled")
+
+
+def test_admission_does_not_overwrite_a_cancelled_request(queue, cluster, monkeypatch):
+    monkeypatch.setattr(scheduler, "start_scheduler", lambda: None)
+    # No node has the product, so the request can never fit
+    entry = scheduler.enqueue(notebook_settings("never", gpu=1))
+    real_could_fit = scheduler.capacity.could_fit
+
+    def cancel_then_check(*args):
+        scheduler.cancel(entry["id"], "alice")
+        return real_could_fit(*args)
+
+    monkeypatch.setattr(scheduler.capacity, "could_fit", cancel_then_check)
+    assert scheduler.admit() == 0
+    assert entry["status"] == "cancelled"
+
+
+def test_admission_deploys_on_the_reserved_node(queue, cluster, monkeypatch):
+    monkeypatch.setattr(scheduler, "start_scheduler", lambda: None)
+    cluster.add_node("gpu1", gpu_product="NVIDIA-A100-SXM4-40GB", gpus=4)
+    entry = scheduler.enqueue(notebook_settings("queued", gpu=2))
+    assert scheduler.admit() == 1
+    assert entry["status"] == "deployed"
+    pod = cluster.core.read_namespaced_pod("queued", cluster.namespace)
+    assert pod.spec.node_selector["kubernetes.io/hostname"] == "gpu1"
+    assert not scheduler.holds_name("queued")
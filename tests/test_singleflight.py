@@ -0,0 +1,74 @@
+import threading
+import time
+from portal import deadlines, singleflight
+from portal.records import Membership, Profile
+
+
+def coalesced(result, degrade=False):
+    """A coalesced function that returns result once the test lets it, and a list of the calls it made."""
+    calls = []
+    started = threading.Event()
+    release = threading.Event()
+
+    @singleflight.coalesce
+    def get_profiles(group_name):
+        calls.append(group_name)
+        started.set()
+        release.wait(5)
+        if degrade and len(calls) == 1:
+            # The leader's request runs low on time while the call runs
+            deadlines.current().expires = time.time() + deadlines.reserve / 2
+            deadlines.allows("events")
+        return result()
+
+    return get_profiles, calls, started, release
+
+
+def run_both(get_profiles, started, release, deadline=None, follower_deadline=None):
+    """Calls get_profiles from a leader thread, then from the calling thread once the leader has started."""
+    results = []
+
+    def lead():
+        with deadlines.use(deadline):
+            results.append(get_profiles("root.atlas-af"))
+
+    leader = threading.Thread(target=lead)
+    leader.start()
+    started.wait(5)
+    threading.Timer(0.2, release.set).start()
+    with deadlines.use(follower_deadline):
+        follower = get_profiles("root.atlas-af")
+    leader.join()
+    return results[0], follower
+
+
+def make_profiles():
+    profile = Profile()
+    profile.unix_name = "alice"
+    profile.group_memberships = [Membership("root.atlas-af", "active")]
+    return [profile]
+
+
+def test_each_caller_gets_its_own_copy_of_the_result():
+    get_profiles, calls, started, release = coalesced(make_profiles)
+    leader, follower = run_both(get_profiles, started, release)
+    assert calls == ["root.atlas-af"]
+    leader[0]["group_memberships"].clear()
+    leader.clear()
+    assert len(follower) == 1
+    assert len(follower[0]["group_memberships"]) == 1
+
+
+def test_a_degraded_result_is_not_shared():
+    get_profiles, calls, started, release = coalesced(make_profiles, degrade=True)
+    deadline = deadlines.Deadline(deadlines.reserve + 60)
+    leader, follower = run_both(get_profiles, started, release, deadline)
+    assert deadline.skipped == ["events"]
+    assert calls == ["root.atlas-af", "root.atlas-af"]
+
+
+def test_a_call_with_little_time_left_is_not_coalesced():
+    get_profiles, calls, started, release = coalesced(make_profiles)
+    follower_deadline = deadlines.Deadline(deadlines.reserve / 2)
+    run_both(get_profiles, started, release, follower_deadline=follower_deadline)
+    assert calls == ["root.atlas-af", "root.atlas-af"]
@@ -0,0 +1,32 @@
+import time
+from kubernetes.client.rest import ApiException
+from portal import startups
+
+
+def test_track_reads_only_new_log_lines(cluster, deploy):
+    deploy("mynotebook")
+    cluster.add_log("mynotebook", "Starting the notebook", at=time.time() - 3600)
+    assert startups.track() == 0
+    reads = cluster.calls["read_namespaced_pod_log"]
+    assert reads == 1
+
+    cluster.add_log("mynotebook", "Jupyter Server 2.14 is running at:")
+    assert startups.track() == 1
+    # The notebook has started, so its log is not read again
+    assert startups.track() == 0
+    assert cluster.calls["read_namespaced_pod_log"] == reads + 1
+    stats = startups.get_stats(by="resource_class", hours=1)
+    assert stats["groups"]["cpu"]["phases"]["total"]["count"] >= 1
+
+
+def test_track_skips_notebooks_it_cannot_read(cluster, deploy, monkeypatch):
+    deploy("mynotebook")
+
+    def read_namespaced_pod(*args, **kwargs):
+        raise ApiException(status=403, reason="Forbidden")
+
+    monkeypatch.setattr(cluster.core, "read_namespaced_pod", read_namespaced_pod)
+    assert startups.track() == 0
+    # The notebook's backend was recorded with the deploy, so nothing looks the notebook up
+    assert cluster.calls["list_namespaced_pod"] == 0
+    assert cluster.calls["read_namespaced_secret"] == 0
@@ -0,0 +1,84 @@
+from portal import jupyterlab, reservations
+
+
+def kinds(cluster, name):
+    """Returns the kinds of the objects that a notebook has on the fake cluster."""
+    return sorted(
+        kind
+        for kind, objects in cluster.objects.items()
+        if (cluster.namespace, name) in objects
+    )
+
+
+def test_stop_deletes_only_the_pod(cluster, deploy):
+    deploy("mynotebook")
+    assert jupyterlab.stop_notebook("mynotebook")
+    assert kinds(cluster, "mynotebook") == ["ingress", "secret", "service"]
+    # The owner's volume claim outlives the notebook
+    assert (cluster.namespace, "alice-cephfs-pvc") in cluster.objects[
+        "persistent_volume_claim"
+    ]
+    secret = cluster.core.read_namespaced_secret("mynotebook", cluster.namespace)
+    assert secret.metadata.labels["notebook-state"] == "stopped"
+    # Stopping a stopped notebook does nothing
+    assert not jupyterlab.stop_notebook("mynotebook")
+
+
+def test_resume_recreates_the_pod_with_the_time_left(cluster, deploy):
+    deploy("mynotebook", hours=10)
+    cluster.set_age("mynotebook", 4)
+    assert jupyterlab.stop_notebook("mynotebook")
+    calls = sum(cluster.calls.values())
+
+    assert jupyterlab.resume_notebook("mynotebook")
+
+    pod = cluster.core.read_namespaced_pod("mynotebook", cluster.namespace)
+    assert pod.metadata.labels["time2delete"] == "ttl-6"
+    assert kinds(cluster, "mynotebook") == ["ingress", "pod", "secret", "service"]
+    secret = cluster.core.read_namespaced_secret("mynotebook", cluster.namespace)
+    assert "notebook-state" not in secret.metadata.labels
+    # Resuming reads the secret, creates the pod and patches the secret, besides finding the notebook's backend
+    assert sum(cluster.calls.values()) - calls <= 6
+    # A running notebook cannot be resumed
+    assert not jupyterlab.resume_notebook("mynotebook")
+
+
+def test_a_gpu_notebook_resumes_on_a_node_with_room(cluster, deploy):
+    cluster.add_node("gpu1", gpu_product="NVIDIA-A100-SXM4-40GB", gpus=1)
+    cluster.add_node("gpu2", gpu_product="NVIDIA-A100-SXM4-40GB", gpus=1)
+    deploy("mynotebook", gpu=1, gpu_node="gpu1")
+    assert jupyterlab.stop_notebook("mynotebook")
+    # Another notebook takes the GPU of the node that the stopped notebook ran on
+    deploy("other", gpu=1, gpu_node="gpu1")
+
+    assert jupyterlab.resume_notebook("mynotebook")
+
+    pod = cluster.core.read_namespaced_pod("mynotebook", cluster.namespace)
+    assert pod.spec.node_selector["kubernetes.io/hostname"] == "gpu2"
+    # The reservation is dropped once the pod is counted on its node
+    assert jupyterlab.get_gpu_availability()[0]["available"] == 0
+    assert reservations.get_reservations() == {}
+
+
+def test_a_gpu_notebook_stays_stopped_without_room(cluster, deploy):
+    cluster.add_node("gpu1", gpu_product="NVIDIA-A100-SXM4-40GB", gpus=1)
+    deploy("mynotebook", gpu=1, gpu_node="gpu1")
+    assert jupyterlab.stop_notebook("mynotebook")
+    deploy("other", gpu=1, gpu_node="gpu1")
+
+    assert not jupyterlab.resume_notebook("mynotebook")
+    assert kinds(cluster, "mynotebook") == ["ingress", "secret", "service"]
+
+
+def test_a_backend_without_a_storage_class_has_no_persistent_volume(cluster, deploy):
+    cluster.install(storage_class=None)
+    deploy("mynotebook")
+    assert not cluster.objects["persistent_volume_claim"]
+    pod = cluster.core.read_namespaced_pod("mynotebook", cluster.namespace)
+    assert "persistent" not in [volume.name for volume in pod.spec.volumes]
+    assert "/workspace" not in [
+        mount.mount_path for mount in pod.spec.containers[0].volume_mounts
+    ]
+    # The notebook can still be stopped and resumed
+    assert jupyterlab.stop_notebook("mynotebook")
+    assert jupyterlab.resume_notebook("mynotebook")
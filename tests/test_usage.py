@@ -0,0 +1,48 @@
+import pytest
+from fake_kubernetes import FakeBackend, FakeCluster
+from portal import backends, jupyterlab, usage
+
+
+def pod_metrics(name, cpu, memory):
+    return dict(
+        metadata=dict(name=name, labels={"k8s-app": "jupyterlab"}),
+        timestamp="2026-10-19T12:00:00Z",
+        window="30s",
+        containers=[dict(name="notebook", usage=dict(cpu=cpu, memory=memory))],
+    )
+
+
+@pytest.fixture
+def metrics(cluster):
+    usage.usage_snapshot.timestamp = 0
+    yield cluster.metrics
+    usage.usage_snapshot.timestamp = 0
+    with usage.lock:
+        usage.history.clear()
+
+
+def test_the_listing_includes_the_usage_of_each_notebook(cluster, deploy, metrics):
+    deploy("busy")
+    deploy("quiet")
+    metrics.append(pod_metrics("busy", "1500m", "2Gi"))
+    notebooks = {n["id"]: n for n in jupyterlab.get_notebooks(owner="alice")}
+    assert notebooks["busy"]["usage"]["cpu"] == 1.5
+    assert notebooks["busy"]["usage"]["memory"] == 2
+    assert notebooks["quiet"]["usage"] is None
+
+
+def test_pods_with_the_same_name_on_two_backends_are_kept_apart(metrics):
+    other = FakeCluster(namespace="af-jupyter")
+    with backends.lock:
+        backends.registry["other"] = FakeBackend(other, name="other")
+    metrics.append(pod_metrics("shared", "1", "1Gi"))
+    other.metrics.append(pod_metrics("shared", "3", "1Gi"))
+    usage.usage_snapshot.refresh()
+    assert usage.get_usage("shared")["cpu"] == 1
+    assert usage.get_usage("shared", backend="other")["cpu"] == 3
+    usage.usage_snapshot.timestamp = 0
+    usage.usage_snapshot.refresh()
+    assert len(usage.get_history("shared", backend="other")) == 2
+    assert usage.get_backend_usage("other") == {
+        "shared": usage.get_usage("shared", "other")
+    }
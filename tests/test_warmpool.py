@@ -0,0 +1,49 @@
+import pytest
+from environment import notebook_settings
+from kubernetes.client.rest import ApiException
+from portal import warmpool
+
+# The pool runs the image of the notebook settings
+image = notebook_settings("mynotebook")["image"]
+
+
+@pytest.fixture
+def pool(cluster, monkeypatch):
+    monkeypatch.setattr(warmpool, "pool", [dict(image=image, cpu=1, memory=4, size=2)])
+    assert warmpool.refill() == 2
+    return warmpool.pool
+
+
+def test_claim_relabels_a_warm_pod(cluster, pool):
+    name = warmpool.claim(**notebook_settings("mynotebook"))
+    pod = cluster.core.read_namespaced_pod(name, cluster.namespace)
+    assert pod.metadata.labels["k8s-app"] == "jupyterlab"
+    assert pod.metadata.labels["owner"] == "alice"
+    assert pod.metadata.labels["notebook-name"] == "mynotebook"
+    assert "warm-pool" not in pod.metadata.labels
+    assert pod.metadata.annotations["af-portal/owner"] == "alice"
+    for kind in ("service", "secret", "ingress"):
+        assert (cluster.namespace, name) in cluster.objects[kind]
+    assert warmpool.get_pool()[0]["pods"] == 1
+    assert warmpool.refill() == 1
+
+
+def test_claim_only_matches_pool_entries(cluster, pool):
+    assert warmpool.claim(**notebook_settings("mynotebook", cpu_request=2)) is None
+    assert warmpool.claim(**notebook_settings("mynotebook", gpu_request=1)) is None
+    assert warmpool.get_pool()[0]["pods"] == 2
+
+
+def test_a_failed_claim_deletes_the_claimed_pod(cluster, pool, monkeypatch):
+    def create_namespaced_ingress(*args, **kwargs):
+        raise ApiException(status=500, reason="Internal Server Error")
+
+    monkeypatch.setattr(
+        cluster.networking, "create_namespaced_ingress", create_namespaced_ingress
+    )
+    assert warmpool.claim(**notebook_settings("mynotebook")) is None
+    # The other warm pod is still in the pool, and nothing else is left behind
+    pods = cluster.core.list_namespaced_pod(cluster.namespace).items
+    assert [pod.metadata.labels["k8s-app"] for pod in pods] == ["jupyterlab-warm"]
+    assert not cluster.objects["service"]
+    assert not cluster.objects["secret"]